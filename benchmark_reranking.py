@@ -0,0 +1,208 @@
+# encoding: utf-8
+"""
+Benchmark of every re-ranking mode on synthetic features.
+
+Query / gallery features are random L2-normalized vectors (dim=4096 is MGN's
+8 x 512 output). Every (mode, size) runs in a fresh process, which records its
+RSS once the inputs are built and its peak RSS during the re-ranking (the peak
+since process start where /proc/self/clear_refs is not available). The wall
+time of each phase comes from reranking.record_timings; loop is the original
+implementation, kept as it was, so it only has a total time. A run whose
+process dies (e.g. killed for running out of memory) or exceeds `timeout`
+seconds is recorded as failed. Results are appended to a JSON file so runs
+on different machines or commits can be compared.
+
+    python benchmark_reranking.py run --modes [sparse,torch_sparse] --sizes [[1000,5000]] --dim 4096
+
+modes: loop, dense, sparse, out_of_core, approximate, index, torch_dense, torch_sparse
+"""
+from __future__ import print_function
+from __future__ import division
+
+import json
+import multiprocessing
+import os
+import os.path as osp
+import platform
+import queue as queue_module
+import resource
+import shutil
+import sys
+import time
+
+import numpy as np
+
+import reranking
+
+MODES = ['loop', 'dense', 'sparse', 'out_of_core', 'approximate', 'index', 'torch_dense', 'torch_sparse']
+
+
+def _rss_mb(field):
+    """VmRSS / VmHWM (peak) of this process from /proc, or the getrusage peak elsewhere."""
+    if osp.exists('/proc/self/status'):
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / (1 << 10)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / (1 << 10)
+
+
+def _reset_peak_rss():
+    # Linux >= 4.0: writing 5 to clear_refs resets VmHWM to the current RSS
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def _features(num_query, num_gallery, dim, seed):
+    rng = np.random.RandomState(seed)
+    feats = rng.randn(num_query + num_gallery, dim).astype(np.float32)
+    feats /= np.linalg.norm(feats, axis=1, keepdims=True)
+    return feats[:num_query], feats[num_query:]
+
+
+def _distances(qf, gf):
+    feats = np.concatenate([qf, gf], axis=0)
+    sq_norms = np.sum(feats ** 2, axis=1)
+    dist = np.sqrt(np.maximum(sq_norms[:, None] + sq_norms[None, :] - 2 * np.dot(feats, feats.T), 0))
+    query_num = qf.shape[0]
+    return dist[:query_num, query_num:], dist[:query_num, :query_num], dist[query_num:, query_num:]
+
+
+def _run(mode, qf, gf, params):
+    k1, k2, lambda_value, workers = params['k1'], params['k2'], params['lambda_value'], params['workers']
+    if mode == 'loop':
+        return reranking.re_ranking_loop(*params['distances'], k1=k1, k2=k2, lambda_value=lambda_value)
+    if mode in ('dense', 'sparse'):
+        return reranking.re_ranking_from_features(qf, gf, k1=k1, k2=k2, lambda_value=lambda_value,
+                                                  backend=mode, workers=workers)
+    if mode == 'out_of_core':
+        final_dist = reranking.re_ranking_out_of_core(*params['distances'], k1=k1, k2=k2, lambda_value=lambda_value,
+                                                      memory_budget=params['memory_budget'], workers=workers)
+        shutil.rmtree(osp.dirname(final_dist.filename))
+        return final_dist
+    if mode == 'approximate':
+        return reranking.re_ranking_approximate(qf, gf, k1=k1, k2=k2, lambda_value=lambda_value,
+                                                shortlist=params['shortlist'], num_probes=params['num_probes'],
+                                                workers=workers)
+    if mode == 'index':
+        return reranking.RerankIndex(k1=k1, k2=k2).build(gf).rerank(qf, lambda_value=lambda_value)
+
+    import torch
+    from reranking_torch import re_ranking_torch
+    if params['torch_threads']:
+        torch.set_num_threads(params['torch_threads'])
+    device = torch.device(params['device'])
+    return re_ranking_torch(torch.from_numpy(qf).to(device), torch.from_numpy(gf).to(device),
+                            k1=k1, k2=k2, lambda_value=lambda_value, backend=mode[len('torch_'):])
+
+
+def _child(mode, num_query, num_gallery, params, queue):
+    try:
+        qf, gf = _features(num_query, num_gallery, params['dim'], params['seed'])
+        if mode in ('loop', 'out_of_core'):
+            # these take distance matrices, which are built before the baseline
+            params = dict(params, distances=_distances(qf, gf))
+        if mode.startswith('torch'):
+            import torch
+        _reset_peak_rss()
+        baseline = _rss_mb('VmRSS')
+
+        with reranking.record_timings() as timings:
+            start = time.time()
+            _run(mode, qf, gf, params)
+            total = time.time() - start
+        queue.put({'mode': mode, 'num_query': num_query, 'num_gallery': num_gallery,
+                   'total': total, 'phases': timings,
+                   'baseline_rss_mb': baseline, 'peak_rss_mb': _rss_mb('VmHWM'),
+                   'workers_peak_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / (1 << 10)})
+    except Exception as e:
+        queue.put({'mode': mode, 'num_query': num_query, 'num_gallery': num_gallery,
+                   'error': '{}: {}'.format(type(e).__name__, e)})
+
+
+def _wait(process, queue, timeout, poll=1.):
+    """The result the child puts on queue, or an error if it dies or runs past timeout seconds."""
+    start = time.time()
+    while True:
+        try:
+            return queue.get(timeout=poll)
+        except queue_module.Empty:
+            pass
+        if not process.is_alive():
+            # the result may have been flushed just before it exited
+            try:
+                return queue.get(timeout=poll)
+            except queue_module.Empty:
+                return {'error': 'process exited with code {}'.format(process.exitcode)}
+        if timeout is not None and time.time() - start > timeout:
+            process.terminate()
+            return {'error': 'timed out after {}s'.format(timeout)}
+
+
+def run(modes=('dense', 'sparse', 'torch_sparse'), sizes=((1000, 5000),), dim=4096, k1=20, k2=6,
+        lambda_value=0.3, workers=1, torch_threads=None, device='cpu', shortlist=200, num_probes=8,
+        memory_budget=1 << 30, repeat=1, seed=0, timeout=None, output='./result/benchmark_reranking.json'):
+    """Benchmark `modes` at every (num_query, num_gallery) of `sizes`, append the results to `output`.
+
+    timeout: seconds a run may take before it is killed and recorded as failed, None to wait
+    """
+    if isinstance(modes, str):
+        modes = modes.split(',')
+    for mode in modes:
+        if mode not in MODES:
+            raise ValueError('mode should be one of {}, but got {}'.format(MODES, mode))
+    params = {'dim': dim, 'k1': k1, 'k2': k2, 'lambda_value': lambda_value, 'workers': workers,
+              'torch_threads': torch_threads, 'device': device, 'shortlist': shortlist,
+              'num_probes': num_probes, 'memory_budget': memory_budget, 'seed': seed}
+
+    # a fresh interpreter per run: peak RSS is per process and never goes down
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for num_query, num_gallery in sizes:
+        for mode in modes:
+            for _ in range(repeat):
+                queue = context.Queue()
+                process = context.Process(target=_child, args=(mode, num_query, num_gallery, params, queue))
+                process.start()
+                result = _wait(process, queue, timeout)
+                process.join()
+                result.update(mode=mode, num_query=num_query, num_gallery=num_gallery)
+                results.append(result)
+                if 'error' in result:
+                    print('{mode:<13} {num_query:>6} x {num_gallery:<7} failed: {error}'.format(**result))
+                    continue
+                print('{mode:<13} {num_query:>6} x {num_gallery:<7} {total:8.2f}s  rss {baseline_rss_mb:6.0f}MB '
+                      'peak {peak_rss_mb:6.0f}MB  '
+                      .format(**result) +
+                      ' '.join('{} {:.2f}s'.format(phase, t) for phase, t in result['phases'].items()))
+
+    record = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'host': platform.node(),
+              'machine': platform.machine(), 'cpu_count': os.cpu_count(), 'python': platform.python_version(),
+              'numpy': np.__version__, 'params': params, 'results': results}
+    try:
+        import torch
+        record['torch'] = torch.__version__
+        record['torch_threads'] = torch.get_num_threads()
+    except ImportError:
+        pass
+
+    runs = []
+    if osp.exists(output):
+        with open(output) as f:
+            runs = json.load(f)
+    runs.append(record)
+    os.makedirs(osp.dirname(osp.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(runs, f, indent=2)
+    print('results written to {}'.format(output))
+    return results
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire()
@@ -28,6 +28,9 @@ class DefaultConfig(object):
     margin = None
     num_instances = 4
     num_gpu = 1
+    device = 'auto'  # auto, cuda, cpu
+    cpu_threads = None
+    cpu_interop_threads = None
 
     #data augment
     PIXEL_MEAN = [0.485, 0.456, 0.406]
@@ -57,6 +60,38 @@ class DefaultConfig(object):
     re_ranking = False
     norm = False
     crop_validation = False
+    rerank_workers = 1
+    rerank_backend = 'numpy'  # numpy, torch
+    rerank_torch_backend = 'sparse'  # dense, sparse: how rerank_backend torch keeps V
+    rerank_approximate = False
+    rerank_shortlist = 200
+    rerank_k1s = list(range(1, 21))
+    rerank_k2s = [2]
+    rerank_lambdas = [0.3]
+    rerank_grid_workers = 1
+    ann_probes = 8
+    ranking_backend = 'exact'  # exact, ivf, pq, two_stage, hash
+    ann_lists = 0  # inverted lists of the ivf index, 0 for sqrt(gallery size)
+    ann_index = ''  # ivf index file of the gallery, built and saved there if missing or stale
+    pq_codec = ''  # product quantizer trained by test.train_pq, used by ranking_backend pq
+    pq_subspaces = 64  # bytes per encoded image
+    pq_codes = ''  # pq codes of the gallery, encoded and saved there if missing or stale
+    pq_rescore = 10  # exactly re-scored candidates per rank
+    stage_one_slices = ['fg_p1']  # feature slices (models feature_slices) ranking the gallery in two_stage
+    stage_one_shortlist = 1000  # gallery images per query re-scored with the full feature in two_stage
+    projection_dim = 0  # PCA dims of the features (test.fit_projection), 0 to keep them unprojected
+    projection = ''  # PCA projection fitted by test.fit_projection, default save_dir/projection.pth
+    projection_whiten = False
+    hash_codec = ''  # ITQ hash codec trained by test.train_hash, used by ranking_backend hash
+    hash_codes = ''  # hash codes of the gallery, encoded and saved there if missing or stale
+    hash_bits = 256
+    hash_shortlist = 1000  # hamming nearest gallery images per query re-scored with the full feature
+    stack_views = False
+    max_eval_batch = 256
+    search_dtype = 'float32'  # float32, float16, bfloat16
+    prefetch = 2
+    feature_memmap_dir = ''  # memory-map extracted features here, '' to keep them in memory
+    feature_cache = ''  # cache directory of extracted features, '' to disable
 
     # miscs
     print_freq = 10
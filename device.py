@@ -0,0 +1,38 @@
+# encoding: utf-8
+import os
+
+import torch
+
+
+def _num_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def set_cpu_threads(num_threads=None, num_interop_threads=None, loader_workers=0):
+    """Intra-op threads default to the usable cores minus the DataLoader workers
+    decoding images next to the model; eager inference has no inter-op parallelism,
+    so inter-op threads default to 1."""
+    if num_threads is None:
+        num_threads = max(1, _num_cores() - loader_workers)
+    torch.set_num_threads(num_threads)
+    try:
+        # only allowed before the first parallel work in the process
+        torch.set_num_interop_threads(num_interop_threads or 1)
+    except RuntimeError:
+        pass
+
+
+def build_device(opt):
+    """torch.device of opt.device, 'auto' picks cuda when it is available.
+    On cpu the thread settings of opt are applied as well."""
+    if opt.device == 'auto':
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    else:
+        device = torch.device(opt.device)
+    if device.type == 'cuda' and not torch.cuda.is_available():
+        raise ValueError('device {} requested but cuda is not available'.format(opt.device))
+    if device.type == 'cpu':
+        set_cpu_threads(opt.cpu_threads, opt.cpu_interop_threads, loader_workers=opt.workers)
+    return device
@@ -3,16 +3,42 @@
 @author:  zhoumi
 @contact: zhoumi281571814@126.com
 """
+import hashlib
+import json
 import numpy as np
 import os
 import torch
 from PIL import Image
 import matplotlib.pyplot as plt
-import heapq
-from reranking import re_ranking as re_ranking_func
+from collections import OrderedDict
+from reranking import re_ranking_from_features, re_ranking_sweep, re_ranking_approximate
+from reranking_torch import re_ranking_torch
+from extraction import extract, stream
+from retrieval import BinaryHash, IVFIndex, PCA, PQCodec, nearest, recall_at_k, search, top_k, search_dtypes, \
+    two_stage_search
+import time
+
+def _digest(*arrays, block_size=65536):
+    sha1 = hashlib.sha1()
+    for array in arrays:
+        for start in range(0, len(array), block_size):
+            sha1.update(np.ascontiguousarray(array[start:start + block_size]).data)
+    return sha1.hexdigest()
+
+
+def _single_thread():
+    # torch's intra-op thread pool does not survive a fork
+    torch.set_num_threads(1)
+
 
 class Evaluator:
-    def __init__(self, model, pcb_model=None, norm=False, eval_flip=False, re_ranking=False, crop_validation=False, concate=False):
+    def __init__(self, model, pcb_model=None, norm=False, eval_flip=False, re_ranking=False, crop_validation=False, concate=False,
+                 rerank_workers=1, rerank_approximate=False, rerank_shortlist=200, ann_probes=8,
+                 rerank_backend='numpy', rerank_torch_backend='sparse', stack_views=False, max_eval_batch=256, device=None, feature_cache=None,
+                 search_dtype='float32', prefetch=2, memmap_dir=None, ranking_backend='exact', ann_lists=None,
+                 ann_index=None, pq_codec=None, pq_codes=None, pq_rescore=10, stage_one_columns=None, stage_one_shortlist=1000,
+                 projection=None, projection_dim=None, projection_whiten=False, hash_codec=None, hash_codes=None,
+                 hash_shortlist=1000):
         self.model = model
         self.norm = norm
         self.eval_flip = eval_flip
@@ -20,276 +46,116 @@ class Evaluator:
         self.pcb_model = pcb_model
         self.concate = concate
         self.crop_validation = crop_validation
-
-    def evaluate(self, queryloader, galleryloader,
-                 queryFliploader, galleryFliploader,
-                 queryCenterloader, galleryCenterloader,
-                 queryLtloader, galleryLtloader,
-                 queryRtloader, galleryRtloader,
-                 queryLbloader, galleryLbloader,
-                 queryRbloader, galleryRbloader,
-                 ranks=200, k1=20, k2=6, lambda_value=0.3):
-        self.model.eval()
-        if self.concate:
-            self.pcb_model.eval()
-        qf, q_paths = [], []
-        for inputs0, inputs1, inputs2, inputs3, inputs4, inputs5, inputs6\
-                in zip(queryloader, queryFliploader, queryCenterloader,
-                       queryLtloader, queryRtloader, queryLbloader, queryRbloader):
-            inputs, _, paths = self._parse_data(inputs0)
-            feature0 = self._forward(inputs)
-            if self.eval_flip:
-                inputs, _, _ = self._parse_data(inputs1)
-                feature1 = self._forward(inputs)
-                if self.crop_validation:
-                    imgs2, _, _ = self._parse_data(inputs2)
-                    feature2 = self._forward(imgs2)
-
-                    imgs3, _, _ = self._parse_data(inputs3)
-                    feature3 = self._forward(imgs3)
-
-                    imgs4, _, _ = self._parse_data(inputs4)
-                    feature4 = self._forward(imgs4)
-
-                    imgs5, _, _ = self._parse_data(inputs5)
-                    feature5 = self._forward(imgs5)
-
-                    imgs6, _, _ = self._parse_data(inputs6)
-                    feature6 = self._forward(imgs6)
-
-                    qf.append((feature0 + feature1 + feature2 + feature3 + feature4 + feature5 + feature6) / 7.0)
-                else:
-                    qf.append((feature0 + feature1) / 2.0)
-            else:
-                qf.append(feature0)
-            q_paths+=paths
-
-        qf = torch.cat(qf, 0)
-        if True == self.norm:
-            qf = torch.nn.functional.normalize(qf, dim=1, p=2)
-
+        self.rerank_workers = rerank_workers
+        self.rerank_approximate = rerank_approximate
+        self.rerank_shortlist = rerank_shortlist
+        self.ann_probes = ann_probes
+        if rerank_backend not in ('numpy', 'torch'):
+            raise ValueError("rerank_backend should be 'numpy' or 'torch', but got {}".format(rerank_backend))
+        self.rerank_backend = rerank_backend
+        if rerank_torch_backend not in ('dense', 'sparse'):
+            raise ValueError("rerank_torch_backend should be 'dense' or 'sparse', but got {}".format(
+                rerank_torch_backend))
+        self.rerank_torch_backend = rerank_torch_backend
+        self.stack_views = stack_views
+        self.max_eval_batch = max_eval_batch
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
+        self.feature_cache = feature_cache
+        if search_dtype not in search_dtypes:
+            raise ValueError('search_dtype should be one of {}, but got {}'.format(list(search_dtypes), search_dtype))
+        self.search_dtype = search_dtype
+        self.prefetch = prefetch
+        self.memmap_dir = memmap_dir
+        if ranking_backend not in ('exact', 'ivf', 'pq', 'two_stage', 'hash'):
+            raise ValueError("ranking_backend should be 'exact', 'ivf', 'pq', 'two_stage' or 'hash', but got {}".format(
+                ranking_backend))
+        if ranking_backend == 'hash' and hash_codec is None:
+            raise ValueError("ranking_backend 'hash' needs a hash_codec")
+        if ranking_backend == 'pq' and pq_codec is None:
+            raise ValueError("ranking_backend 'pq' needs a pq_codec")
+        if ranking_backend == 'two_stage' and not stage_one_columns:
+            raise ValueError("ranking_backend 'two_stage' needs stage_one_columns")
+        if ranking_backend == 'two_stage' and projection_dim:
+            # stage_one_columns index the model's feature slices, which projection mixes
+            raise ValueError("ranking_backend 'two_stage' does not work with projection_dim")
+        self.ranking_backend = ranking_backend
+        self.ann_lists = ann_lists
+        self.ann_index = ann_index
+        self.pq_codec = pq_codec
+        self.pq_codes = pq_codes
+        self.pq_rescore = pq_rescore
+        self.stage_one_columns = stage_one_columns
+        self.stage_one_shortlist = stage_one_shortlist
+        self.projection = projection
+        self.projection_dim = projection_dim
+        self.projection_whiten = projection_whiten
+        self.hash_codec = hash_codec
+        self.hash_codes = hash_codes
+        self.hash_shortlist = hash_shortlist
+
+    def evaluate(self, queryloader, galleryloader, ranks=200, k1=20, k2=6, lambda_value=0.3):
+        qf, _, q_paths = self._extract(queryloader)
         print("Extracted features for query set: {} x {}".format(qf.size(0), qf.size(1)))
 
-        gf, g_paths = [], []
-        for inputs0, inputs1, inputs2, inputs3, inputs4, inputs5, inputs6 \
-                in zip(galleryloader, galleryFliploader, galleryCenterloader,
-                       galleryLtloader, galleryRtloader, galleryLbloader, galleryRbloader):
-            inputs, _, paths = self._parse_data(inputs0)
-            feature0 = self._forward(inputs)
-            if self.eval_flip:
-                inputs, _, _ = self._parse_data(inputs1)
-                feature1 = self._forward(inputs)
-                if self.crop_validation:
-                    imgs2, _, _ = self._parse_data(inputs2)
-                    feature2 = self._forward(imgs2)
-
-                    imgs3, _, _ = self._parse_data(inputs3)
-                    feature3 = self._forward(imgs3)
-
-                    imgs4, _, _ = self._parse_data(inputs4)
-                    feature4 = self._forward(imgs4)
-
-                    imgs5, _, _ = self._parse_data(inputs5)
-                    feature5 = self._forward(imgs5)
-
-                    imgs6, _, _ = self._parse_data(inputs6)
-                    feature6 = self._forward(imgs6)
-
-                    gf.append((feature0 + feature1 + feature2 + feature3 + feature4 + feature5 + feature6) / 7.0)
-                else:
-                    gf.append((feature0 + feature1) / 2.0)
-            else:
-                gf.append(feature0)
-            g_paths +=paths
-
-        gf = torch.cat(gf, 0)
-        if True == self.norm:
-            gf = torch.nn.functional.normalize(gf, dim=1, p=2)
-
+        gf, _, g_paths = self._extract(galleryloader)
         print("Extracted features for gallery set: {} x {}".format(gf.size(0), gf.size(1)))
 
-        print("Computing distance matrix")
-
-        m, n = qf.size(0), gf.size(0)
-        q_g_dist = torch.pow(qf, 2).sum(dim=1, keepdim=True).expand(m, n) + \
-                   torch.pow(gf, 2).sum(dim=1, keepdim=True).expand(n, m).t()
-        q_g_dist.addmm_(1, -2, qf, gf.t())
-
-        # q_g_dist = q_g_dist.cpu().numpy()
-
-        if self.re_ranking:
-            q_q_dist = torch.pow(qf, 2).sum(dim=1, keepdim=True).expand(m, m) + \
-                       torch.pow(qf, 2).sum(dim=1, keepdim=True).expand(m, m).t()
-            q_q_dist.addmm_(1, -2, qf, qf.t())
-
-            g_g_dist = torch.pow(gf, 2).sum(dim=1, keepdim=True).expand(n, n) + \
-                       torch.pow(gf, 2).sum(dim=1, keepdim=True).expand(n, n).t()
-            g_g_dist.addmm_(1, -2, gf, gf.t())
-
-            q_g_dist = q_g_dist.numpy()
-            q_g_dist[q_g_dist < 0] = 0
-            q_g_dist = np.sqrt(q_g_dist)
-
-            q_q_dist = q_q_dist.numpy()
-            q_q_dist[q_q_dist < 0] = 0
-            q_q_dist = np.sqrt(q_q_dist)
-
-            g_g_dist = g_g_dist.numpy()
-            g_g_dist[g_g_dist < 0] = 0
-            g_g_dist = np.sqrt(g_g_dist)
-
-            distmat = torch.Tensor(re_ranking_func(q_g_dist, q_q_dist, g_g_dist, k1=k1, k2=k2, lambda_value=lambda_value)).cpu().numpy()
+        if self.re_ranking and self.rerank_approximate and ranks <= self.rerank_shortlist:
+            # the re-ranked shortlist already holds the top ranks, no Q x G matrix is built
+            print("Re-ranking the {} nearest gallery images".format(self.rerank_shortlist))
+            _, index = self._approximate_re_ranking(qf, gf, k1, k2, lambda_value)
+            index = index[:, :ranks]
+        elif self.re_ranking:
+            print("Computing distance matrix")
+            distmat = self._re_ranking(qf, gf, k1, k2, lambda_value).cpu().numpy()
+            index = top_k(distmat, ranks)
+        elif self.ranking_backend == 'ivf':
+            print("Searching top {} gallery images in {} probed lists".format(ranks, self.ann_probes))
+            _, index = self._gallery_index(gf).search(qf.numpy(), ranks)
+        elif self.ranking_backend == 'pq':
+            # gf is only read at the re-scored candidates, it can stay memory-mapped
+            print("Searching top {} gallery images in {}-byte codes".format(ranks, self.pq_codec.num_subspaces))
+            _, index = self.pq_codec.search(self._pq_gallery_codes(gf), qf.numpy(), ranks, feats=gf.numpy(),
+                                            rescore=self.pq_rescore)
+        elif self.ranking_backend == 'two_stage':
+            print("Searching top {} gallery images, re-scoring the {} nearest on {} feature dims".format(
+                ranks, self.stage_one_shortlist, len(self.stage_one_columns)))
+            _, index = two_stage_search(qf, gf, ranks, self.stage_one_columns, shortlist=self.stage_one_shortlist,
+                                        metric='cosine' if self.norm else 'euclidean', dtype=self.search_dtype)
+            index = index.cpu().numpy()
+        elif self.ranking_backend == 'hash':
+            print("Searching top {} gallery images, re-scoring the {} nearest {}-bit codes".format(
+                ranks, self.hash_shortlist, self.hash_codec.num_bits))
+            _, index = self.hash_codec.search(self._hash_gallery_codes(gf), qf.numpy(), ranks,
+                                              feats=gf.numpy(), shortlist=self.hash_shortlist)
         else:
-            distmat = q_g_dist.cpu().numpy()
+            # only the top ranks are kept, the Q x G distance matrix is never built
+            print("Searching top {} gallery images".format(ranks))
+            _, index = search(qf, gf, ranks, metric='cosine' if self.norm else 'euclidean', dtype=self.search_dtype)
+            index = index.cpu().numpy()
 
-        print(distmat.shape, len(q_paths), len(g_paths))
-        q_paths = np.array(q_paths)
+        print(index.shape, len(q_paths), len(g_paths))
         g_paths = np.array(g_paths)
-
-        #generate compare results
-        clusters = {}
-        for i in range(distmat.shape[0]):
-            print(i)
-            temp_vector = np.squeeze(distmat[i,])
-            temp = temp_vector.tolist()
-
-            y = list(map(temp.index, heapq.nsmallest(ranks, temp)))
-
-            if len(y) != len(set(y)):
-                m=[]
-                for j in range(ranks):
-                    m.append(temp.index(min(temp)))
-                    temp[temp.index(min(temp))] = 1000000
-                print(m)
-                clusters[q_paths[i]] = g_paths[np.array(m)].tolist()
-                continue
-
-            clusters[q_paths[i]] = g_paths[np.array(y)].tolist()
-
-        # print("results: ", clusters)
+        clusters = dict(zip(q_paths, g_paths[index].tolist()))
 
         return clusters
 
-    def validation(self, queryloader, galleryloader,
-                   queryFliploader, galleryFliploader,
-                   queryCenterloader, galleryCenterloader,
-                   queryLtloader, galleryLtloader,
-                   queryRtloader, galleryRtloader,
-                   queryLbloader, galleryLbloader,
-                   queryRbloader, galleryRbloader,
-                   re_ranking=False, ranks=[1], k1=20, k2=6, lambda_value=0.3):
-        self.model.eval()
-        if self.concate:
-            self.pcb_model.eval()
-        qf, q_pids = [], []
-        for inputs0, inputs1, inputs2, inputs3, inputs4, inputs5, inputs6\
-                in zip(queryloader, queryFliploader, queryCenterloader,
-                       queryLtloader, queryRtloader, queryLbloader, queryRbloader):
-            inputs, pids, _ = self._parse_data(inputs0)
-            feature0 = self._forward(inputs)
-            if self.eval_flip:
-                imgs1, _, _ = self._parse_data(inputs1)
-                feature1 = self._forward(imgs1)
-
-                if self.crop_validation:
-                    imgs2, _, _ = self._parse_data(inputs2)
-                    feature2 = self._forward(imgs2)
-
-                    imgs3, _, _ = self._parse_data(inputs3)
-                    feature3 = self._forward(imgs3)
-
-                    imgs4, _, _ = self._parse_data(inputs4)
-                    feature4 = self._forward(imgs4)
-
-                    imgs5, _, _ = self._parse_data(inputs5)
-                    feature5 = self._forward(imgs5)
-
-                    imgs6, _, _ = self._parse_data(inputs6)
-                    feature6 = self._forward(imgs6)
-
-                    qf.append((feature0 + feature1 + feature2 + feature3 + feature4 + feature5 + feature6) / 7.0)
-                else:
-                    qf.append((feature0 + feature1) / 2.0)
-            else:
-                qf.append(feature0)
-            q_pids.extend(list(map(int, pids)))
-
-        qf = torch.cat(qf, 0)
-        if True == self.norm:
-            qf = torch.nn.functional.normalize(qf, dim=1, p=2)
-        q_pids = torch.Tensor(q_pids)
-
-        print("Extracted features for query set: {} x {}".format(qf.size(0), qf.size(1)))
-
-        gf, g_pids = [], []
-        for inputs0, inputs1, inputs2, inputs3, inputs4, inputs5, inputs6\
-                in zip(galleryloader, galleryFliploader, galleryCenterloader,
-                       galleryLtloader, galleryRtloader, galleryLbloader, galleryRbloader):
-            inputs, pids, _ = self._parse_data(inputs0)
-            feature0 = self._forward(inputs)
-            if self.eval_flip:
-                imgs1, _, _ = self._parse_data(inputs1)
-                feature1 = self._forward(imgs1)
-
-                if self.crop_validation:
-                    imgs2, _, _ = self._parse_data(inputs2)
-                    feature2 = self._forward(imgs2)
-
-                    imgs3, _, _ = self._parse_data(inputs3)
-                    feature3 = self._forward(imgs3)
-
-                    imgs4, _, _ = self._parse_data(inputs4)
-                    feature4 = self._forward(imgs4)
-
-                    imgs5, _, _ = self._parse_data(inputs5)
-                    feature5 = self._forward(imgs5)
-
-                    imgs6, _, _ = self._parse_data(inputs6)
-                    feature6 = self._forward(imgs6)
-
-                    gf.append((feature0 + feature1 + feature2 + feature3 + feature4 + feature5 + feature6) / 7.0)
-                else:
-                    gf.append((feature0 + feature1) / 2.0)
-            else:
-                gf.append(feature0)
-            g_pids.extend(list(map(int, pids)))
-
-        gf = torch.cat(gf, 0)
-        if True == self.norm:
-            gf = torch.nn.functional.normalize(gf, dim=1, p=2)
-        g_pids = torch.Tensor(g_pids)
-
-        print("Extracted features for gallery set: {} x {}".format(gf.size(0), gf.size(1)))
+    def validation(self, queryloader, galleryloader, re_ranking=False, ranks=[1], k1=20, k2=6, lambda_value=0.3,
+                   features=None):
+        if features is None:
+            features = self.validation_features(queryloader, galleryloader)
+        qf, q_pids, gf, g_pids = features
 
         print("Computing distance matrix")
-        m, n = qf.size(0), gf.size(0)
-        q_g_dist = torch.pow(qf, 2).sum(dim=1, keepdim=True).expand(m, n) + \
-            torch.pow(gf, 2).sum(dim=1, keepdim=True).expand(n, m).t()
-        q_g_dist.addmm_(1, -2, qf, gf.t())
-
         if re_ranking:
-            q_q_dist = torch.pow(qf, 2).sum(dim=1, keepdim=True).expand(m, m) + \
-                       torch.pow(qf, 2).sum(dim=1, keepdim=True).expand(m, m).t()
-            q_q_dist.addmm_(1, -2, qf, qf.t())
-
-            g_g_dist = torch.pow(gf, 2).sum(dim=1, keepdim=True).expand(n, n) + \
-                       torch.pow(gf, 2).sum(dim=1, keepdim=True).expand(n, n).t()
-            g_g_dist.addmm_(1, -2, gf, gf.t())
-
-            q_g_dist = q_g_dist.numpy()
-            q_g_dist[q_g_dist < 0] = 0
-            q_g_dist = np.sqrt(q_g_dist)
-
-            q_q_dist = q_q_dist.numpy()
-            q_q_dist[q_q_dist < 0] = 0
-            q_q_dist = np.sqrt(q_q_dist)
-
-            g_g_dist = g_g_dist.numpy()
-            g_g_dist[g_g_dist < 0] = 0
-            g_g_dist = np.sqrt(g_g_dist)
-
-            distmat = torch.Tensor(re_ranking_func(q_g_dist, q_q_dist, g_g_dist, k1=k1, k2=k2, lambda_value=lambda_value))
+            distmat = self._re_ranking(qf, gf, k1, k2, lambda_value)
         else:
+            m, n = qf.size(0), gf.size(0)
+            q_g_dist = torch.pow(qf, 2).sum(dim=1, keepdim=True).expand(m, n) + \
+                torch.pow(gf, 2).sum(dim=1, keepdim=True).expand(n, m).t()
+            q_g_dist.addmm_(1, -2, qf, gf.t())
             distmat = q_g_dist
 
         print("Computing CMC and mAP")
@@ -304,125 +170,191 @@ class Evaluator:
         print("------------------")
         return (cmc[0] + mAP) / 2
 
-    def extract_features(self, queryloader, galleryloader,
-                 queryFliploader, galleryFliploader,
-                 queryCenterloader, galleryCenterloader,
-                 queryLtloader, galleryLtloader,
-                 queryRtloader, galleryRtloader,
-                 queryLbloader, galleryLbloader,
-                 queryRbloader, galleryRbloader,
-                 ranks=200, k1=20, k2=6, lambda_value=0.3):
-        self.model.eval()
-        if self.concate:
-            self.pcb_model.eval()
-        qf, q_paths = [], []
-        for inputs0, inputs1, inputs2, inputs3, inputs4, inputs5, inputs6\
-                in zip(queryloader, queryFliploader, queryCenterloader,
-                       queryLtloader, queryRtloader, queryLbloader, queryRbloader):
-            inputs, _, paths = self._parse_data(inputs0)
-            feature0 = self._forward(inputs)
-            if self.eval_flip:
-                inputs, _, _ = self._parse_data(inputs1)
-                feature1 = self._forward(inputs)
-                if self.crop_validation:
-                    imgs2, _, _ = self._parse_data(inputs2)
-                    feature2 = self._forward(imgs2)
-
-                    imgs3, _, _ = self._parse_data(inputs3)
-                    feature3 = self._forward(imgs3)
-
-                    imgs4, _, _ = self._parse_data(inputs4)
-                    feature4 = self._forward(imgs4)
-
-                    imgs5, _, _ = self._parse_data(inputs5)
-                    feature5 = self._forward(imgs5)
-
-                    imgs6, _, _ = self._parse_data(inputs6)
-                    feature6 = self._forward(imgs6)
-
-                    qf.append((feature0 + feature1 + feature2 + feature3 + feature4 + feature5 + feature6) / 7.0)
-                else:
-                    qf.append((feature0 + feature1) / 2.0)
-            else:
-                qf.append(feature0)
-            q_paths+=paths
-
-        qf = torch.cat(qf, 0)
-        if True == self.norm:
-            qf = torch.nn.functional.normalize(qf, dim=1, p=2)
+    def rerank_sweep(self, queryloader, galleryloader, k1s=range(1, 21), k2s=(6,), lambda_values=(0.3,),
+                     grid_workers=1, output=None, features=None):
+        """Scores of a (k1, k2, lambda_value) grid on features extracted once; with
+        `output` the best configuration and the full table are written there as JSON."""
+        if features is None:
+            features = self.validation_features(queryloader, galleryloader)
+        qf, q_pids, gf, g_pids = features
+
+        def score_func(distmat):
+            cmc, mAP = self.eval_func_gpu(torch.from_numpy(distmat), q_pids, g_pids)
+            return (cmc[0] + mAP) / 2
+
+        print("Re-ranking parameter sweep")
+        results = re_ranking_sweep(qf.numpy(), gf.numpy(), score_func, k1s=k1s, k2s=k2s,
+                                   lambda_values=lambda_values, workers=self.rerank_workers,
+                                   grid_workers=grid_workers, initializer=_single_thread)
+        for result in results:
+            print("k1: {k1:<3} k2: {k2:<3} lambda: {lambda_value:<4} tencent score: {score}".format(**result))
+        if output is not None:
+            best = max(results, key=lambda result: result['score'])
+            os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+            with open(output, 'w') as f:
+                json.dump({'best': best, 'results': results}, f, indent=2, default=float)
+            print("Re-ranking sweep written to {}".format(output))
+        return results
+
+    def rerank_approximate_report(self, queryloader, galleryloader,
+                                  k1=20, k2=6, lambda_value=0.3, shortlists=(100, 200), num_probes=(4, 8, 16),
+                                  ks=(1, 10, 100), features=None):
+        """Recall and score of approximate re-ranking against exact re-ranking.
+
+        recall@k is the fraction of the exact re-ranked top-k gallery images of a
+        query that are also in its approximate top-k.
+        """
+        if features is None:
+            features = self.validation_features(queryloader, galleryloader)
+        qf, q_pids, gf, g_pids = features
+
+        def score(distmat):
+            cmc, mAP = self.eval_func_gpu(torch.from_numpy(distmat), q_pids, g_pids)
+            return (cmc[0] + mAP) / 2
+
+        start = time.time()
+        exact = re_ranking_from_features(qf.numpy(), gf.numpy(), k1=k1, k2=k2, lambda_value=lambda_value,
+                                         workers=self.rerank_workers)
+        exact_time = time.time() - start
+        exact_top = np.argsort(exact, axis=1)[:, :max(ks)]
+        print("exact re-ranking: {:.2f}s tencent score: {}".format(exact_time, score(exact)))
 
-        print("Extracted features for query set: {} x {}".format(qf.size(0), qf.size(1)))
+        results = []
+        for shortlist in shortlists:
+            for probes in num_probes:
+                start = time.time()
+                final_dist, index = re_ranking_approximate(qf.numpy(), gf.numpy(), k1=k1, k2=k2,
+                                                           lambda_value=lambda_value, shortlist=shortlist,
+                                                           num_probes=probes, workers=self.rerank_workers)
+                result = {'shortlist': shortlist, 'num_probes': probes, 'time': time.time() - start,
+                          'score': score(self._shortlist_distmat(qf, gf, final_dist, index))}
+                for k in ks:
+                    if k <= index.shape[1]:
+                        result['recall@{}'.format(k)] = recall_at_k(index, exact_top, k)
+                recall = " ".join("recall@{}: {:.4f}".format(k, result['recall@{}'.format(k)])
+                                  for k in ks if k <= index.shape[1])
+                print("shortlist: {shortlist:<5} probes: {num_probes:<3} time: {time:.2f}s "
+                      "tencent score: {score} ".format(**result) + recall)
+                results.append(result)
+        return results
+
+    def ann_report(self, queryloader, galleryloader, num_probes=(1, 2, 4, 8, 16, 32), ks=(1, 10, 100),
+                   features=None):
+        """Time, recall and score of the ivf ranking backend against exact search.
+
+        recall@k is the fraction of the exact top-k gallery images of a query that
+        are also in its ivf top-k.
+        """
+        if features is None:
+            features = self.validation_features(queryloader, galleryloader)
+        qf, q_pids, gf, g_pids = features
+
+        start = time.time()
+        _, exact_top = search(qf, gf, max(ks))
+        print("exact search: {:.2f}s".format(time.time() - start))
+        start = time.time()
+        ivf = self._gallery_index(gf)
+        print("ivf index: {} lists, {:.2f}s".format(len(ivf.centroids), time.time() - start))
 
-        gf, g_paths = [], []
-        for inputs0, inputs1, inputs2, inputs3, inputs4, inputs5, inputs6 \
-                in zip(galleryloader, galleryFliploader, galleryCenterloader,
-                       galleryLtloader, galleryRtloader, galleryLbloader, galleryRbloader):
-            inputs, _, paths = self._parse_data(inputs0)
-            feature0 = self._forward(inputs)
-            if self.eval_flip:
-                inputs, _, _ = self._parse_data(inputs1)
-                feature1 = self._forward(inputs)
-                if self.crop_validation:
-                    imgs2, _, _ = self._parse_data(inputs2)
-                    feature2 = self._forward(imgs2)
-
-                    imgs3, _, _ = self._parse_data(inputs3)
-                    feature3 = self._forward(imgs3)
-
-                    imgs4, _, _ = self._parse_data(inputs4)
-                    feature4 = self._forward(imgs4)
-
-                    imgs5, _, _ = self._parse_data(inputs5)
-                    feature5 = self._forward(imgs5)
-
-                    imgs6, _, _ = self._parse_data(inputs6)
-                    feature6 = self._forward(imgs6)
-
-                    gf.append((feature0 + feature1 + feature2 + feature3 + feature4 + feature5 + feature6) / 7.0)
-                else:
-                    gf.append((feature0 + feature1) / 2.0)
-            else:
-                gf.append(feature0)
-            g_paths +=paths
-
-        gf = torch.cat(gf, 0)
-        if True == self.norm:
-            gf = torch.nn.functional.normalize(gf, dim=1, p=2)
+        results = []
+        for probes in num_probes:
+            start = time.time()
+            dist, index = ivf.search(qf.numpy(), max(ks), num_probes=probes)
+            result = {'num_probes': probes, 'time': time.time() - start}
+            cmc, mAP = self.eval_func_gpu(torch.from_numpy(self._shortlist_distmat(qf, gf, dist, index)),
+                                          q_pids, g_pids)
+            result['score'] = (cmc[0] + mAP) / 2
+            for k in ks:
+                result['recall@{}'.format(k)] = recall_at_k(index, exact_top.numpy(), k)
+            recall = " ".join("recall@{}: {:.4f}".format(k, result['recall@{}'.format(k)]) for k in ks)
+            print("probes: {num_probes:<3} time: {time:.2f}s tencent score: {score} ".format(**result) + recall)
+            results.append(result)
+        return results
+
+    def two_stage_report(self, queryloader, galleryloader, shortlists=(100, 200, 500, 1000), ks=(1, 10, 100),
+                         features=None):
+        """Time, rank-1, mAP and recall@k of two-stage search against exact search.
+
+        Gallery images outside a query's shortlist follow it in stage one order.
+        gemm is the cost of the distance products relative to exact search.
+        """
+        if features is None:
+            features = self.validation_features(queryloader, galleryloader)
+        qf, q_pids, gf, g_pids = features
+        metric = 'cosine' if self.norm else 'euclidean'
+        num_columns, dim = len(self.stage_one_columns), qf.size(1)
+
+        start = time.time()
+        _, exact_top = search(qf, gf, max(ks), metric=metric)
+        exact_time = time.time() - start
+        cmc, mAP = self.eval_func_gpu(self._distmat(qf, gf), q_pids, g_pids)
+        print("exact search: {:.2f}s rank-1: {:.1%} mAP: {:.1%}".format(exact_time, cmc[0], mAP))
 
-        print("Extracted features for gallery set: {} x {}".format(gf.size(0), gf.size(1)))
+        results = []
+        for shortlist in shortlists:
+            start = time.time()
+            dist, index = two_stage_search(qf, gf, shortlist, self.stage_one_columns, shortlist=shortlist,
+                                           metric=metric)
+            result = {'shortlist': shortlist, 'time': time.time() - start,
+                      'gemm': (num_columns * gf.size(0) + dim * min(shortlist, gf.size(0))) / (dim * gf.size(0))}
+            cmc, mAP = self.eval_func_gpu(torch.from_numpy(self._shortlist_distmat(
+                qf, gf, dist.numpy(), index.numpy(), columns=self.stage_one_columns)), q_pids, g_pids)
+            result['rank-1'], result['mAP'] = float(cmc[0]), float(mAP)
+            for k in ks:
+                result['recall@{}'.format(k)] = recall_at_k(index.numpy(), exact_top.numpy(), k)
+            recall = " ".join("recall@{}: {:.4f}".format(k, result['recall@{}'.format(k)]) for k in ks)
+            print("shortlist: {shortlist:<5} time: {time:.2f}s gemm: {gemm:.2f} rank-1: {rank-1:.1%} "
+                  "mAP: {mAP:.1%} ".format(**result) + recall)
+            results.append(result)
+        return results
+
+    def hash_report(self, queryloader, galleryloader, shortlists=(100, 200, 500, 1000, 2000), ks=(1, 10, 100),
+                    features=None):
+        """Time, rank-1, mAP and recall@k of the hamming prefilter with exact re-scoring
+        against exact search."""
+        if features is None:
+            features = self.validation_features(queryloader, galleryloader)
+        qf, q_pids, gf, g_pids = features
+
+        start = time.time()
+        _, exact_top = search(qf, gf, max(ks), metric='cosine' if self.norm else 'euclidean')
+        print("exact search: {:.2f}s".format(time.time() - start))
+        start = time.time()
+        codes = self.hash_codec.encode(gf.numpy())
+        print("encoded gallery: {:.2f}s, {} bytes per image".format(time.time() - start, codes.itemsize * codes.shape[1]))
 
-        print("Computing distance matrix")
+        results = []
+        for shortlist in shortlists:
+            start = time.time()
+            dist, index = self.hash_codec.search(codes, qf.numpy(), shortlist, feats=gf.numpy(), shortlist=shortlist)
+            result = {'shortlist': shortlist, 'time': time.time() - start}
+            cmc, mAP = self.eval_func_gpu(torch.from_numpy(self._shortlist_distmat(qf, gf, dist, index)),
+                                          q_pids, g_pids)
+            result['rank-1'], result['mAP'] = float(cmc[0]), float(mAP)
+            for k in ks:
+                result['recall@{}'.format(k)] = recall_at_k(index, exact_top.numpy(), k)
+            recall = " ".join("recall@{}: {:.4f}".format(k, result['recall@{}'.format(k)]) for k in ks)
+            print("shortlist: {shortlist:<5} time: {time:.2f}s rank-1: {rank-1:.1%} mAP: {mAP:.1%} ".format(**result)
+                  + recall)
+            results.append(result)
+        return results
+
+    def extract_features(self, queryloader, galleryloader, ranks=200, k1=20, k2=6, lambda_value=0.3):
+        qf, _, q_paths = self._extract(queryloader)
+        print("Extracted features for query set: {} x {}".format(qf.size(0), qf.size(1)))
 
-        m, n = qf.size(0), gf.size(0)
-        q_g_dist = torch.pow(qf, 2).sum(dim=1, keepdim=True).expand(m, n) + \
-                   torch.pow(gf, 2).sum(dim=1, keepdim=True).expand(n, m).t()
-        q_g_dist.addmm_(1, -2, qf, gf.t())
+        gf, _, g_paths = self._extract(galleryloader)
+        print("Extracted features for gallery set: {} x {}".format(gf.size(0), gf.size(1)))
 
-        # q_g_dist = q_g_dist.cpu().numpy()
+        print("Computing distance matrix")
 
         if self.re_ranking:
-            q_q_dist = torch.pow(qf, 2).sum(dim=1, keepdim=True).expand(m, m) + \
-                       torch.pow(qf, 2).sum(dim=1, keepdim=True).expand(m, m).t()
-            q_q_dist.addmm_(1, -2, qf, qf.t())
-
-            g_g_dist = torch.pow(gf, 2).sum(dim=1, keepdim=True).expand(n, n) + \
-                       torch.pow(gf, 2).sum(dim=1, keepdim=True).expand(n, n).t()
-            g_g_dist.addmm_(1, -2, gf, gf.t())
-
-            q_g_dist = q_g_dist.numpy()
-            q_g_dist[q_g_dist < 0] = 0
-            q_g_dist = np.sqrt(q_g_dist)
-
-            q_q_dist = q_q_dist.numpy()
-            q_q_dist[q_q_dist < 0] = 0
-            q_q_dist = np.sqrt(q_q_dist)
-
-            g_g_dist = g_g_dist.numpy()
-            g_g_dist[g_g_dist < 0] = 0
-            g_g_dist = np.sqrt(g_g_dist)
-
-            distmat = torch.Tensor(re_ranking_func(q_g_dist, q_q_dist, g_g_dist, k1=k1, k2=k2, lambda_value=lambda_value)).cpu().numpy()
+            distmat = self._re_ranking(qf, gf, k1, k2, lambda_value).cpu().numpy()
         else:
+            m, n = qf.size(0), gf.size(0)
+            q_g_dist = torch.pow(qf, 2).sum(dim=1, keepdim=True).expand(m, n) + \
+                       torch.pow(gf, 2).sum(dim=1, keepdim=True).expand(n, m).t()
+            q_g_dist.addmm_(1, -2, qf, gf.t())
             distmat = q_g_dist.cpu().numpy()
 
         print(distmat.shape, len(q_paths), len(g_paths))
@@ -430,11 +362,13 @@ class Evaluator:
         #generate compare results
         clusters = {}
 
-        clusters['query_path'] = q_paths
-        clusters['gallery_path'] = g_paths
+        clusters['query_path'] = q_paths.tolist()
+        clusters['gallery_path'] = g_paths.tolist()
 
         clusters['query_feat'] = qf
         clusters['gallery_feat'] = gf
+        if self.pq_codec is not None:
+            clusters['gallery_codes'] = self._pq_gallery_codes(gf)
 
         clusters['dist_mat'] = distmat
 
@@ -443,9 +377,224 @@ class Evaluator:
         return clusters
 
 
+    def train_pq_codec(self, trainloader, num_subspaces=64, num_centroids=256):
+        """PQCodec trained on the features of trainloader (the training set, with the test transform)."""
+        feats, _, _ = self._extract(trainloader)
+        print("Extracted features for training set: {} x {}".format(feats.size(0), feats.size(1)))
+        start = time.time()
+        codec = PQCodec(num_subspaces, num_centroids).train(feats.numpy())
+        print("Trained {} x {} product quantizer: {:.2f}s".format(num_subspaces, num_centroids, time.time() - start))
+        return codec
+
+    def train_hash_codec(self, trainloader, num_bits=256):
+        """BinaryHash trained on the features of trainloader (the training set, with the test transform)."""
+        feats, _, _ = self._extract(trainloader)
+        print("Extracted features for training set: {} x {}".format(feats.size(0), feats.size(1)))
+        start = time.time()
+        codec = BinaryHash(num_bits).train(feats.numpy())
+        print("Trained {}-bit hash codec: {:.2f}s".format(num_bits, time.time() - start))
+        return codec
+
+    def fit_projection(self, trainloader):
+        """PCA of the features of trainloader (the training set, with the test transform),
+        accumulated batch by batch without keeping the features."""
+        self.model.eval()
+        if self.concate:
+            self.pcb_model.eval()
+        pca = PCA()
+        start = time.time()
+        for feats, _, _ in stream(trainloader, self._parse_data, self._view_features, prefetch=self.prefetch,
+                                  norm=self.norm):
+            pca.partial_fit(feats)
+        print("Extracted features for training set: {}".format(pca.count))
+        pca.fit()
+        print("Fitted PCA: {:.2f}s".format(time.time() - start))
+        return pca
+
+    def projection_report(self, queryloader, galleryloader, dims=(128, 256, 512, 1024, 2048), features=None):
+        """Rank-1, mAP and distance time of the projected features per output dim, with
+        and without whitening. `features` are unprojected (validation_features(project=False))."""
+        if features is None:
+            features = self.validation_features(queryloader, galleryloader, project=False)
+        qf, q_pids, gf, g_pids = features
+        results = []
+        for dim in [dim for dim in dims if dim < qf.size(1)] + [qf.size(1)]:
+            for whiten in (False, True):
+                q_proj, g_proj = self.project(qf, dim, whiten), self.project(gf, dim, whiten)
+                start = time.time()
+                distmat = self._distmat(q_proj, g_proj)
+                result = {'dim': dim, 'whiten': whiten, 'time': time.time() - start,
+                          'variance': self.projection.explained_variance(dim)}
+                cmc, mAP = self.eval_func_gpu(distmat, q_pids, g_pids)
+                result['rank-1'], result['mAP'] = float(cmc[0]), float(mAP)
+                result['score'] = (result['rank-1'] + result['mAP']) / 2
+                print("dim: {dim:<5} whiten: {whiten!s:<5} variance: {variance:.3f} distance time: {time:.2f}s "
+                      "rank-1: {rank-1:.1%} mAP: {mAP:.1%} tencent score: {score}".format(**result))
+                results.append(result)
+        return results
+
+    def project(self, feats, dim=None, whiten=None):
+        """feats projected with self.projection, to projection_dim dims by default."""
+        feats = self.projection.transform(feats, dim or self.projection_dim,
+                                          self.projection_whiten if whiten is None else whiten)
+        if self.norm:
+            feats = torch.nn.functional.normalize(feats, dim=1, p=2)
+        return feats
+
+    def project_features(self, features):
+        """validation_features(project=False) -> validation_features()"""
+        qf, q_pids, gf, g_pids = features
+        if self.projection is None:
+            return features
+        return self.project(qf), q_pids, self.project(gf), g_pids
+
+    def validation_features(self, queryloader, galleryloader, project=True):
+        """(qf, q_pids, gf, g_pids), can be passed as `features` to the validation methods
+        to evaluate several of them on one extraction."""
+        qf, q_pids, _ = self._extract(queryloader, project)
+        q_pids = torch.from_numpy(q_pids)
+        print("Extracted features for query set: {} x {}".format(qf.size(0), qf.size(1)))
+
+        gf, g_pids, _ = self._extract(galleryloader, project)
+        g_pids = torch.from_numpy(g_pids)
+        print("Extracted features for gallery set: {} x {}".format(gf.size(0), gf.size(1)))
+        return qf, q_pids, gf, g_pids
+
+    def _extract(self, loader, project=True):
+        # the cache holds unprojected features
+        feats, pids, paths = self._extract_cached(loader)
+        if project and self.projection is not None:
+            feats = self.project(feats)
+        return feats, pids, paths
+
+    def _extract_cached(self, loader):
+        if self.feature_cache is None:
+            return self._extract_from_model(loader)
+        key = self.feature_cache.key(loader.dataset.dataset, loader.dataset.transform, eval_flip=self.eval_flip,
+                                     crop_validation=self.crop_validation, norm=self.norm, concate=self.concate)
+        cached = self.feature_cache.load(key)
+        if cached is not None:
+            print("Loaded cached features {}".format(key))
+            return cached
+        feats, pids, paths = self._extract_from_model(loader)
+        self.feature_cache.save(key, feats, pids, paths)
+        return feats, pids, paths
+
+    def _extract_from_model(self, loader):
+        # each batch holds every test-time view of its images (see build_tta_transforms),
+        # the features of the views are averaged
+        self.model.eval()
+        if self.concate:
+            self.pcb_model.eval()
+        return extract(loader, self._parse_data, self._view_features, prefetch=self.prefetch,
+                       memmap_dir=self.memmap_dir, norm=self.norm)
+
+    def _re_ranking(self, qf, gf, k1, k2, lambda_value):
+        # re-ranked distance as a tensor; the torch backend never leaves torch and runs on self.device
+        if self.rerank_approximate:
+            final_dist, index = self._approximate_re_ranking(qf, gf, k1, k2, lambda_value)
+            return torch.from_numpy(self._shortlist_distmat(qf, gf, final_dist, index))
+        if self.rerank_backend == 'torch':
+            return re_ranking_torch(qf.to(self.device), gf.to(self.device), k1=k1, k2=k2, lambda_value=lambda_value,
+                                    backend=self.rerank_torch_backend)
+        return torch.from_numpy(re_ranking_from_features(qf.numpy(), gf.numpy(), k1=k1, k2=k2,
+                                                         lambda_value=lambda_value, workers=self.rerank_workers))
+
+    def _approximate_re_ranking(self, qf, gf, k1, k2, lambda_value):
+        return re_ranking_approximate(qf.numpy(), gf.numpy(), k1=k1, k2=k2, lambda_value=lambda_value,
+                                      shortlist=self.rerank_shortlist, num_probes=self.ann_probes,
+                                      workers=self.rerank_workers)
+
+    def _gallery_index(self, gf):
+        # the saved index is reused as long as it holds exactly these gallery features
+        feats = gf.numpy()
+        if self.ann_index and os.path.exists(self.ann_index):
+            ivf = IVFIndex.load(self.ann_index)
+            if np.array_equal(ivf.feats, feats):
+                ivf.num_probes = self.ann_probes
+                return ivf
+            print("{} was built on other gallery features, rebuilding it".format(self.ann_index))
+        ivf = IVFIndex(num_lists=self.ann_lists, num_probes=self.ann_probes).build(feats)
+        if self.ann_index:
+            ivf.save(self.ann_index)
+        return ivf
+
+    def _gallery_codes(self, codec, codec_arrays, gf, path):
+        # the saved codes are reused as long as this codec (its arrays) encoded them from exactly
+        # these gallery features
+        feats = gf.numpy()
+        digest = _digest(feats, *codec_arrays)
+        if path and os.path.exists(path):
+            with np.load(path) as data:
+                if str(data['digest']) == digest:
+                    return data['codes']
+            print("{} was encoded from other gallery features or by another codec, re-encoding".format(path))
+        codes = codec.encode(feats)
+        if path:
+            with open(path, 'wb') as f:
+                np.savez(f, codes=codes, digest=digest)
+        return codes
+
+    def _pq_gallery_codes(self, gf):
+        return self._gallery_codes(self.pq_codec, [self.pq_codec.centroids], gf, self.pq_codes)
+
+    def _hash_gallery_codes(self, gf):
+        return self._gallery_codes(self.hash_codec, [self.hash_codec.mean, self.hash_codec.projection], gf,
+                                   self.hash_codes)
+
+    @staticmethod
+    def _distmat(qf, gf):
+        m, n = qf.size(0), gf.size(0)
+        q_g_dist = torch.pow(qf, 2).sum(dim=1, keepdim=True).expand(m, n) + \
+            torch.pow(gf, 2).sum(dim=1, keepdim=True).expand(n, m).t()
+        q_g_dist.addmm_(1, -2, qf, gf.t())
+        return q_g_dist
+
+    def _shortlist_distmat(self, qf, gf, final_dist, index, columns=None):
+        # gallery images outside a query's shortlist follow it in plain distance order,
+        # over `columns` of the features if given
+        if columns is not None:
+            qf, gf = qf[:, columns], gf[:, columns]
+        q_g_dist = self._distmat(qf, gf)
+        q_g_dist /= q_g_dist.max(dim=1, keepdim=True)[0]
+        distmat = q_g_dist.numpy() + 1 + final_dist.max()
+        np.put_along_axis(distmat, index, final_dist, axis=1)
+        return distmat
+
     def _parse_data(self, inputs):
-        imgs, pids, image_path = inputs
-        return imgs.cuda(), pids, image_path
+        views, pids, image_path = inputs
+        if torch.is_tensor(views):
+            views = [views]
+        num_views = 1
+        if self.eval_flip:
+            num_views = 7 if self.crop_validation else 2
+        return [view.to(self.device, non_blocking=True) for view in views[:num_views]], pids, image_path
+
+    def _view_features(self, views):
+        # averaged on the device, one copy to the host per batch
+        if not self.stack_views:
+            return (sum(self._forward(view) for view in views) / float(len(views))).cpu()
+        # views of the same size go through the model together, in chunks of at most
+        # max_eval_batch images; a chunk may start or end inside a view
+        batch_size = views[0].size(0)
+        groups = OrderedDict()
+        for view in views:
+            groups.setdefault(view.shape[1:], []).append(view)
+        feature = 0
+        for group in groups.values():
+            inputs = torch.cat(group, 0)
+            for start in range(0, inputs.size(0), self.max_eval_batch):
+                outputs = self._forward(inputs[start:start + self.max_eval_batch])
+                if not torch.is_tensor(feature):
+                    feature = outputs.new_zeros(batch_size, outputs.size(1))
+                # add the part of every view in the chunk to the rows of its images
+                pos, stop = start, start + outputs.size(0)
+                while pos < stop:
+                    end = min(stop, (pos // batch_size + 1) * batch_size)
+                    row = pos % batch_size
+                    feature[row:row + end - pos] += outputs[pos - start:end - start]
+                    pos = end
+        return (feature / float(len(views))).cpu()
 
     def _forward(self, inputs):
         if self.concate:
@@ -457,25 +606,28 @@ class Evaluator:
         else:
             with torch.no_grad():
                 feature = self.model(inputs)
-        return feature.cpu()
+        return feature
 
-    def eval_func_gpu(self, distmat, q_pids, g_pids, max_rank=200):
+    def eval_func_gpu(self, distmat, q_pids, g_pids, max_rank=200, chunk_size=1024):
         num_q, num_g = distmat.size()
         if num_g < max_rank:
             max_rank = num_g
             print("Note: number of gallery samples is quite small, got {}".format(num_g))
-        _, indices = torch.sort(distmat, dim=1)
-        matches = (g_pids[indices] == q_pids.view([num_q, -1]))
-
-        results = []
-        num_rel = []
-        for i in range(num_q):
-            m = matches[i][:]
-            if m.any():
-                num_rel.append(m.sum())
-                results.append(m[:max_rank].unsqueeze(0))
-        matches = torch.cat(results, dim=0).float()
-        num_rel = torch.Tensor(num_rel)
+        q_pids, g_pids = q_pids.to(distmat.device), g_pids.to(distmat.device)
+
+        # positives of every query from the gallery pid counts
+        pids, counts = torch.unique(g_pids, return_counts=True)
+        pos = torch.searchsorted(pids, q_pids).clamp(max=pids.size(0) - 1)
+        num_rel = torch.where(pids[pos] == q_pids, counts[pos], torch.zeros_like(counts[pos]))
+
+        # matches among the max_rank nearest gallery images, a chunk of queries at a time
+        matches = []
+        for start in range(0, num_q, chunk_size):
+            _, indices = nearest(distmat[start:start + chunk_size], max_rank)
+            matches.append(g_pids[indices] == q_pids[start:start + chunk_size].view(-1, 1))
+        valid = num_rel > 0
+        matches = torch.cat(matches, dim=0)[valid].float().cpu()
+        num_rel = num_rel[valid].float().cpu()
 
         cmc = matches.cumsum(dim=1)
         cmc[cmc > 1] = 1
@@ -485,4 +637,4 @@ class Evaluator:
         temp_cmc = matches.cumsum(dim=1) / pos * matches
         AP = temp_cmc.sum(dim=1) / num_rel
         mAP = AP.sum() / AP.size(0)
-        return all_cmc.numpy(), mAP.item()
\ No newline at end of file
+        return all_cmc.numpy(), mAP.item()
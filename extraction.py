@@ -0,0 +1,94 @@
+# encoding: utf-8
+"""
+Feature extraction over a DataLoader.
+
+A background thread pulls batches from the loader and moves them to the compute
+device, keeping up to `prefetch` batches ready, so image decoding and the host
+to device copy overlap with the forward passes. Features go straight into one
+preallocated [N, D] buffer, in memory or memory-mapped in `memmap_dir`.
+"""
+import queue
+import tempfile
+import threading
+
+import numpy as np
+import torch
+
+_END = object()
+
+
+def _prefetch(loader, parse, depth):
+    """Yields parse(inputs) for every batch of loader, produced by a background thread."""
+    batches = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for inputs in loader:
+                if stop.is_set():
+                    return
+                batches.put(parse(inputs))
+            batches.put(_END)
+        except Exception as e:
+            batches.put(e)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = batches.get()
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # unblock the producer if the consumer stopped early
+        stop.set()
+        while thread.is_alive():
+            try:
+                batches.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def _buffer(num_rows, dim, memmap_dir=None):
+    if not memmap_dir:
+        return torch.empty((num_rows, dim))
+    # the mapping outlives the (already deleted) file
+    with tempfile.TemporaryFile(dir=memmap_dir) as f:
+        return torch.from_numpy(np.memmap(f, dtype=np.float32, mode='w+', shape=(num_rows, dim)))
+
+
+def stream(loader, parse, forward, prefetch=2, norm=False):
+    """Yields (feats [B, D], pids, paths) batch by batch, for consumers that do
+    not need all features at once (see extract)."""
+    for inputs, batch_pids, batch_paths in _prefetch(loader, parse, prefetch):
+        batch = forward(inputs)
+        if norm:
+            batch = torch.nn.functional.normalize(batch, dim=1, p=2)
+        yield batch, batch_pids, batch_paths
+
+
+def extract(loader, parse, forward, prefetch=2, memmap_dir=None, norm=False):
+    """(feats [N, D], pids [N], paths [N]) of every image of loader.
+
+    parse(inputs) -> (inputs on the compute device, pids, paths), run in the prefetch thread.
+    forward(inputs) -> [B, D] features on the host.
+    """
+    num_images = len(loader.dataset)
+    feats = None
+    pids = np.empty(num_images, dtype=np.int64)
+    paths = np.empty(num_images, dtype=object)
+    start = 0
+    for batch, batch_pids, batch_paths in stream(loader, parse, forward, prefetch, norm):
+        if feats is None:
+            feats = _buffer(num_images, batch.size(1), memmap_dir)
+        end = start + batch.size(0)
+        feats[start:end] = batch
+        pids[start:end] = np.asarray(batch_pids, dtype=np.int64)
+        paths[start:end] = list(batch_paths)
+        start = end
+    if feats is None:
+        feats = torch.empty((0, 0))
+    return feats[:start], pids[:start], paths[:start]
@@ -0,0 +1,77 @@
+# encoding: utf-8
+"""
+On-disk cache of extracted features.
+
+An entry is a directory named by the hash of everything the features depend
+on: the checkpoint contents, the image list, the test transform (image size,
+normalization, TTA views) and the evaluator settings. It holds
+
+    feats.npy   float32 [N, D], opened memory-mapped
+    meta.json   pids and image paths
+"""
+import hashlib
+import json
+import os
+import os.path as osp
+import shutil
+import tempfile
+
+import numpy as np
+import torch
+
+# DefaultConfig options that change the features a checkpoint produces
+MODEL_OPTIONS = ('model_name', 'last_stride', 'bnneck', 'num_parts', 'attention', 'feat', 'sep_bn', 'neck_feat')
+
+
+def _file_sha1(path, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class FeatureCache(object):
+    """Features keyed by checkpoint, image list and TTA config.
+
+    checkpoints: checkpoint files of every model that contributes to a feature.
+    settings: anything else that changes the model output (model_name, feat, ...).
+    """
+
+    def __init__(self, root, checkpoints, settings=None):
+        self.root = root
+        self.checkpoint_hashes = [_file_sha1(path) for path in checkpoints]
+        self.settings = settings or {}
+
+    def key(self, dataset, transform, **settings):
+        sha1 = hashlib.sha1()
+        sha1.update(json.dumps(self.checkpoint_hashes).encode())
+        sha1.update(json.dumps(sorted(self.settings.items()), default=str).encode())
+        sha1.update(json.dumps(sorted(settings.items()), default=str).encode())
+        sha1.update(repr(transform).encode())
+        for img_path, pid in dataset:
+            sha1.update('{} {}\n'.format(img_path, pid).encode())
+        return sha1.hexdigest()
+
+    def load(self, key):
+        """(feats, pids, paths) of key or None; feats is a copy-on-write memmap."""
+        entry = osp.join(self.root, key)
+        if not osp.exists(osp.join(entry, 'meta.json')):
+            return None
+        with open(osp.join(entry, 'meta.json')) as f:
+            meta = json.load(f)
+        feats = torch.from_numpy(np.load(osp.join(entry, 'feats.npy'), mmap_mode='c'))
+        return feats, np.array(meta['pids'], dtype=np.int64), np.array(meta['paths'], dtype=object)
+
+    def save(self, key, feats, pids, paths):
+        os.makedirs(self.root, exist_ok=True)
+        # written next to the entry and renamed, so readers never see a partial one
+        tmp_dir = tempfile.mkdtemp(prefix='.' + key, dir=self.root)
+        np.save(osp.join(tmp_dir, 'feats.npy'), feats.numpy().astype(np.float32))
+        with open(osp.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump({'pids': pids.tolist(), 'paths': paths.tolist()}, f)
+        try:
+            os.rename(tmp_dir, osp.join(self.root, key))
+        except OSError:
+            # another run stored the same entry first
+            shutil.rmtree(tmp_dir)
@@ -11,7 +11,7 @@ from .center_loss import CenterLoss
 from .rank_loss import RankedLoss
 
 
-def make_loss(opt):
+def make_loss(opt, device='cuda'):
     num_classes = opt.NUM_CLASS
     sampler = opt.sampler
     if opt.loss_type == 'triplet':
@@ -23,7 +23,7 @@ def make_loss(opt):
               'but got {}'.format(opt.loss_type))
 
     if opt.label_smooth == 'on':
-        xent = CrossEntropyLabelSmooth(num_classes=num_classes)
+        xent = CrossEntropyLabelSmooth(num_classes=num_classes, device=device)
         print("label smooth on, numclasses:", num_classes)
 
     if sampler == 'softmax':
@@ -48,7 +48,7 @@ def make_loss(opt):
     return loss_func
 
 
-def make_loss_with_center(opt):    # modified by gu
+def make_loss_with_center(opt, device='cuda'):    # modified by gu
     num_classes = opt.NUM_CLASS
     if opt.model_name == 'resnet18' or opt.model_name == 'resnet34':
         feat_dim = 512
@@ -56,18 +56,18 @@ def make_loss_with_center(opt):    # modified by gu
         feat_dim = 2048
 
     if opt.loss_type == 'center':
-        center_criterion = CenterLoss(num_classes=num_classes, feat_dim=feat_dim, use_gpu=True)  # center loss
+        center_criterion = CenterLoss(num_classes=num_classes, feat_dim=feat_dim, device=device)  # center loss
 
     elif opt.loss_type == 'triplet_center':
         triplet = TripletLoss(opt.margin)  # triplet loss
-        center_criterion = CenterLoss(num_classes=num_classes, feat_dim=feat_dim, use_gpu=True)  # center loss
+        center_criterion = CenterLoss(num_classes=num_classes, feat_dim=feat_dim, device=device)  # center loss
 
     else:
         print('expected loss_type with center should be center, triplet_center'
               'but got {}'.format(opt.loss_type))
 
     if opt.label_smooth == 'on':
-        xent = CrossEntropyLabelSmooth(num_classes=num_classes)     # new add by luo
+        xent = CrossEntropyLabelSmooth(num_classes=num_classes, device=device)     # new add by luo
         print("label smooth on, numclasses:", num_classes)
 
     def loss_func(score, feat, target):
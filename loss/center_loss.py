@@ -13,18 +13,16 @@ class CenterLoss(nn.Module):
     Args:
         num_classes (int): number of classes.
         feat_dim (int): feature dimension.
+        device (str or torch.device): device of the centers.
     """
 
-    def __init__(self, num_classes=751, feat_dim=2048, use_gpu=True):
+    def __init__(self, num_classes=751, feat_dim=2048, device='cuda'):
         super(CenterLoss, self).__init__()
         self.num_classes = num_classes
         self.feat_dim = feat_dim
-        self.use_gpu = use_gpu
+        self.device = torch.device(device)
 
-        if self.use_gpu:
-            self.centers = nn.Parameter(torch.randn(self.num_classes, self.feat_dim).cuda())
-        else:
-            self.centers = nn.Parameter(torch.randn(self.num_classes, self.feat_dim))
+        self.centers = nn.Parameter(torch.randn(self.num_classes, self.feat_dim, device=self.device))
 
     def forward(self, x, labels):
         """
@@ -39,8 +37,7 @@ class CenterLoss(nn.Module):
                   torch.pow(self.centers, 2).sum(dim=1, keepdim=True).expand(self.num_classes, batch_size).t()
         distmat.addmm_(1, -2, x, self.centers.t())
 
-        classes = torch.arange(self.num_classes).long()
-        if self.use_gpu: classes = classes.cuda()
+        classes = torch.arange(self.num_classes, device=self.device).long()
         labels = labels.unsqueeze(1).expand(batch_size, self.num_classes)
         mask = labels.eq(classes.expand(batch_size, self.num_classes))
 
@@ -57,13 +54,10 @@ class CenterLoss(nn.Module):
 
 
 if __name__ == '__main__':
-    use_gpu = False
-    center_loss = CenterLoss(use_gpu=use_gpu)
-    features = torch.rand(16, 2048)
-    targets = torch.Tensor([0, 1, 2, 3, 2, 3, 1, 4, 5, 3, 2, 1, 0, 0, 5, 4]).long()
-    if use_gpu:
-        features = torch.rand(16, 2048).cuda()
-        targets = torch.Tensor([0, 1, 2, 3, 2, 3, 1, 4, 5, 3, 2, 1, 0, 0, 5, 4]).cuda()
+    device = 'cpu'
+    center_loss = CenterLoss(device=device)
+    features = torch.rand(16, 2048).to(device)
+    targets = torch.Tensor([0, 1, 2, 3, 2, 3, 1, 4, 5, 3, 2, 1, 0, 0, 5, 4]).long().to(device)
 
     loss = center_loss(features, targets)
     print(loss)
@@ -125,12 +125,13 @@ class CrossEntropyLabelSmooth(nn.Module):
     Args:
         num_classes (int): number of classes.
         epsilon (float): weight.
+        device (str or torch.device): device of the smoothed targets.
     """
-    def __init__(self, num_classes, epsilon=0.1, use_gpu=True):
+    def __init__(self, num_classes, epsilon=0.1, device='cuda'):
         super(CrossEntropyLabelSmooth, self).__init__()
         self.num_classes = num_classes
         self.epsilon = epsilon
-        self.use_gpu = use_gpu
+        self.device = torch.device(device)
         self.logsoftmax = nn.LogSoftmax(dim=1)
 
     def forward(self, inputs, targets):
@@ -140,8 +141,7 @@ class CrossEntropyLabelSmooth(nn.Module):
             targets: ground truth labels with shape (num_classes)
         """
         log_probs = self.logsoftmax(inputs)
-        targets = torch.zeros(log_probs.size()).scatter_(1, targets.unsqueeze(1).data.cpu(), 1)
-        if self.use_gpu: targets = targets.cuda()
+        targets = torch.zeros(log_probs.size(), device=self.device).scatter_(1, targets.unsqueeze(1).to(self.device), 1)
         targets = (1 - self.epsilon) * targets + self.epsilon / self.num_classes
         loss = (- targets * log_probs).mean(0).sum()
         return loss
\ No newline at end of file
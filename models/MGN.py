@@ -4,6 +4,7 @@
 @contact: zhoumi281571814@126.com
 """
 import copy
+from collections import OrderedDict
 
 import torch
 from torch import nn
@@ -36,6 +37,7 @@ class MGN(nn.Module):
         self.neck_feat = neck_feat
         self.attention = attention
         self.sep_bn = sep_bn
+        self.feats = feats
 
         resnet = ResNet(last_stride=last_stride, block=Bottleneck, layers=[3, 4, 6, 3])
 
@@ -260,6 +262,11 @@ class MGN(nn.Module):
 
             return predict
 
+    def feature_slices(self):
+        """Name -> slice of every branch in the inference feature, in torch.cat order."""
+        names = ['fg_p1', 'fg_p2', 'fg_p3', 'f0_p2', 'f1_p2', 'f0_p3', 'f1_p3', 'f2_p3']
+        return OrderedDict((name, slice(i * self.feats, (i + 1) * self.feats)) for i, name in enumerate(names))
+
     def load_param(self, trained_path):
         param_dict = torch.load(trained_path)
         for i in param_dict:
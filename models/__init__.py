@@ -28,3 +28,14 @@ def build_model(opt):
         model = Baseline(opt.NUM_CLASS, opt.last_stride, opt.pretrained_model,
                          opt.bnneck, opt.neck_feat, opt.model_name, opt.pretrained_choice)
     return model
+
+
+def feature_columns(model, names):
+    """Column indices of the named slices (see MGN.feature_slices) of the inference feature of model."""
+    if not hasattr(model, 'feature_slices'):
+        raise ValueError('{} does not declare its feature slices'.format(type(model).__name__))
+    slices = model.feature_slices()
+    unknown = [name for name in names if name not in slices]
+    if unknown:
+        raise ValueError('unknown feature slices {}, {} has {}'.format(unknown, type(model).__name__, list(slices)))
+    return [column for name in names for column in range(slices[name].start, slices[name].stop)]
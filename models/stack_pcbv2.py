@@ -8,6 +8,7 @@ import torch
 import torch.nn as nn
 import copy
 import gc
+from collections import OrderedDict
 
 from .backbones.resnet_ibn_a import ResNet_IBN as ResNet
 from .backbones.resnet_ibn_a import Bottleneck_IBN as Bottleneck
@@ -56,6 +57,7 @@ class StackPCBv2(nn.ModuleList):
 
         self.neck = neck
         self.neck_feat = neck_feat
+        self.local_dim = local_dim
 
         self.backbone = nn.Sequential(
             resnet.conv1,
@@ -350,6 +352,18 @@ class StackPCBv2(nn.ModuleList):
 
         return y, [p1_global_feature, p2_global_feature, p3_global_feature, p4_global_feature, p5_global_feature]
 
+    def feature_slices(self):
+        """Name -> slice of every part in the inference feature: the five 2048-dim
+        global features, then the local ones of every branch."""
+        dims = [('p{}_global'.format(p), 2048) for p in range(1, 6)]
+        for p, num_parts in enumerate([6, 5, 4, 3, 2], 1):
+            dims += [('p{}_f{}'.format(p, f), self.local_dim) for f in range(1, num_parts + 1)]
+        slices, start = OrderedDict(), 0
+        for name, dim in dims:
+            slices[name] = slice(start, start + dim)
+            start += dim
+        return slices
+
     def load_param(self, trained_path):
         param_dict = torch.load(trained_path)
         for i in param_dict:
@@ -16,19 +16,931 @@ q_g_dist: query-gallery distance matrix, numpy array, shape [num_query, num_gall
 q_q_dist: query-query distance matrix, numpy array, shape [num_query, num_query]
 g_g_dist: gallery-gallery distance matrix, numpy array, shape [num_gallery, num_gallery]
 k1, k2, lambda_value: parameters, the original paper is (k1=20, k2=6, lambda_value=0.3)
+block_size: number of probes whose k-reciprocal sets are built together
+backend: 'dense' or 'sparse'
+workers: number of processes (fork start method, i.e. Linux / macOS)
 Returns:
   final_dist: re-ranked distance, numpy array, shape [num_query, num_gallery]
+
+`re_ranking` builds the k-reciprocal sets of a whole block of probes with array
+ops; `re_ranking_loop` is the original per-probe implementation, kept as the
+reference for correctness and speed comparison (run this file directly).
+backend='sparse' keeps V and its query expansion in compressed sparse row form
+and computes the Jaccard term from the inverted (column) index, so apart from
+the distance table the memory is O(N*k1) instead of O(N^2). Both backends only
+keep the top max(k1+1, k2) neighbors of every row as the initial ranking.
+`re_ranking_from_features` builds the squared distances directly from features.
+`re_ranking_out_of_core` runs the sparse backend over memory-mapped row blocks
+of the distance matrix so that the working set stays within a memory budget.
+`re_ranking_sweep` scores a (k1, k2, lambda_value) grid reusing everything that
+does not depend on the parameter being varied.
+`re_ranking_approximate` takes the neighbor lists from an approximate nearest
+neighbor index and only scores a shortlist of gallery images per query.
+workers > 1 splits every phase over blocks of probes handled by a pool of forked
+processes; the distance, rank and V arrays are inherited by the workers and
+their outputs are written to shared memory, nothing large is pickled.
 """
 from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import division
 
-__all__ = ['re_ranking']
+__all__ = ['re_ranking', 're_ranking_from_features', 're_ranking_out_of_core', 're_ranking_sweep',
+           're_ranking_approximate', 'RerankIndex', 're_ranking_loop', 'record_timings']
+
+import contextlib
+import mmap
+import multiprocessing
+import os
+import os.path as osp
+import shutil
+import tempfile
+import time
 
 import numpy as np
 
 
-def re_ranking(q_g_dist, q_q_dist, g_g_dist, k1=20, k2=6, lambda_value=0.3):
+# Arrays read by the block functions below. They are set before a pool of forked
+# workers is started, so the workers inherit them instead of receiving pickled
+# copies. Dense outputs go to shared mmaps (anonymous ones, or the out-of-core
+# files); the sparse V blocks, whose sizes are only known once built, are
+# returned through the pool and so pickled back, O(N * k1 * k2) entries in all.
+_shared = {}
+
+# phase -> seconds, collected while `record_timings` is active
+_timings = None
+_timer_stack = []
+
+
+@contextlib.contextmanager
+def _timed(phase):
+    """Adds the wall time of the block, minus the phases nested in it, to _timings[phase]."""
+    if _timings is None:
+        yield
+        return
+    _timer_stack.append(0.)
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        _timings[phase] = _timings.get(phase, 0.) + elapsed - _timer_stack.pop()
+        if _timer_stack:
+            _timer_stack[-1] += elapsed
+
+
+@contextlib.contextmanager
+def record_timings():
+    """Wall time of every re-ranking phase run inside the block, in a dict filled in place
+    (distance, initial_rank, k_reciprocal_expansion, query_expansion, jaccard, ...).
+
+    Work done in forked workers counts towards the phase that started the pool.
+    """
+    global _timings
+    _timings = timings = {}
+    del _timer_stack[:]
+    try:
+        yield timings
+    finally:
+        _timings = None
+
+
+def _shared_zeros(shape, dtype, workers):
+    """np.zeros, backed by an anonymous shared mmap when forked workers write to it."""
+    if workers <= 1:
+        return np.zeros(shape, dtype=dtype)
+    dtype = np.dtype(dtype)
+    count = int(np.prod(shape))
+    buf = mmap.mmap(-1, max(count * dtype.itemsize, 1))
+    return np.frombuffer(buf, dtype=dtype, count=count).reshape(shape)
+
+
+def _map_blocks(func, num, block_size, workers):
+    """func((start, end)) for row blocks of [0, num), over `workers` forked processes.
+
+    Returns the list of results, which are pickled back from the workers.
+    """
+    if workers > 1:
+        block_size = max(1, min(block_size, -(-num // workers)))
+    tasks = [(start, min(start + block_size, num)) for start in range(0, num, block_size)]
+    if workers > 1 and len(tasks) > 1:
+        with multiprocessing.get_context('fork').Pool(min(workers, len(tasks))) as pool:
+            return pool.map(func, tasks, chunksize=1)
+    return [func(task) for task in tasks]
+
+
+@_timed('initial_rank')
+def _initial_rank(original_dist, k, block_size):
+    """Indices of the k nearest neighbors of every row, nearest first.
+
+    Only the first max(k1 + 1, k2) columns of the ranking are ever read, so each
+    block of rows is partially selected with argpartition and only those columns
+    are sorted, instead of argsorting the whole matrix.
+    """
+    all_num = original_dist.shape[0]
+    k = min(k, original_dist.shape[1])
+    initial_rank = np.zeros((all_num, k), dtype=np.int32)
+    for start in range(0, all_num, block_size):
+        dist = original_dist[start:start + block_size]
+        if k < dist.shape[1]:
+            index = np.argpartition(dist, k - 1, axis=1)[:, :k]
+        else:
+            index = np.tile(np.arange(dist.shape[1]), (dist.shape[0], 1))
+        order = np.argsort(np.take_along_axis(dist, index, axis=1), axis=1, kind='stable')
+        initial_rank[start:start + block_size] = np.take_along_axis(index, order, axis=1)
+    return initial_rank
+
+
+def _k_reciprocal_neighbors(initial_rank, probes, k):
+    """Forward k-NN of each probe and a mask of the ones that are reciprocal."""
+    forward = initial_rank[probes, :k + 1]
+    backward = initial_rank[forward, :k + 1]
+    mask = (backward == probes[:, None, None]).any(axis=2)
+    return forward, mask
+
+
+def _k_reciprocal_sets(forward, mask, candidate_index, candidate_mask):
+    """Rows / columns of the expanded k-reciprocal sets of a block of probes.
+
+    forward, mask: forward k-NN of each probe and which of them are reciprocal
+    candidate_index, candidate_mask: k/2-reciprocal sets of each forward neighbor
+    """
+    # how many members of each candidate's set are in the probe's set
+    k_reciprocal_index = np.where(mask, forward, -1)
+    overlap = (candidate_index[:, :, :, None] == k_reciprocal_index[:, None, None, :]).any(axis=3)
+    overlap = (overlap & candidate_mask).sum(axis=2)
+    accept = mask & (overlap > 2. / 3 * candidate_mask.sum(axis=2))
+
+    expansion = np.concatenate(
+        [k_reciprocal_index,
+         np.where(accept[:, :, None] & candidate_mask, candidate_index, -1).reshape(len(forward), -1)],
+        axis=1)
+    expansion.sort(axis=1)
+    valid = expansion >= 0
+    valid[:, 1:] &= expansion[:, 1:] != expansion[:, :-1]
+
+    rows, cols = np.nonzero(valid)
+    return rows, expansion[rows, cols]
+
+
+def _expansion_weights(dist, rows, num_rows):
+    weight = np.exp(-dist.astype(np.float32))
+    weight_sum = np.bincount(rows, weights=weight, minlength=num_rows).astype(np.float32)
+    return weight / weight_sum[rows]
+
+
+def _k_reciprocal_expansion(original_dist, initial_rank, probes, k1, half_forward, half_mask):
+    """Non-zero entries (rows, cols, weights) of V for a block of probes."""
+    forward, mask = _k_reciprocal_neighbors(initial_rank, probes, k1)
+    rows, expansion_index = _k_reciprocal_sets(forward, mask, half_forward[forward], half_mask[forward])
+    probe_index = probes[rows]
+    weight = _expansion_weights(original_dist[probe_index, expansion_index], rows, len(probes))
+    return probe_index, expansion_index, weight
+
+
+def _expansion_block(task):
+    start, end = task
+    return _k_reciprocal_expansion(_shared['original_dist'], _shared['initial_rank'], np.arange(start, end),
+                                   _shared['k1'], _shared['half_forward'], _shared['half_mask'])
+
+
+def _k_reciprocal_blocks(original_dist, initial_rank, k1, block_size, workers):
+    all_num = initial_rank.shape[0]
+    half_forward, half_mask = _k_reciprocal_neighbors(
+        initial_rank, np.arange(all_num), int(np.around(k1/2.)))
+    _shared.update(original_dist=original_dist, initial_rank=initial_rank, k1=k1,
+                   half_forward=half_forward, half_mask=half_mask)
+    return _map_blocks(_expansion_block, all_num, block_size, workers)
+
+
+def _csr_from_coo(rows, cols, data, shape):
+    """Compressed sparse rows (indptr, indices, data); duplicate entries are summed."""
+    key = rows.astype(np.int64) * shape[1] + cols
+    key, inverse = np.unique(key, return_inverse=True)
+    data = np.bincount(inverse.ravel(), weights=data, minlength=len(key)).astype(np.float32)
+    rows = key // shape[1]
+    indptr = np.zeros(shape[0] + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=shape[0]), out=indptr[1:])
+    return indptr, (key % shape[1]).astype(np.int32), data
+
+
+def _csr_gather(indptr, rows):
+    """Positions of all entries of `rows`, and which element of `rows` each belongs to."""
+    starts = indptr[rows]
+    counts = indptr[rows + 1] - starts
+    owner = np.repeat(np.arange(len(rows)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return owner, np.repeat(starts, counts) + offsets
+
+
+def _csr_transpose(indptr, indices, data, num_cols):
+    rows = np.repeat(np.arange(len(indptr) - 1, dtype=np.int32), np.diff(indptr))
+    order = np.argsort(indices, kind='stable')
+    t_indptr = np.zeros(num_cols + 1, dtype=np.int64)
+    np.cumsum(np.bincount(indices, minlength=num_cols), out=t_indptr[1:])
+    return t_indptr, rows[order], data[order]
+
+
+def _sparse_query_expansion_block(task):
+    # rows [start, end) of V_qe: mean of V over the k2 nearest rows
+    start, end = task
+    k2 = _shared['k2']
+    indptr, indices, data = _shared['V']
+    neighbors = _shared['initial_rank'][start:end, :k2]
+    owner, entries = _csr_gather(indptr, neighbors.ravel())
+    # fewer than k2 columns when k2 exceeds the number of images
+    k2 = neighbors.shape[1]
+    return _csr_from_coo(owner // k2, indices[entries], data[entries] / k2, (end - start, len(indptr) - 1))
+
+
+def _min_sum(V, probes, V_t, first_col, num_cols):
+    """sum_k min(V[p, k], W[j, k]) for the probes p and the columns j of
+    [first_col, first_col + num_cols), with W given by its column index V_t."""
+    indptr, indices, data = V
+    t_indptr, t_indices, t_data = V_t
+    owner, entries = _csr_gather(indptr, probes)
+    pair_owner, pair_entries = _csr_gather(t_indptr, indices[entries])
+    images = t_indices[pair_entries]
+    keep = images >= first_col
+    pair_owner, pair_entries, images = pair_owner[keep], pair_entries[keep], images[keep]
+
+    key = owner[pair_owner].astype(np.int64) * num_cols + (images - first_col)
+    key, inverse = np.unique(key, return_inverse=True)
+    min_sum = np.bincount(inverse.ravel(), minlength=len(key),
+                          weights=np.minimum(data[entries][pair_owner], t_data[pair_entries]))
+
+    temp_min = np.zeros(len(probes) * num_cols, dtype=np.float32)
+    temp_min[key] = min_sum
+    return temp_min.reshape(len(probes), num_cols)
+
+
+def _sparse_jaccard_block(task):
+    start, end = task
+    query_num = _shared['query_num']
+    original_dist = _shared['original_dist']
+    lambda_value = _shared['lambda_value']
+
+    temp_min = _min_sum(_shared['V'], np.arange(start, end), _shared['V_t'],
+                        query_num, original_dist.shape[1] - query_num)
+    jaccard_dist = 1 - temp_min / (2. - temp_min)
+    _shared['final_dist'][start:end] = \
+        jaccard_dist * (1 - lambda_value) + original_dist[start:end, query_num:].astype(np.float32) * lambda_value
+
+
+@_timed('k_reciprocal_expansion')
+def _sparse_V(original_dist, initial_rank, k1, block_size, workers):
+    all_num = original_dist.shape[0]
+    blocks = _k_reciprocal_blocks(original_dist, initial_rank, k1, block_size, workers)
+    rows, cols, data = [np.concatenate(x) for x in zip(*blocks)]
+    del blocks
+    return _csr_from_coo(rows, cols, data, (all_num, all_num))
+
+
+@_timed('query_expansion')
+def _sparse_query_expansion(V, initial_rank, k2, block_size, workers):
+    if k2 == 1:
+        return V
+    _shared.update(V=V, k2=k2, initial_rank=initial_rank)
+    blocks = _map_blocks(_sparse_query_expansion_block, len(V[0]) - 1, max(1, block_size // k2), workers)
+    indptr = [np.zeros(1, dtype=np.int64)]
+    for block_indptr, _, _ in blocks:
+        indptr.append(block_indptr[1:] + indptr[-1][-1])
+    return (np.concatenate(indptr),
+            np.concatenate([block[1] for block in blocks]),
+            np.concatenate([block[2] for block in blocks]))
+
+
+@_timed('jaccard')
+def _sparse_final_dist(V, original_dist, query_num, lambda_value, block_size, workers, final_dist=None):
+    all_num = original_dist.shape[0]
+    if final_dist is None:
+        final_dist = _shared_zeros((query_num, all_num - query_num), np.float32, workers)
+    # inverted index: V in compressed sparse column form
+    _shared.update(V=V, V_t=_csr_transpose(V[0], V[1], V[2], all_num), original_dist=original_dist,
+                   query_num=query_num, lambda_value=lambda_value, final_dist=final_dist)
+    _map_blocks(_sparse_jaccard_block, query_num, block_size, workers)
+    return final_dist
+
+
+def _re_ranking_sparse(original_dist, initial_rank, query_num, k1, k2, lambda_value, block_size,
+                       final_dist=None, workers=1):
+    V = _sparse_V(original_dist, initial_rank, k1, block_size, workers)
+    V = _sparse_query_expansion(V, initial_rank, k2, block_size, workers)
+    return _sparse_final_dist(V, original_dist, query_num, lambda_value, block_size, workers, final_dist=final_dist)
+
+
+def _distance_rows(q_g_dist, q_q_dist, g_g_dist, start, end):
+    """Rows [start, end) of the transposed squared distance matrix `re_ranking` concatenates."""
+    query_num = q_g_dist.shape[0]
+    rows = []
+    if start < query_num:
+        s, e = start, min(end, query_num)
+        rows.append(np.concatenate([q_q_dist[:, s:e].T, q_g_dist[s:e]], axis=1))
+    if end > query_num:
+        s, e = max(start, query_num) - query_num, end - query_num
+        rows.append(np.concatenate([q_g_dist[:, s:e].T, g_g_dist[:, s:e].T], axis=1))
+    return np.power(np.concatenate(rows, axis=0), 2).astype(np.float32)
+
+
+def _feature_distance_rows(feats, sq_norms, start, end):
+    """Rows [start, end) of the clamped squared euclidean distance among `feats`."""
+    dist = np.dot(feats[start:end], feats.T)
+    dist *= -2
+    dist += sq_norms[start:end, None]
+    dist += sq_norms[None, :]
+    np.maximum(dist, 0, out=dist)
+    return dist
+
+
+def _distance_block(task):
+    start, end = task
+    initial_rank = _shared['initial_rank']
+    dist = _shared['distance_rows'](start, end)
+    dist /= np.max(dist, axis=1, keepdims=True)
+    initial_rank[start:end] = _initial_rank(dist, initial_rank.shape[1], end - start)
+    _shared['original_dist'][start:end] = dist
+
+
+@_timed('distance')
+def _normalized_distance(distance_rows, all_num, rank_k, block_size, original_dist=None, workers=1):
+    """Fill `original_dist` with row-normalized squared distances block by block,
+    ranking each block while it is in memory."""
+    if original_dist is None:
+        original_dist = _shared_zeros((all_num, all_num), np.float32, workers)
+    initial_rank = _shared_zeros((all_num, min(rank_k, all_num)), np.int32, workers)
+    _shared.update(distance_rows=distance_rows, original_dist=original_dist, initial_rank=initial_rank)
+    _map_blocks(_distance_block, all_num, block_size, workers)
+    return original_dist, initial_rank
+
+
+def re_ranking_out_of_core(q_g_dist, q_q_dist, g_g_dist, k1=20, k2=6, lambda_value=0.3,
+                           memory_budget=1 << 30, scratch_dir=None, disk_dtype=np.float32, workers=1):
+    """Sparse re-ranking over a distance matrix kept in memory-mapped files.
+
+    The normalized (Q+G)^2 distance matrix is written row block by row block to
+    `scratch_dir` (a new temporary directory by default), optionally as float16,
+    and every later phase reads it back one block at a time. Block sizes are
+    chosen so that the working set stays within `memory_budget` bytes, on top
+    of the O(N*k1*k2) sparse V and the N x (k1+1) initial ranking. The inputs may
+    themselves be memory-mapped (e.g. np.load(..., mmap_mode='r')). With
+    workers > 1 the budget is shared by all workers.
+
+    Returns the [num_query, num_gallery] final distance as a float32 np.memmap
+    backed by `scratch_dir`/final_dist.dat, which is left for the caller. The
+    distance matrix file is always removed, and so is a temporary directory
+    created here if the re-ranking fails.
+    """
+    query_num = q_g_dist.shape[0]
+    all_num = q_g_dist.shape[0] + q_g_dist.shape[1]
+    # ~32 bytes per element of a row block: float32 rows, int64 argpartition, temporaries
+    block_size = int(max(1, min(all_num, memory_budget // (32 * all_num * max(1, workers)))))
+
+    created = scratch_dir is None
+    if created:
+        scratch_dir = tempfile.mkdtemp(prefix='re_ranking_')
+    os.makedirs(scratch_dir, exist_ok=True)
+    dist_path = osp.join(scratch_dir, 'original_dist.dat')
+    try:
+        original_dist = np.memmap(dist_path, dtype=disk_dtype, mode='w+', shape=(all_num, all_num))
+        original_dist, initial_rank = _normalized_distance(
+            lambda start, end: _distance_rows(q_g_dist, q_q_dist, g_g_dist, start, end),
+            all_num, max(k1 + 1, k2), block_size, original_dist=original_dist, workers=workers)
+        original_dist.flush()
+
+        final_dist = np.memmap(osp.join(scratch_dir, 'final_dist.dat'), dtype=np.float32, mode='w+',
+                               shape=(query_num, all_num - query_num))
+        _re_ranking_sparse(original_dist, initial_rank, query_num, k1, k2, lambda_value, block_size,
+                           final_dist=final_dist, workers=workers)
+        final_dist.flush()
+    except BaseException:
+        # final_dist.dat only survives a successful run
+        if created:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+        raise
+    finally:
+        _shared.clear()
+        original_dist = None
+        if osp.exists(dist_path):
+            os.remove(dist_path)
+    return final_dist
+
+
+def _dense_query_expansion_block(task):
+    start, end = task
+    V, k2 = _shared['V'], _shared['k2']
+    _shared['V_qe'][start:end] = np.mean(V[_shared['initial_rank'][start:end, :k2], :], axis=1)
+
+
+def _dense_jaccard_block(task):
+    V, invIndex, jaccard_dist = _shared['V'], _shared['invIndex'], _shared['jaccard_dist']
+    gallery_num = V.shape[0]
+    for i in range(*task):
+        temp_min = np.zeros(shape=[1,gallery_num],dtype=np.float32)
+        indNonZero = np.where(V[i,:] != 0)[0]
+        indImages = []
+        indImages = [invIndex[ind] for ind in indNonZero]
+        for j in range(len(indNonZero)):
+            temp_min[0,indImages[j]] = temp_min[0,indImages[j]]+ np.minimum(V[i,indNonZero[j]],V[indImages[j],indNonZero[j]])
+        jaccard_dist[i] = 1-temp_min/(2.-temp_min)
+
+
+def _re_ranking_dense(original_dist, initial_rank, query_num, k1, k2, lambda_value, block_size, workers=1):
+    gallery_num = original_dist.shape[0]
+    all_num = gallery_num
+
+    with _timed('k_reciprocal_expansion'):
+        V = np.zeros_like(original_dist).astype(np.float32)
+        for rows, cols, weight in _k_reciprocal_blocks(original_dist, initial_rank, k1, block_size, workers):
+            V[rows, cols] = weight
+
+    original_dist = original_dist[:query_num,]
+    if k2 != 1:
+        with _timed('query_expansion'):
+            V_qe = _shared_zeros(V.shape, np.float32, workers)
+            _shared.update(V=V, V_qe=V_qe, k2=k2, initial_rank=initial_rank)
+            _map_blocks(_dense_query_expansion_block, all_num, max(1, block_size // k2), workers)
+            V = V_qe
+            del V_qe
+    del initial_rank
+    with _timed('jaccard'):
+        invIndex = []
+        for i in range(gallery_num):
+            invIndex.append(np.where(V[:,i] != 0)[0])
+
+        jaccard_dist = _shared_zeros(original_dist.shape, np.float32, workers)
+        _shared.clear()
+        _shared.update(V=V, invIndex=invIndex, jaccard_dist=jaccard_dist)
+        _map_blocks(_dense_jaccard_block, query_num, block_size, workers)
+
+        final_dist = jaccard_dist*(1-lambda_value) + original_dist*lambda_value
+    del original_dist
+    del V
+    del jaccard_dist
+    final_dist = final_dist[:query_num,query_num:]
+    return final_dist
+
+
+def _check_backend(backend):
+    if backend not in ('dense', 'sparse'):
+        raise ValueError("backend should be 'dense' or 'sparse', but got {}".format(backend))
+
+
+def _re_ranking_backend(distance_rows, all_num, query_num, k1, k2, lambda_value, block_size, backend, workers):
+    try:
+        original_dist, initial_rank = _normalized_distance(
+            distance_rows, all_num, max(k1 + 1, k2), block_size, workers=workers)
+        if backend == 'sparse':
+            return _re_ranking_sparse(original_dist, initial_rank, query_num, k1, k2, lambda_value, block_size,
+                                      workers=workers)
+        return _re_ranking_dense(original_dist, initial_rank, query_num, k1, k2, lambda_value, block_size,
+                                 workers=workers)
+    finally:
+        _shared.clear()
+
+
+def re_ranking(q_g_dist, q_q_dist, g_g_dist, k1=20, k2=6, lambda_value=0.3, block_size=1024, backend='dense',
+               workers=1):
+
+    # The following naming, e.g. gallery_num, is different from outer scope.
+    # Don't care about it.
+
+    _check_backend(backend)
+
+    # rows of transpose(original_dist / max(original_dist, axis=0)) for the concatenated
+    # [[q_q, q_g], [q_g.T, g_g]] ** 2, built block by block
+    query_num = q_g_dist.shape[0]
+    all_num = q_g_dist.shape[0] + q_g_dist.shape[1]
+    return _re_ranking_backend(lambda start, end: _distance_rows(q_g_dist, q_q_dist, g_g_dist, start, end),
+                               all_num, query_num, k1, k2, lambda_value, block_size, backend, workers)
+
+
+def re_ranking_from_features(qf, gf, k1=20, k2=6, lambda_value=0.3, block_size=1024, backend='dense',
+                             workers=1):
+    """Re-ranking straight from query / gallery features.
+
+    Equivalent to computing the euclidean q_g, q_q and g_g distances and calling
+    `re_ranking`, but the squared distances that re-ranking works on are written
+    block by block into a single (Q+G)^2 matrix, without the sqrt / square round
+    trip and the concatenation copies.
+    """
+    _check_backend(backend)
+
+    query_num = qf.shape[0]
+    feats = np.concatenate([qf, gf], axis=0).astype(np.float32)
+    sq_norms = np.sum(feats ** 2, axis=1)
+    return _re_ranking_backend(lambda start, end: _feature_distance_rows(feats, sq_norms, start, end),
+                               feats.shape[0], query_num, k1, k2, lambda_value, block_size, backend, workers)
+
+
+def _sweep_task(task):
+    k1, k2s = task
+    original_dist, initial_rank = _shared['sweep_original_dist'], _shared['sweep_initial_rank']
+    query_num, block_size, workers = _shared['sweep_query_num'], _shared['sweep_block_size'], _shared['sweep_workers']
+    q_g_dist = original_dist[:query_num, query_num:]
+    results = []
+    V = _sparse_V(original_dist, initial_rank, k1, block_size, workers)
+    for k2 in k2s:
+        V_qe = _sparse_query_expansion(V, initial_rank, k2, block_size, workers)
+        jaccard_dist = _sparse_final_dist(V_qe, original_dist, query_num, 0., block_size, workers)
+        del V_qe
+        for lambda_value in _shared['sweep_lambda_values']:
+            final_dist = jaccard_dist * (1 - lambda_value) + q_g_dist * lambda_value
+            results.append({'k1': k1, 'k2': k2, 'lambda_value': lambda_value,
+                            'score': _shared['sweep_score_func'](final_dist)})
+            del final_dist
+        del jaccard_dist
+    return results
+
+
+def re_ranking_sweep(qf, gf, score_func, k1s=range(1, 21), k2s=(6,), lambda_values=(0.3,),
+                     block_size=1024, workers=1, grid_workers=1, initializer=None):
+    """Score every (k1, k2, lambda_value) of a grid, sharing intermediates.
+
+    The distance matrix and the initial ranking do not depend on the parameters
+    and are built once; V is built once per k1, and its query expansion and the
+    Jaccard distance once per (k1, k2) and reused for every lambda_value. So the
+    grid costs about one sparse re-ranking per (k1, k2) pair.
+
+    With grid_workers > 1 the k1 values are spread over that many forked
+    processes, which all read the one distance matrix and initial ranking; each
+    of them then runs its k1 with a single worker, and score_func runs in them
+    (after `initializer`, e.g. to reset thread pools that do not survive a fork).
+    With fewer k1 values than grid_workers the (k1, k2) pairs are spread
+    instead, each building its own V. A grid of a single pair runs in this
+    process with `workers`.
+
+    score_func: called with each [num_query, num_gallery] final distance, returns a score
+    Returns:
+      list of dicts with keys k1, k2, lambda_value and score, in grid order
+    """
+    query_num = qf.shape[0]
+    feats = np.concatenate([qf, gf], axis=0).astype(np.float32)
+    sq_norms = np.sum(feats ** 2, axis=1)
+    all_num = feats.shape[0]
+    k1s, k2s = list(k1s), list(k2s)
+    if len(k1s) >= grid_workers:
+        tasks = [(k1, k2s) for k1 in k1s]
+    else:
+        tasks = [(k1, [k2]) for k1 in k1s for k2 in k2s]
+    grid_workers = min(grid_workers, len(tasks))
+    try:
+        original_dist, initial_rank = _normalized_distance(
+            lambda start, end: _feature_distance_rows(feats, sq_norms, start, end),
+            all_num, max(max(k1s) + 1, max(k2s)), block_size, workers=workers)
+        del feats
+        _shared.update(sweep_original_dist=original_dist, sweep_initial_rank=initial_rank,
+                       sweep_query_num=query_num, sweep_block_size=block_size,
+                       sweep_workers=workers if grid_workers <= 1 else 1,
+                       sweep_lambda_values=list(lambda_values), sweep_score_func=score_func)
+        if grid_workers > 1:
+            with multiprocessing.get_context('fork').Pool(grid_workers, initializer=initializer) as pool:
+                results = pool.map(_sweep_task, tasks, chunksize=1)
+        else:
+            results = [_sweep_task(task) for task in tasks]
+    finally:
+        _shared.clear()
+    return [result for task_results in results for result in task_results]
+
+
+class _PairDistance(object):
+    """original_dist[rows, cols] among gallery features, computed on demand."""
+
+    def __init__(self, feats, sq_norms, row_max):
+        self.feats = feats
+        self.sq_norms = sq_norms
+        self.row_max = row_max
+        self.shape = (feats.shape[0], feats.shape[0])
+
+    def __getitem__(self, index):
+        rows, cols = index
+        dist = np.empty(len(rows), dtype=np.float32)
+        step = max(1, (1 << 24) // self.feats.shape[1])
+        for start in range(0, len(rows), step):
+            r, c = rows[start:start + step], cols[start:start + step]
+            d = self.sq_norms[r] + self.sq_norms[c] - 2 * np.einsum('ij,ij->i', self.feats[r], self.feats[c])
+            dist[start:start + step] = np.maximum(d, 0) / self.row_max[r]
+        return dist
+
+
+def _csr_replace_rows(V, rows, coo, shape):
+    """V with `rows` replaced by the entries of coo = (rows, cols, data), grown to `shape`."""
+    if V is not None:
+        indptr, indices, data = V
+        entry_rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+        keep = ~np.isin(entry_rows, rows)
+        coo = (np.concatenate([entry_rows[keep], coo[0]]),
+               np.concatenate([indices[keep], coo[1]]),
+               np.concatenate([data[keep], coo[2]]))
+    return _csr_from_coo(coo[0], coo[1], coo[2], shape)
+
+
+class RerankIndex(object):
+    """k-reciprocal re-ranking of query batches against a fixed gallery.
+
+    The gallery-side state of `re_ranking` -- the gallery-gallery neighbor lists,
+    the V rows of the gallery, their query expansion and its inverted index -- is
+    computed once by `build` and kept (and saved) with the gallery features.
+    `rerank` then costs one query x gallery distance block plus sparse work per
+    query, and `add` only recomputes the gallery rows whose neighborhoods or
+    weights change.
+
+    Every query is re-ranked on its own against the gallery, and gallery
+    neighborhoods are those among gallery images only (queries do not enter
+    them), so the result approximates `re_ranking` of the same batch.
+    """
+
+    def __init__(self, k1=20, k2=6, block_size=1024):
+        self.k1 = k1
+        self.k2 = k2
+        self.block_size = block_size
+        self.gf = None
+
+    @property
+    def num_gallery(self):
+        return 0 if self.gf is None else self.gf.shape[0]
+
+    def build(self, gf):
+        self.gf = np.ascontiguousarray(gf, dtype=np.float32)
+        self.sq_norms = np.sum(self.gf ** 2, axis=1)
+        gallery_num = self.num_gallery
+        rank_k = min(max(self.k1 + 1, self.k2), gallery_num)
+        self.initial_rank = np.zeros((gallery_num, rank_k), dtype=np.int32)
+        self.rank_dist = np.zeros((gallery_num, rank_k), dtype=np.float32)
+        self.row_max = np.zeros(gallery_num, dtype=np.float32)
+        for start in range(0, gallery_num, self.block_size):
+            self._rank_rows(start, min(start + self.block_size, gallery_num))
+
+        self.V = self.V_qe = None
+        everything = np.arange(gallery_num)
+        self._refresh(everything, everything)
+        return self
+
+    def add(self, gf):
+        """Append gallery images, updating only the affected gallery rows."""
+        gf = np.asarray(gf, dtype=np.float32)
+        old_num = self.num_gallery
+        gallery_num = old_num + gf.shape[0]
+        rank_k = self.initial_rank.shape[1]
+        if min(max(self.k1 + 1, self.k2), gallery_num) != rank_k:
+            return self.build(np.concatenate([self.gf, gf], axis=0))
+
+        sq_norms = np.sum(gf ** 2, axis=1)
+        max_changed = np.zeros(gallery_num, dtype=bool)
+        rank_changed = np.zeros(gallery_num, dtype=bool)
+        rank_changed[old_num:] = True
+        for start in range(0, old_num, self.block_size):
+            end = min(start + self.block_size, old_num)
+            dist = np.dot(self.gf[start:end], gf.T)
+            dist *= -2
+            dist += self.sq_norms[start:end, None]
+            dist += sq_norms[None, :]
+            np.maximum(dist, 0, out=dist)
+
+            new_max = np.max(dist, axis=1)
+            max_changed[start:end] = new_max > self.row_max[start:end]
+            self.row_max[start:end] = np.maximum(self.row_max[start:end], new_max)
+
+            # merge the new images into the rank rows they enter
+            enter = np.nonzero((dist < self.rank_dist[start:end, -1:]).any(axis=1))[0]
+            rank_changed[start + enter] = True
+            index = np.concatenate([self.initial_rank[start + enter],
+                                    np.tile(np.arange(old_num, gallery_num, dtype=np.int32), (len(enter), 1))], axis=1)
+            candidate_dist = np.concatenate([self.rank_dist[start + enter], dist[enter]], axis=1)
+            order = _initial_rank(candidate_dist, rank_k, self.block_size)
+            self.initial_rank[start + enter] = np.take_along_axis(index, order, axis=1)
+            self.rank_dist[start + enter] = np.take_along_axis(candidate_dist, order, axis=1)
+
+        self.gf = np.concatenate([self.gf, gf], axis=0)
+        self.sq_norms = np.concatenate([self.sq_norms, sq_norms])
+        self.initial_rank = np.concatenate([self.initial_rank, np.zeros((len(gf), rank_k), dtype=np.int32)])
+        self.rank_dist = np.concatenate([self.rank_dist, np.zeros((len(gf), rank_k), dtype=np.float32)])
+        self.row_max = np.concatenate([self.row_max, np.zeros(len(gf), dtype=np.float32)])
+        for start in range(old_num, gallery_num, self.block_size):
+            self._rank_rows(start, min(start + self.block_size, gallery_num))
+
+        # rows whose k-reciprocal sets, expansion candidates, weights or query expansion depend on a change
+        initial_rank = self.initial_rank
+        half_changed = rank_changed | rank_changed[initial_rank[:, :int(np.around(self.k1/2.)) + 1]].any(axis=1)
+        forward = initial_rank[:, :self.k1 + 1]
+        v_dirty = rank_changed | max_changed | rank_changed[forward].any(axis=1) | half_changed[forward].any(axis=1)
+        qe_dirty = rank_changed | v_dirty | v_dirty[initial_rank[:, :self.k2]].any(axis=1)
+        self._refresh(np.nonzero(v_dirty)[0], np.nonzero(qe_dirty)[0])
+        return self
+
+    def rerank(self, qf, lambda_value=0.3):
+        """Re-ranked [num_query, num_gallery] distance of a batch of query features."""
+        qf = np.asarray(qf, dtype=np.float32)
+        final_dist = np.zeros((qf.shape[0], self.num_gallery), dtype=np.float32)
+        for start in range(0, qf.shape[0], self.block_size):
+            final_dist[start:start + self.block_size] = self._rerank_block(qf[start:start + self.block_size],
+                                                                           lambda_value)
+        return final_dist
+
+    def save(self, fpath):
+        # through a file object, so np.savez does not append .npz to fpath
+        with open(fpath, 'wb') as f:
+            np.savez(f, k1=self.k1, k2=self.k2, block_size=self.block_size, gf=self.gf,
+                     row_max=self.row_max, initial_rank=self.initial_rank, rank_dist=self.rank_dist,
+                     V_indptr=self.V[0], V_indices=self.V[1], V_data=self.V[2],
+                     V_qe_indptr=self.V_qe[0], V_qe_indices=self.V_qe[1], V_qe_data=self.V_qe[2])
+
+    @classmethod
+    def load(cls, fpath):
+        with np.load(fpath) as state:
+            index = cls(int(state['k1']), int(state['k2']), int(state['block_size']))
+            index.gf = state['gf']
+            index.row_max = state['row_max']
+            index.initial_rank = state['initial_rank']
+            index.rank_dist = state['rank_dist']
+            index.V = (state['V_indptr'], state['V_indices'], state['V_data'])
+            index.V_qe = (state['V_qe_indptr'], state['V_qe_indices'], state['V_qe_data'])
+        index.sq_norms = np.sum(index.gf ** 2, axis=1)
+        index._half_sets()
+        index.V_t = _csr_transpose(index.V_qe[0], index.V_qe[1], index.V_qe[2], index.num_gallery)
+        return index
+
+    @_timed('distance')
+    def _rank_rows(self, start, end):
+        dist = _feature_distance_rows(self.gf, self.sq_norms, start, end)
+        self.row_max[start:end] = np.max(dist, axis=1)
+        rank = _initial_rank(dist, self.initial_rank.shape[1], self.block_size)
+        self.initial_rank[start:end] = rank
+        self.rank_dist[start:end] = np.take_along_axis(dist, rank, axis=1)
+
+    def _half_sets(self):
+        self.half_forward, self.half_mask = _k_reciprocal_neighbors(
+            self.initial_rank, np.arange(self.num_gallery), int(np.around(self.k1/2.)))
+
+    def _refresh(self, v_rows, qe_rows):
+        gallery_num = self.num_gallery
+        with _timed('k_reciprocal_expansion'):
+            self._half_sets()
+            pair_dist = _PairDistance(self.gf, self.sq_norms, self.row_max)
+            blocks = [_k_reciprocal_expansion(pair_dist, self.initial_rank, v_rows[start:start + self.block_size],
+                                              self.k1, self.half_forward, self.half_mask)
+                      for start in range(0, len(v_rows), self.block_size)]
+            coo = [np.concatenate(x) for x in zip(*blocks)] if blocks else [np.zeros(0, np.int64)] * 3
+            self.V = _csr_replace_rows(self.V, v_rows, coo, (gallery_num, gallery_num))
+
+        with _timed('query_expansion'):
+            if self.k2 == 1:
+                self.V_qe = self.V
+            else:
+                neighbors = self.initial_rank[qe_rows, :self.k2]
+                owner, entries = _csr_gather(self.V[0], neighbors.ravel())
+                coo = (qe_rows[owner // neighbors.shape[1]], self.V[1][entries],
+                       self.V[2][entries] / neighbors.shape[1])
+                self.V_qe = _csr_replace_rows(self.V_qe, qe_rows, coo, (gallery_num, gallery_num))
+            self.V_t = _csr_transpose(self.V_qe[0], self.V_qe[1], self.V_qe[2], gallery_num)
+
+    @_timed('rerank')
+    def _rerank_block(self, qf, lambda_value):
+        query_num, gallery_num = qf.shape[0], self.num_gallery
+        rank_k = self.initial_rank.shape[1]
+        k1 = min(self.k1, gallery_num)
+        k_half = int(np.around(self.k1/2.))
+        width = self.half_forward.shape[1]
+
+        dist = np.dot(qf, self.gf.T)
+        dist *= -2
+        dist += np.sum(qf ** 2, axis=1)[:, None]
+        dist += self.sq_norms[None, :]
+        np.maximum(dist, 0, out=dist)
+        forward = _initial_rank(dist, k1, self.block_size)
+        forward_dist = np.take_along_axis(dist, forward, axis=1)
+
+        # the query is reciprocal to a gallery neighbor if it would enter that neighbor's top k1+1
+        threshold = self.rank_dist[forward, self.k1] if rank_k > self.k1 else np.inf
+        mask = forward_dist < threshold
+        threshold = self.rank_dist[forward[:, :width - 1], k_half] if rank_k > k_half else np.inf
+        half_mask = forward_dist[:, :width - 1] < threshold
+
+        # the query itself is column `gallery_num`, first in its own lists
+        self_index = np.full((query_num, 1), gallery_num, dtype=forward.dtype)
+        self_mask = np.ones((query_num, 1), dtype=bool)
+        rows, cols = _k_reciprocal_sets(
+            np.concatenate([self_index, forward], axis=1),
+            np.concatenate([self_mask, mask], axis=1),
+            np.concatenate([np.concatenate([self_index, forward[:, :width - 1]], axis=1)[:, None],
+                            self.half_forward[forward]], axis=1),
+            np.concatenate([np.concatenate([self_mask, half_mask], axis=1)[:, None],
+                            self.half_mask[forward]], axis=1))
+
+        row_max = np.max(dist, axis=1, keepdims=True)
+        dist /= row_max
+        weight = _expansion_weights(np.concatenate([dist, np.zeros((query_num, 1), np.float32)], axis=1)[rows, cols],
+                                    rows, query_num)
+        keep = cols < gallery_num
+        rows, cols, weight = rows[keep], cols[keep], weight[keep]
+        if self.k2 != 1:
+            # the query's k2 nearest: itself and its k2 - 1 nearest gallery images
+            neighbors = forward[:, :self.k2 - 1]
+            owner, entries = _csr_gather(self.V[0], neighbors.ravel())
+            rows = np.concatenate([rows, owner // neighbors.shape[1]])
+            cols = np.concatenate([cols, self.V[1][entries]])
+            weight = np.concatenate([weight, self.V[2][entries]]) / (neighbors.shape[1] + 1)
+        V = _csr_from_coo(rows, cols, weight, (query_num, gallery_num))
+
+        temp_min = _min_sum(V, np.arange(query_num), self.V_t, 0, gallery_num)
+        jaccard_dist = 1 - temp_min / (2. - temp_min)
+        return jaccard_dist * (1 - lambda_value) + dist * lambda_value
+
+
+def _estimated_row_max(ivf, feats, sq_norms, block_size, num_samples=1024, seed=0):
+    """max_j |x_i - x_j|^2 estimated as the maximum over a reference subset: a
+    random sample of the features and the member of every IVF list farthest
+    from its centroid."""
+    owner = np.repeat(np.arange(len(ivf.centroids)), np.diff(ivf.list_ptr))
+    radius = np.sum((feats[ivf.list_index] - ivf.centroids[owner]) ** 2, axis=1)
+    order = np.lexsort((-radius, owner))
+    farthest = ivf.list_index[order[ivf.list_ptr[:-1][np.diff(ivf.list_ptr) > 0]]]
+    sample = np.random.RandomState(seed).choice(len(feats), min(num_samples, len(feats)), replace=False)
+    reference = np.union1d(sample, farthest)
+
+    row_max = np.zeros(len(feats), dtype=np.float32)
+    for start in range(0, len(feats), block_size):
+        dist = np.dot(feats[start:start + block_size], feats[reference].T)
+        dist *= -2
+        dist += sq_norms[start:start + block_size, None]
+        dist += sq_norms[None, reference]
+        row_max[start:start + block_size] = np.max(dist, axis=1)
+    return row_max
+
+
+def _pair_min_sum(V, probes, V_t, cols):
+    """sum_k min(V[p, k], W[j, k]) only for the columns j in cols[i] of every probe p = probes[i]."""
+    indptr, indices, data = V
+    t_indptr, t_indices, t_data = V_t
+    num_cols = len(t_indptr) - 1
+    owner, entries = _csr_gather(indptr, probes)
+    pair_owner, pair_entries = _csr_gather(t_indptr, indices[entries])
+    key = owner[pair_owner].astype(np.int64) * num_cols + t_indices[pair_entries]
+
+    wanted = (np.arange(len(probes), dtype=np.int64)[:, None] * num_cols + cols).ravel()
+    order = np.argsort(wanted)
+    position = np.minimum(np.searchsorted(wanted[order], key), len(wanted) - 1)
+    hit = wanted[order][position] == key
+    min_sum = np.bincount(order[position[hit]], minlength=len(wanted),
+                          weights=np.minimum(data[entries][pair_owner], t_data[pair_entries])[hit])
+    return min_sum.reshape(cols.shape).astype(np.float32)
+
+
+def re_ranking_approximate(qf, gf, k1=20, k2=6, lambda_value=0.3, shortlist=200, num_lists=None, num_probes=8,
+                           block_size=1024, workers=1):
+    """Approximate re-ranking of a shortlist per query, for galleries too large for `re_ranking`.
+
+    The initial ranking of every query and gallery image comes from an IVF index
+    over the features (retrieval.IVFIndex) instead of the (Q+G)^2 distance
+    matrix; V and its query expansion are built from it in sparse form, with the
+    distances they need computed pair by pair, and the Jaccard distance is only
+    computed between each query and its `shortlist` nearest gallery images.
+    Row normalization uses an estimate of every row's maximum distance. The
+    cost is dominated by the index searches, num_probes / num_lists of brute
+    force; the default num_lists = sqrt(Q+G) gives O((Q+G)^1.5), lists of a
+    fixed size give linear scaling.
+
+    Returns:
+      final_dist: [num_query, shortlist] re-ranked distances, ascending
+      index: [num_query, shortlist] gallery indices of final_dist
+    """
+    # retrieval loads torch, which the exact re-ranking paths and their workers do without
+    from retrieval import IVFIndex
+
+    query_num = qf.shape[0]
+    feats = np.concatenate([qf, gf], axis=0).astype(np.float32)
+    sq_norms = np.sum(feats ** 2, axis=1)
+    all_num = feats.shape[0]
+    shortlist = min(shortlist, all_num - query_num)
+
+    with _timed('index'):
+        ivf = IVFIndex(num_lists=num_lists, num_probes=num_probes, block_size=block_size).build(feats)
+    with _timed('initial_rank'):
+        _, initial_rank = ivf.search(feats, min(max(k1 + 1, k2), all_num))
+    with _timed('distance'):
+        row_max = _estimated_row_max(ivf, feats, sq_norms, block_size)
+        gallery_mask = np.arange(all_num) >= query_num
+        shortlist_dist, shortlist_index = ivf.search(feats[:query_num], shortlist, mask=gallery_mask)
+    del ivf
+
+    try:
+        pair_dist = _PairDistance(feats, sq_norms, row_max)
+        V = _sparse_V(pair_dist, initial_rank.astype(np.int32), k1, block_size, workers)
+        V = _sparse_query_expansion(V, initial_rank, k2, block_size, workers)
+    finally:
+        _shared.clear()
+    with _timed('jaccard'):
+        V_t = _csr_transpose(V[0], V[1], V[2], all_num)
+        final_dist = np.zeros((query_num, shortlist), dtype=np.float32)
+        for start in range(0, query_num, block_size):
+            end = min(start + block_size, query_num)
+            temp_min = _pair_min_sum(V, np.arange(start, end), V_t, shortlist_index[start:end])
+            jaccard_dist = 1 - temp_min / (2. - temp_min)
+            final_dist[start:end] = jaccard_dist * (1 - lambda_value) + \
+                shortlist_dist[start:end] / row_max[start:end, None] * lambda_value
+    order = np.argsort(final_dist, axis=1, kind='stable')
+    return np.take_along_axis(final_dist, order, axis=1), np.take_along_axis(shortlist_index, order, axis=1) - query_num
+
+
+def re_ranking_loop(q_g_dist, q_q_dist, g_g_dist, k1=20, k2=6, lambda_value=0.3):
 
     # The following naming, e.g. gallery_num, is different from outer scope.
     # Don't care about it.
@@ -94,4 +1006,50 @@ def re_ranking(q_g_dist, q_q_dist, g_g_dist, k1=20, k2=6, lambda_value=0.3):
     del V
     del jaccard_dist
     final_dist = final_dist[:query_num,query_num:]
-    return final_dist
\ No newline at end of file
+    return final_dist
+
+
+if __name__ == '__main__':
+    rng = np.random.RandomState(0)
+    for num_query, num_gallery in [(200, 1000), (500, 3000)]:
+        feats = rng.randn(num_query + num_gallery, 256).astype(np.float32)
+        feats /= np.linalg.norm(feats, axis=1, keepdims=True)
+        sq = (feats ** 2).sum(axis=1)
+        dist = np.sqrt(np.maximum(sq[:, None] + sq[None, :] - 2 * feats.dot(feats.T), 0))
+        q_g_dist = dist[:num_query, num_query:]
+        q_q_dist = dist[:num_query, :num_query]
+        g_g_dist = dist[num_query:, num_query:]
+
+        start = time.time()
+        loop_dist = re_ranking_loop(q_g_dist, q_q_dist, g_g_dist)
+        loop_time = time.time() - start
+        print('query {} gallery {}: loop {:.2f}s'.format(num_query, num_gallery, loop_time))
+        for backend in ['dense', 'sparse']:
+            start = time.time()
+            final_dist = re_ranking(q_g_dist, q_q_dist, g_g_dist, backend=backend)
+            backend_time = time.time() - start
+            print('  {:<6} {:.2f}s ({:.1f}x), max abs diff {:.2e}'.format(
+                backend, backend_time, loop_time / backend_time, np.abs(loop_dist - final_dist).max()))
+        start = time.time()
+        final_dist = re_ranking_from_features(feats[:num_query], feats[num_query:], backend='sparse')
+        backend_time = time.time() - start
+        print('  from features {:.2f}s ({:.1f}x), max abs diff {:.2e}'.format(
+            backend_time, loop_time / backend_time, np.abs(loop_dist - final_dist).max()))
+        for backend in ['dense', 'sparse']:
+            start = time.time()
+            final_dist = re_ranking(q_g_dist, q_q_dist, g_g_dist, backend=backend, workers=4)
+            backend_time = time.time() - start
+            print('  {:<6} 4 workers {:.2f}s ({:.1f}x), max abs diff {:.2e}'.format(
+                backend, backend_time, loop_time / backend_time, np.abs(loop_dist - final_dist).max()))
+        for disk_dtype in [np.float32, np.float16]:
+            start = time.time()
+            final_dist = re_ranking_out_of_core(q_g_dist, q_q_dist, g_g_dist, memory_budget=64 << 20,
+                                                disk_dtype=disk_dtype)
+            backend_time = time.time() - start
+            print('  out-of-core {:<7} {:.2f}s ({:.1f}x), max abs diff {:.2e}'.format(
+                np.dtype(disk_dtype).name, backend_time, loop_time / backend_time,
+                np.abs(loop_dist - final_dist).max()))
+            scratch_dir = osp.dirname(final_dist.filename)
+            del final_dist
+            os.remove(osp.join(scratch_dir, 'final_dist.dat'))
+            os.rmdir(scratch_dir)
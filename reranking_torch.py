@@ -0,0 +1,251 @@
+# encoding: utf-8
+"""
+k-reciprocal re-ranking (see reranking.py) on torch tensors.
+
+`re_ranking_torch` takes query / gallery features on any device and returns the
+re-ranked [num_query, num_gallery] distance as a tensor on that device, so the
+Q x G matrices never round-trip through numpy. Every phase is written with
+batched tensor ops (topk, gather, index_add_, unique, sort), which run on the
+GPU, or on CPU over torch's intra-op thread pool (torch.set_num_threads).
+
+backend='dense' keeps V as an N x N tensor and computes the Jaccard term from
+the non-zero entries of each query row against the gallery rows.
+backend='sparse' keeps V and its query expansion in compressed sparse row form
+and computes the Jaccard term from the inverted (column) index.
+Both follow the array version in reranking.py step by step and agree with it
+up to float rounding and the order of exactly tied distances.
+"""
+from __future__ import absolute_import
+from __future__ import division
+
+import contextlib
+
+import torch
+
+import reranking
+
+__all__ = ['re_ranking_torch']
+
+
+@contextlib.contextmanager
+def _timed(phase):
+    """reranking._timed, waiting for the GPU kernels of the phase while timings are recorded."""
+    with reranking._timed(phase):
+        yield
+        if reranking._timings is not None and torch.cuda.is_available() and torch.cuda.is_initialized():
+            torch.cuda.synchronize()
+
+
+def _normalized_distance(feats, rank_k, block_size):
+    """Row-normalized squared distances among `feats` and the rank_k nearest of every row."""
+    all_num = feats.size(0)
+    sq_norms = feats.pow(2).sum(dim=1)
+    original_dist = torch.empty(all_num, all_num, dtype=torch.float32, device=feats.device)
+    initial_rank = torch.empty(all_num, min(rank_k, all_num), dtype=torch.long, device=feats.device)
+    for start in range(0, all_num, block_size):
+        end = min(start + block_size, all_num)
+        with _timed('distance'):
+            dist = torch.addmm(sq_norms[None, :], feats[start:end], feats.t(), beta=1, alpha=-2)
+            dist += sq_norms[start:end, None]
+            dist.clamp_(min=0)
+            dist /= dist.max(dim=1, keepdim=True)[0]
+            original_dist[start:end] = dist
+        with _timed('initial_rank'):
+            initial_rank[start:end] = torch.topk(dist, initial_rank.size(1), dim=1, largest=False)[1]
+    return original_dist, initial_rank
+
+
+def _k_reciprocal_neighbors(initial_rank, probes, k):
+    """Forward k-NN of each probe and a mask of the ones that are reciprocal."""
+    forward = initial_rank[probes, :k + 1]
+    backward = initial_rank[forward, :k + 1]
+    mask = (backward == probes[:, None, None]).any(dim=2)
+    return forward, mask
+
+
+def _k_reciprocal_expansion(original_dist, initial_rank, probes, k1, half_forward, half_mask):
+    """Non-zero entries (rows, cols, weights) of V for a block of probes."""
+    forward, mask = _k_reciprocal_neighbors(initial_rank, probes, k1)
+    candidate_index, candidate_mask = half_forward[forward], half_mask[forward]
+
+    # how many members of each candidate's set are in the probe's set
+    k_reciprocal_index = torch.where(mask, forward, torch.full_like(forward, -1))
+    overlap = (candidate_index[:, :, :, None] == k_reciprocal_index[:, None, None, :]).any(dim=3)
+    overlap = (overlap & candidate_mask).sum(dim=2)
+    accept = mask & (overlap.float() > 2. / 3 * candidate_mask.sum(dim=2).float())
+
+    expansion = torch.cat(
+        [k_reciprocal_index,
+         torch.where(accept[:, :, None] & candidate_mask, candidate_index,
+                     torch.full_like(candidate_index, -1)).reshape(len(probes), -1)],
+        dim=1)
+    expansion = torch.sort(expansion, dim=1)[0]
+    valid = expansion >= 0
+    valid[:, 1:] &= expansion[:, 1:] != expansion[:, :-1]
+    rows, cols = valid.nonzero(as_tuple=True)
+    expansion_index = expansion[rows, cols]
+
+    probe_index = probes[rows]
+    weight = torch.exp(-original_dist[probe_index, expansion_index])
+    weight_sum = torch.zeros(len(probes), dtype=weight.dtype, device=weight.device).index_add_(0, rows, weight)
+    return probe_index, expansion_index, weight / weight_sum[rows]
+
+
+def _V_entries(original_dist, initial_rank, k1, block_size):
+    all_num = initial_rank.size(0)
+    probes = torch.arange(all_num, device=initial_rank.device)
+    half_forward, half_mask = _k_reciprocal_neighbors(initial_rank, probes, int(round(k1 / 2.)))
+    blocks = [_k_reciprocal_expansion(original_dist, initial_rank, probes[start:start + block_size], k1,
+                                      half_forward, half_mask)
+              for start in range(0, all_num, block_size)]
+    return [torch.cat(x) for x in zip(*blocks)]
+
+
+@_timed('k_reciprocal_expansion')
+def _dense_V(original_dist, initial_rank, k1, block_size):
+    rows, cols, weight = _V_entries(original_dist, initial_rank, k1, block_size)
+    V = torch.zeros_like(original_dist)
+    V[rows, cols] = weight
+    return V
+
+
+@_timed('query_expansion')
+def _dense_query_expansion(V, initial_rank, k2, block_size):
+    V_qe = torch.empty_like(V)
+    step = max(1, block_size // k2)
+    for start in range(0, V.size(0), step):
+        V_qe[start:start + step] = V[initial_rank[start:start + step, :k2]].mean(dim=1)
+    return V_qe
+
+
+@_timed('jaccard')
+def _dense_final_dist(V, original_dist, query_num, lambda_value, block_size):
+    # sum_k min(V[q, k], V[g, k]) from the non-zero entries of each query row, padded with zeros,
+    # against the gallery rows of the columns they hit, transposed once
+    num_nonzero = max(1, int((V[:query_num] != 0).sum(dim=1).max()))
+    values, index = torch.topk(V[:query_num], num_nonzero, dim=1)
+    columns, index = torch.unique(index, return_inverse=True)
+    V_t = V[query_num:, columns].t().contiguous()
+    gallery_num = V_t.size(1)
+    step = max(1, min(block_size, (1 << 26) // (num_nonzero * gallery_num)))
+    jaccard_dist = torch.empty(query_num, gallery_num, dtype=V_t.dtype, device=V_t.device)
+    for start in range(0, query_num, step):
+        end = min(start + step, query_num)
+        temp_min = torch.min(V_t[index[start:end].reshape(-1)], values[start:end].reshape(-1, 1))
+        temp_min = temp_min.reshape(end - start, num_nonzero, gallery_num).sum(dim=1)
+        jaccard_dist[start:end] = 1 - temp_min / (2. - temp_min)
+    return jaccard_dist * (1 - lambda_value) + original_dist[:query_num, query_num:] * lambda_value
+
+
+def _re_ranking_dense(original_dist, initial_rank, query_num, k1, k2, lambda_value, block_size):
+    V = _dense_V(original_dist, initial_rank, k1, block_size)
+    if k2 != 1:
+        V = _dense_query_expansion(V, initial_rank, k2, block_size)
+    del initial_rank
+    return _dense_final_dist(V, original_dist, query_num, lambda_value, block_size)
+
+
+def _csr_from_coo(rows, cols, data, shape):
+    """Compressed sparse rows (indptr, indices, data); duplicate entries are summed."""
+    key, inverse = torch.unique(rows * shape[1] + cols, return_inverse=True)
+    data = torch.zeros(len(key), dtype=data.dtype, device=data.device).index_add_(0, inverse, data)
+    indptr = torch.zeros(shape[0] + 1, dtype=torch.long, device=key.device)
+    indptr[1:] = torch.cumsum(torch.bincount(key // shape[1], minlength=shape[0]), dim=0)
+    return indptr, key % shape[1], data
+
+
+def _csr_gather(indptr, rows):
+    """Positions of all entries of `rows`, and which element of `rows` each belongs to."""
+    starts = indptr[rows]
+    counts = indptr[rows + 1] - starts
+    owner = torch.repeat_interleave(torch.arange(len(rows), device=rows.device), counts)
+    offsets = torch.arange(len(owner), device=rows.device) - \
+        torch.repeat_interleave(torch.cumsum(counts, dim=0) - counts, counts)
+    return owner, torch.repeat_interleave(starts, counts) + offsets
+
+
+def _csr_transpose(indptr, indices, data, num_cols):
+    rows = torch.repeat_interleave(torch.arange(len(indptr) - 1, device=indptr.device), indptr[1:] - indptr[:-1])
+    order = torch.sort(indices, stable=True)[1]
+    t_indptr = torch.zeros(num_cols + 1, dtype=torch.long, device=indptr.device)
+    t_indptr[1:] = torch.cumsum(torch.bincount(indices, minlength=num_cols), dim=0)
+    return t_indptr, rows[order], data[order]
+
+
+def _min_sum(V, probes, W_t, num_cols):
+    """sum_k min(V[p, k], W[j, k]) for the probes p and the num_cols rows j of W,
+    with W given by its column index W_t."""
+    indptr, indices, data = V
+    t_indptr, t_indices, t_data = W_t
+    owner, entries = _csr_gather(indptr, probes)
+    pair_owner, pair_entries = _csr_gather(t_indptr, indices[entries])
+
+    temp_min = torch.zeros(len(probes) * num_cols, dtype=data.dtype, device=data.device)
+    temp_min.index_add_(0, owner[pair_owner] * num_cols + t_indices[pair_entries],
+                        torch.min(data[entries][pair_owner], t_data[pair_entries]))
+    return temp_min.reshape(len(probes), num_cols)
+
+
+@_timed('k_reciprocal_expansion')
+def _sparse_V(original_dist, initial_rank, k1, block_size):
+    all_num = original_dist.size(0)
+    rows, cols, weight = _V_entries(original_dist, initial_rank, k1, block_size)
+    return _csr_from_coo(rows, cols, weight, (all_num, all_num))
+
+
+@_timed('query_expansion')
+def _sparse_query_expansion(V, initial_rank, k2, block_size):
+    # rows of V_qe: mean of V over the k2 nearest rows
+    all_num = initial_rank.size(0)
+    step = max(1, block_size // k2)
+    indptr, blocks = [torch.zeros(1, dtype=torch.long, device=initial_rank.device)], []
+    for start in range(0, all_num, step):
+        neighbors = initial_rank[start:start + step, :k2]
+        owner, entries = _csr_gather(V[0], neighbors.reshape(-1))
+        block = _csr_from_coo(owner // neighbors.size(1), V[1][entries], V[2][entries] / neighbors.size(1),
+                              (neighbors.size(0), all_num))
+        indptr.append(block[0][1:] + indptr[-1][-1])
+        blocks.append(block)
+    return torch.cat(indptr), torch.cat([block[1] for block in blocks]), torch.cat([block[2] for block in blocks])
+
+
+@_timed('jaccard')
+def _sparse_final_dist(V, original_dist, query_num, lambda_value, block_size):
+    # inverted index: the gallery rows of V in compressed sparse column form
+    all_num = original_dist.size(0)
+    indptr, indices, data = V
+    gallery_start = int(indptr[query_num])
+    gallery_num = all_num - query_num
+    V_t = _csr_transpose(indptr[query_num:] - gallery_start, indices[gallery_start:], data[gallery_start:], all_num)
+    final_dist = torch.empty(query_num, gallery_num, dtype=torch.float32, device=original_dist.device)
+    probes = torch.arange(query_num, device=original_dist.device)
+    for start in range(0, query_num, block_size):
+        end = min(start + block_size, query_num)
+        temp_min = _min_sum(V, probes[start:end], V_t, gallery_num)
+        jaccard_dist = 1 - temp_min / (2. - temp_min)
+        final_dist[start:end] = jaccard_dist * (1 - lambda_value) + original_dist[start:end, query_num:] * lambda_value
+    return final_dist
+
+
+def _re_ranking_sparse(original_dist, initial_rank, query_num, k1, k2, lambda_value, block_size):
+    V = _sparse_V(original_dist, initial_rank, k1, block_size)
+    if k2 != 1:
+        V = _sparse_query_expansion(V, initial_rank, k2, block_size)
+    del initial_rank
+    return _sparse_final_dist(V, original_dist, query_num, lambda_value, block_size)
+
+
+def re_ranking_torch(qf, gf, k1=20, k2=6, lambda_value=0.3, block_size=1024, backend='dense'):
+    """Re-ranked [num_query, num_gallery] distance of query / gallery feature tensors,
+    on the device of the features."""
+    if backend not in ('dense', 'sparse'):
+        raise ValueError("backend should be 'dense' or 'sparse', but got {}".format(backend))
+
+    query_num = qf.size(0)
+    with torch.no_grad():
+        feats = torch.cat([qf, gf], dim=0).float()
+        original_dist, initial_rank = _normalized_distance(feats, max(k1 + 1, k2), block_size)
+        del feats
+        if backend == 'sparse':
+            return _re_ranking_sparse(original_dist, initial_rank, query_num, k1, k2, lambda_value, block_size)
+        return _re_ranking_dense(original_dist, initial_rank, query_num, k1, k2, lambda_value, block_size)
@@ -0,0 +1,8 @@
+# encoding: utf-8
+
+from .hashing import BinaryHash, hamming
+from .ivf import IVFIndex, kmeans
+from .pca import PCA
+from .pq import PQCodec
+from .ranking import recall_at_k, top_k
+from .search import DTYPES as search_dtypes, nearest, search, two_stage_search
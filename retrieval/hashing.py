@@ -0,0 +1,158 @@
+# encoding: utf-8
+"""
+Binary hash codes of features, searched by Hamming distance.
+
+The centered features are projected onto their `num_bits` leading principal
+components and rotated by an orthogonal matrix learned with iterative
+quantization (ITQ, Gong & Lazebnik), which minimizes the loss of taking the
+sign. A code is the sign bits packed into num_bits / 64 uint64 words, so
+the Hamming distance to every gallery image costs a few XORs and popcounts.
+
+The Hamming nearest shortlist of a query is re-scored exactly with the full
+features, which, as for PQCodec, may stay memory-mapped on disk.
+"""
+from __future__ import absolute_import
+from __future__ import division
+
+import numpy as np
+import torch
+
+from .pca import PCA
+from .pq import _exact_distances
+from .ranking import top_k
+
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def _popcount(words):
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+    # numpy < 2.0
+    return _POPCOUNT_TABLE[words.view(np.uint8)].reshape(words.shape + (-1,)).sum(axis=-1, dtype=np.uint8)
+
+
+def hamming(a, b, out=None, block_size=1024):
+    """Hamming distances [len(a), len(b)] between packed codes, into `out` if given.
+
+    Computed over blocks of b with reused buffers that stay in cache.
+    """
+    if out is None:
+        out = np.empty((len(a), len(b)), dtype=np.int32)
+    words = np.empty((len(a), min(block_size, len(b))), dtype=np.uint64)
+    counts = np.empty(words.shape, dtype=np.int32)
+    for start in range(0, len(b), block_size):
+        end = min(start + block_size, len(b))
+        block_words, block_counts = words[:, :end - start], counts[:, :end - start]
+        block_counts[:] = 0
+        for word in range(a.shape[1]):
+            np.bitwise_xor(a[:, word, None], b[None, start:end, word], out=block_words)
+            block_counts += _popcount(block_words)
+        out[:, start:end] = block_counts
+    return out
+
+
+class BinaryHash(object):
+    """ITQ hashing of features into num_bits-bit codes.
+
+    num_bits: code length, a multiple of 64 and at most the feature dim
+    """
+
+    def __init__(self, num_bits=256, num_iters=50, max_samples=100000, block_size=1024, seed=0):
+        if num_bits % 64:
+            raise ValueError('num_bits should be a multiple of 64, but got {}'.format(num_bits))
+        self.num_bits = num_bits
+        self.num_iters = num_iters
+        self.max_samples = max_samples
+        self.block_size = block_size
+        self.seed = seed
+        self.mean = None
+        self.projection = None
+
+    def train(self, feats):
+        feats = np.asarray(feats, dtype=np.float32)
+        if self.num_bits > feats.shape[1]:
+            raise ValueError('num_bits {} exceeds the feature dim {}'.format(self.num_bits, feats.shape[1]))
+        rng = np.random.RandomState(self.seed)
+        if len(feats) > self.max_samples:
+            feats = feats[np.sort(rng.choice(len(feats), self.max_samples, replace=False))]
+        pca = PCA().fit(torch.from_numpy(feats))
+        self.mean = pca.mean.numpy()
+        components = pca.components[:self.num_bits].numpy()
+        v = np.dot(feats - self.mean, components.T)
+        rotation = np.linalg.qr(rng.randn(self.num_bits, self.num_bits))[0]
+        for _ in range(self.num_iters):
+            # fix the codes, then the rotation that best maps v onto them (orthogonal Procrustes)
+            codes = np.sign(np.dot(v, rotation))
+            u, _, vt = np.linalg.svd(np.dot(v.T, codes))
+            rotation = np.dot(u, vt)
+        # one matrix from centered feature to the pre-sign code
+        self.projection = np.dot(components.T, rotation).astype(np.float32)
+        return self
+
+    def encode(self, feats):
+        """Packed codes [N, num_bits / 64] uint64 of feats."""
+        codes = np.empty((len(feats), self.num_bits // 64), dtype=np.uint64)
+        for start in range(0, len(feats), self.block_size):
+            block = np.asarray(feats[start:start + self.block_size], dtype=np.float32)
+            bits = np.dot(block - self.mean, self.projection) > 0
+            codes[start:start + len(block)] = np.packbits(bits, axis=1).view('>u8').astype(np.uint64)
+        return codes
+
+    def search(self, codes, x, k, feats=None, shortlist=1000, max_elements=1 << 26):
+        """Distances and indices of the k nearest codes of every row of x, nearest first,
+        ties by index.
+
+        Without feats the distances are Hamming distances. With feats (the features
+        the codes were encoded from, e.g. a memmap) the `shortlist` Hamming nearest
+        codes of a query are re-scored exactly, distances are squared euclidean.
+        Queries are searched in blocks whose [block, len(codes)] distances hold at
+        most max_elements entries.
+        """
+        x = np.asarray(x, dtype=np.float32)
+        k = min(k, len(codes))
+        num_candidates = min(max(k, shortlist), len(codes)) if feats is not None else k
+        dist = np.empty((len(x), k), dtype=np.float32)
+        index = np.empty((len(x), k), dtype=np.int64)
+        block_size = max(1, min(self.block_size, max_elements // max(1, len(codes))))
+        for start in range(0, len(x), block_size):
+            block = x[start:start + block_size]
+            cand_dist, cand_index = self._hamming_nearest(self.encode(block), codes, num_candidates)
+            if feats is not None:
+                cand_dist = _exact_distances(block, feats, cand_index)
+                top = top_k(cand_dist, k)
+                cand_dist = np.take_along_axis(cand_dist, top, axis=1)
+                cand_index = np.take_along_axis(cand_index, top, axis=1)
+            dist[start:start + len(block)] = cand_dist
+            index[start:start + len(block)] = cand_index
+        return dist, index
+
+    def _hamming_nearest(self, query_codes, codes, num_candidates):
+        """(distances, indices) of the num_candidates Hamming nearest codes of every query,
+        nearest first, ties by index.
+
+        Distances are small integers, so dist * len(codes) + index is a unique key
+        with the same order: one argpartition selects the candidates, no ties to resolve.
+        """
+        num_codes = len(codes)
+        dtype = np.uint32 if (self.num_bits + 1) * num_codes < 1 << 32 else np.uint64
+        keys = hamming(query_codes, codes, out=np.empty((len(query_codes), num_codes), dtype=dtype))
+        keys *= num_codes
+        keys += np.arange(num_codes, dtype=dtype)
+        if num_candidates < num_codes:
+            keys = np.take_along_axis(keys, np.argpartition(keys, num_candidates - 1, axis=1)[:, :num_candidates],
+                                      axis=1)
+        keys.sort(axis=1)
+        return (keys // num_codes).astype(np.float32), (keys % num_codes).astype(np.int64)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(f, mean=self.mean, projection=self.projection, num_iters=self.num_iters,
+                     max_samples=self.max_samples, seed=self.seed)
+
+    @classmethod
+    def load(cls, path, block_size=1024):
+        with np.load(path) as data:
+            codec = cls(num_bits=data['projection'].shape[1], num_iters=int(data['num_iters']),
+                        max_samples=int(data['max_samples']), block_size=block_size, seed=int(data['seed']))
+            codec.mean, codec.projection = data['mean'], data['projection']
+        return codec
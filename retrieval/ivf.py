@@ -0,0 +1,162 @@
+# encoding: utf-8
+"""
+Inverted-file (IVF) index for approximate nearest neighbor search on features.
+
+The features are clustered with k-means into `num_lists` inverted lists; a query
+only computes exact squared euclidean distances to the members of its
+`num_probes` nearest lists. With num_lists ~ sqrt(N) the cost of a search is
+about num_probes * N / num_lists distances per query instead of N.
+
+An index is saved to / loaded from a single .npz file holding the indexed
+features, so a gallery only has to be clustered once.
+"""
+from __future__ import absolute_import
+from __future__ import division
+
+import numpy as np
+
+
+def _top_k(dist, k):
+    """Column positions of the k smallest entries of every row, smallest first."""
+    k = min(k, dist.shape[1])
+    if k < dist.shape[1]:
+        index = np.argpartition(dist, k - 1, axis=1)[:, :k]
+    else:
+        index = np.tile(np.arange(dist.shape[1]), (dist.shape[0], 1))
+    order = np.argsort(np.take_along_axis(dist, index, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(index, order, axis=1)
+
+
+def _sq_dist(x, x_sq_norms, y, y_sq_norms):
+    dist = np.dot(x, y.T)
+    dist *= -2
+    dist += x_sq_norms[:, None]
+    dist += y_sq_norms[None, :]
+    np.maximum(dist, 0, out=dist)
+    return dist
+
+
+def kmeans(feats, num_clusters, num_iters=10, max_samples=None, block_size=4096, seed=0):
+    """Lloyd's k-means on (a sample of) `feats`, returns the [num_clusters, dim] centroids."""
+    rng = np.random.RandomState(seed)
+    if max_samples is not None and len(feats) > max_samples:
+        feats = feats[np.sort(rng.choice(len(feats), max_samples, replace=False))]
+    feats = np.asarray(feats, dtype=np.float32)
+    sq_norms = np.sum(feats ** 2, axis=1)
+    centroids = feats[rng.choice(len(feats), num_clusters, replace=False)].copy()
+    for _ in range(num_iters):
+        assign = np.concatenate([
+            np.argmin(_sq_dist(feats[start:start + block_size], sq_norms[start:start + block_size],
+                               centroids, np.sum(centroids ** 2, axis=1)), axis=1)
+            for start in range(0, len(feats), block_size)])
+        counts = np.bincount(assign, minlength=num_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, feats)
+        # empty clusters keep their previous centroid
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+    return centroids
+
+
+class IVFIndex(object):
+    """k-means inverted-file index over a fixed set of features.
+
+    num_lists: number of k-means clusters, sqrt(N) by default
+    num_probes: lists visited per query, more probes = higher recall, slower search
+    """
+
+    def __init__(self, num_lists=None, num_probes=8, num_iters=10, block_size=1024, seed=0):
+        self.num_lists = num_lists
+        self.num_probes = num_probes
+        self.num_iters = num_iters
+        self.block_size = block_size
+        self.seed = seed
+        self.feats = None
+
+    _ARRAYS = ('feats', 'sq_norms', 'centroids', 'list_index', 'list_ptr')
+
+    def __len__(self):
+        return 0 if self.feats is None else self.feats.shape[0]
+
+    def build(self, feats):
+        self.feats = np.ascontiguousarray(feats, dtype=np.float32)
+        self.sq_norms = np.sum(self.feats ** 2, axis=1)
+        num_lists = self.num_lists or int(np.ceil(np.sqrt(len(self))))
+        num_lists = max(1, min(num_lists, len(self)))
+        self.centroids = kmeans(self.feats, num_lists, num_iters=self.num_iters,
+                                max_samples=256 * num_lists, seed=self.seed)
+        assign = np.concatenate([np.argmin(self._centroid_dist(start, start + self.block_size), axis=1)
+                                 for start in range(0, len(self), self.block_size)])
+        # members of list l are list_index[list_ptr[l]:list_ptr[l + 1]]
+        self.list_index = np.argsort(assign, kind='stable').astype(np.int64)
+        self.list_ptr = np.zeros(num_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assign, minlength=num_lists), out=self.list_ptr[1:])
+        return self
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(f, num_probes=self.num_probes, num_iters=self.num_iters, seed=self.seed,
+                     **{name: getattr(self, name) for name in self._ARRAYS})
+
+    @classmethod
+    def load(cls, path, block_size=1024):
+        with np.load(path) as data:
+            index = cls(num_lists=len(data['centroids']), num_probes=int(data['num_probes']),
+                        num_iters=int(data['num_iters']), block_size=block_size, seed=int(data['seed']))
+            for name in cls._ARRAYS:
+                setattr(index, name, data[name])
+        return index
+
+    def search(self, x, k, num_probes=None, mask=None):
+        """Squared distances and indices of the k (approximate) nearest indexed
+        features of every row of x, nearest first.
+
+        mask: optional boolean array over the indexed features, only the True
+        ones are returned. Rows that see fewer than k candidates in their probed
+        lists fall back to exact search.
+        """
+        x = np.asarray(x, dtype=np.float32)
+        x_sq_norms = np.sum(x ** 2, axis=1)
+        num_probes = min(num_probes or self.num_probes, len(self.centroids))
+        centroid_sq_norms = np.sum(self.centroids ** 2, axis=1)
+        probes = np.concatenate([
+            _top_k(_sq_dist(x[start:start + self.block_size], x_sq_norms[start:start + self.block_size],
+                            self.centroids, centroid_sq_norms), num_probes)
+            for start in range(0, len(x), self.block_size)])
+
+        dist = np.full((len(x), k), np.inf, dtype=np.float32)
+        index = np.full((len(x), k), -1, dtype=np.int64)
+        # visit list by list, merging its members into the running top-k of the rows probing it
+        order = np.argsort(probes.ravel(), kind='stable')
+        probe_ptr = np.zeros(len(self.centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(probes.ravel(), minlength=len(self.centroids)), out=probe_ptr[1:])
+        for l in range(len(self.centroids)):
+            members = self.list_index[self.list_ptr[l]:self.list_ptr[l + 1]]
+            if mask is not None:
+                members = members[mask[members]]
+            rows = order[probe_ptr[l]:probe_ptr[l + 1]] // num_probes
+            if len(members) == 0 or len(rows) == 0:
+                continue
+            for start in range(0, len(rows), self.block_size):
+                self._merge(dist, index, rows[start:start + self.block_size], x, x_sq_norms, members)
+
+        missing = np.nonzero(index[:, -1] < 0)[0]
+        if len(missing):
+            members = np.arange(len(self)) if mask is None else np.nonzero(mask)[0]
+            for start in range(0, len(missing), self.block_size):
+                rows = missing[start:start + self.block_size]
+                dist[rows], index[rows] = np.inf, -1
+                self._merge(dist, index, rows, x, x_sq_norms, members)
+        return dist, index
+
+    def _centroid_dist(self, start, end):
+        return _sq_dist(self.feats[start:end], self.sq_norms[start:end],
+                        self.centroids, np.sum(self.centroids ** 2, axis=1))
+
+    def _merge(self, dist, index, rows, x, x_sq_norms, members):
+        member_dist = _sq_dist(x[rows], x_sq_norms[rows], self.feats[members], self.sq_norms[members])
+        candidate_dist = np.concatenate([dist[rows], member_dist], axis=1)
+        candidate_index = np.concatenate([index[rows], np.tile(members, (len(rows), 1))], axis=1)
+        top = _top_k(candidate_dist, dist.shape[1])
+        dist[rows] = np.take_along_axis(candidate_dist, top, axis=1)
+        index[rows] = np.take_along_axis(candidate_index, top, axis=1)
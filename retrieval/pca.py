@@ -0,0 +1,72 @@
+# encoding: utf-8
+"""
+PCA projection of features, optionally whitened.
+
+The mean and covariance are accumulated batch by batch (partial_fit), so the
+training-set features never have to be held in memory. The full eigen
+decomposition is kept, the output dim and whitening are chosen when
+projecting.
+"""
+from __future__ import absolute_import
+from __future__ import division
+
+import torch
+
+
+class PCA(object):
+
+    def __init__(self, eps=1e-5):
+        self.eps = eps
+        self.count = 0
+        self._sum = None
+        self._outer = None
+        self.mean = None
+        self.components = None
+        self.eigenvalues = None
+
+    @property
+    def dim(self):
+        return self.components.size(1)
+
+    def partial_fit(self, feats):
+        feats = feats.double()
+        if self._sum is None:
+            self._sum = torch.zeros(feats.size(1), dtype=torch.float64)
+            self._outer = torch.zeros((feats.size(1), feats.size(1)), dtype=torch.float64)
+        self.count += feats.size(0)
+        self._sum += feats.sum(dim=0)
+        self._outer.addmm_(feats.t(), feats)
+        return self
+
+    def fit(self, feats=None):
+        """Fits on feats, or on what partial_fit accumulated."""
+        if feats is not None:
+            self.partial_fit(feats)
+        mean = self._sum / self.count
+        covariance = self._outer / self.count - torch.outer(mean, mean)
+        eigenvalues, components = torch.linalg.eigh(covariance)
+        # largest variance first
+        self.eigenvalues = eigenvalues.flip(0).clamp(min=0).float()
+        self.components = components.flip(1).t().float()
+        self.mean = mean.float()
+        self._sum, self._outer = None, None
+        return self
+
+    def transform(self, feats, dim=None, whiten=False):
+        """[N, dim] projection of feats onto the `dim` leading components."""
+        components = self.components[:dim or self.dim]
+        if whiten:
+            components = components / torch.sqrt(self.eigenvalues[:len(components), None] + self.eps)
+        return torch.mm(feats - self.mean, components.t())
+
+    def explained_variance(self, dim):
+        return float(self.eigenvalues[:dim].sum() / self.eigenvalues.sum())
+
+    def state_dict(self):
+        return {'mean': self.mean, 'components': self.components, 'eigenvalues': self.eigenvalues, 'eps': self.eps}
+
+    @classmethod
+    def from_state_dict(cls, state):
+        pca = cls(eps=state['eps'])
+        pca.mean, pca.components, pca.eigenvalues = state['mean'], state['components'], state['eigenvalues']
+        return pca
@@ -0,0 +1,152 @@
+# encoding: utf-8
+"""
+Product quantization of features, searched with asymmetric distances.
+
+A D-dim feature is cut into `num_subspaces` sub-vectors, each replaced by the
+index of its nearest of `num_centroids` (<= 256) k-means centroids of that
+subspace, so an image takes num_subspaces bytes. A query is not quantized:
+its squared distances to every centroid of every subspace are tabulated once,
+and the distance to a code is the sum of num_subspaces table lookups
+(asymmetric distance computation, ADC).
+
+The ADC top candidates of a query can be re-scored exactly from the full
+features, which may stay on disk as a memmap; only the candidate rows are read.
+"""
+from __future__ import absolute_import
+from __future__ import division
+
+import numpy as np
+
+from .ivf import _sq_dist, kmeans
+from .ranking import top_k
+
+
+def _exact_distances(x, feats, cand_index, max_elements=1 << 24):
+    """Squared distances of every row of x to its candidate rows of feats."""
+    # one sorted read of the candidate rows, sequential for a memmap
+    rows, inverse = np.unique(cand_index, return_inverse=True)
+    cand_feats = np.asarray(feats[rows], dtype=np.float32)
+    cand_sq_norms = np.sum(cand_feats ** 2, axis=1)
+    inverse = inverse.reshape(cand_index.shape)
+    dist = np.empty(cand_index.shape, dtype=np.float32)
+    step = max(1, max_elements // (cand_index.shape[1] * cand_feats.shape[1]))
+    for start in range(0, len(x), step):
+        pos = inverse[start:start + step]
+        dot = np.einsum('bcd,bd->bc', cand_feats[pos], x[start:start + step])
+        dist[start:start + step] = cand_sq_norms[pos] - 2 * dot + np.sum(x[start:start + step] ** 2, axis=1)[:, None]
+    return dist
+
+
+class PQCodec(object):
+    """Product quantizer trained on a set of features.
+
+    num_subspaces: sub-vectors per feature = bytes per code, has to divide the feature dim
+    num_centroids: centroids per subspace, at most 256
+    """
+
+    def __init__(self, num_subspaces=64, num_centroids=256, num_iters=10, block_size=1024, seed=0):
+        if num_centroids > 256:
+            raise ValueError('num_centroids should be at most 256, but got {}'.format(num_centroids))
+        self.num_subspaces = num_subspaces
+        self.num_centroids = num_centroids
+        self.num_iters = num_iters
+        self.block_size = block_size
+        self.seed = seed
+        self.centroids = None
+
+    @property
+    def dim(self):
+        return self.centroids.shape[0] * self.centroids.shape[2]
+
+    def train(self, feats):
+        feats = np.asarray(feats, dtype=np.float32)
+        if feats.shape[1] % self.num_subspaces:
+            raise ValueError('num_subspaces {} does not divide the feature dim {}'.format(
+                self.num_subspaces, feats.shape[1]))
+        sub_dim = feats.shape[1] // self.num_subspaces
+        self.centroids = np.stack([
+            kmeans(feats[:, m * sub_dim:(m + 1) * sub_dim], self.num_centroids, num_iters=self.num_iters,
+                   max_samples=256 * self.num_centroids, seed=self.seed + m)
+            for m in range(self.num_subspaces)])
+        return self
+
+    def encode(self, feats):
+        """uint8 codes [N, num_subspaces] of feats."""
+        self._check_dim(feats)
+        codes = np.empty((len(feats), self.num_subspaces), dtype=np.uint8)
+        sub_dim = self.centroids.shape[2]
+        centroid_sq_norms = np.sum(self.centroids ** 2, axis=2)
+        for start in range(0, len(feats), self.block_size):
+            block = np.asarray(feats[start:start + self.block_size], dtype=np.float32)
+            for m in range(self.num_subspaces):
+                sub = block[:, m * sub_dim:(m + 1) * sub_dim]
+                codes[start:start + len(block), m] = np.argmin(
+                    _sq_dist(sub, np.sum(sub ** 2, axis=1), self.centroids[m], centroid_sq_norms[m]), axis=1)
+        return codes
+
+    def decode(self, codes):
+        return self.centroids[np.arange(self.num_subspaces), codes].reshape(len(codes), self.dim)
+
+    def distances(self, codes, x):
+        """Asymmetric squared distances [len(x), len(codes)] between the rows of x and the codes."""
+        x = np.asarray(x, dtype=np.float32)
+        self._check_dim(x)
+        sub = x.reshape(len(x), self.num_subspaces, -1)
+        # tables[m, c, b]: squared distance of sub-vector m of x[b] to centroid c of subspace m,
+        # laid out so that every lookup copies one contiguous row
+        tables = np.einsum('bmd,mcd->mcb', sub, self.centroids)
+        tables *= -2
+        tables += np.sum(sub ** 2, axis=2).T[:, None, :]
+        tables += np.sum(self.centroids ** 2, axis=2)[:, :, None]
+        codes = codes.T.astype(np.intp)
+        dist = np.zeros((len(codes[0]), len(x)), dtype=np.float32)
+        for m in range(self.num_subspaces):
+            dist += tables[m][codes[m]]
+        return np.ascontiguousarray(dist.T)
+
+    def search(self, codes, x, k, feats=None, rescore=10, gallery_block_size=65536):
+        """Squared distances and indices of the k nearest codes of every row of x, nearest first.
+
+        feats: the full features the codes were encoded from (e.g. a memmap); if given,
+        the k * rescore ADC nearest codes of a query are re-scored exactly with them.
+        """
+        x = np.asarray(x, dtype=np.float32)
+        k = min(k, len(codes))
+        num_candidates = min(k * rescore, len(codes)) if feats is not None else k
+        dist = np.empty((len(x), k), dtype=np.float32)
+        index = np.empty((len(x), k), dtype=np.int64)
+        for start in range(0, len(x), self.block_size):
+            block = x[start:start + self.block_size]
+            # running top candidates over gallery blocks
+            cand_dist = np.empty((len(block), 0), dtype=np.float32)
+            cand_index = np.empty((len(block), 0), dtype=np.int64)
+            for g_start in range(0, len(codes), gallery_block_size):
+                block_dist = self.distances(codes[g_start:g_start + gallery_block_size], block)
+                cand_dist = np.concatenate([cand_dist, block_dist], axis=1)
+                columns = np.arange(g_start, g_start + block_dist.shape[1])
+                cand_index = np.concatenate([cand_index, np.broadcast_to(columns, block_dist.shape)], axis=1)
+                top = top_k(cand_dist, num_candidates)
+                cand_dist = np.take_along_axis(cand_dist, top, axis=1)
+                cand_index = np.take_along_axis(cand_index, top, axis=1)
+            if feats is not None:
+                cand_dist = _exact_distances(block, feats, cand_index)
+            top = top_k(cand_dist, k)
+            dist[start:start + len(block)] = np.take_along_axis(cand_dist, top, axis=1)
+            index[start:start + len(block)] = np.take_along_axis(cand_index, top, axis=1)
+        return dist, index
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(f, centroids=self.centroids, num_iters=self.num_iters, seed=self.seed)
+
+    @classmethod
+    def load(cls, path, block_size=1024):
+        with np.load(path) as data:
+            codec = cls(num_subspaces=data['centroids'].shape[0], num_centroids=data['centroids'].shape[1],
+                        num_iters=int(data['num_iters']), block_size=block_size, seed=int(data['seed']))
+            codec.centroids = data['centroids']
+        return codec
+
+    def _check_dim(self, feats):
+        if feats.shape[1] != self.dim:
+            raise ValueError('the codec was trained on {}-dim features, but got {}'.format(self.dim, feats.shape[1]))
@@ -0,0 +1,47 @@
+# encoding: utf-8
+"""
+Top-k ranking of distance matrices.
+
+Equal distances are ranked by column index, so the result does not depend on
+how numpy's partition happens to split ties.
+"""
+from __future__ import absolute_import
+from __future__ import division
+
+import numpy as np
+
+
+def _top_k_block(dist, k):
+    if k == dist.shape[1]:
+        return np.argsort(dist, axis=1, kind='stable')
+    index = np.argpartition(dist, k - 1, axis=1)[:, :k]
+    kth = np.take_along_axis(dist, index, axis=1).max(axis=1, keepdims=True)
+    # rows where the partition had to choose among entries tied with the k-th one
+    spilled = np.flatnonzero((dist <= kth).sum(axis=1) > k)
+    if len(spilled):
+        # keep everything below the k-th distance and the lowest-index ties of it
+        rows, kth = dist[spilled], kth[spilled]
+        tied = rows == kth
+        below = rows < kth
+        keep = below | (tied & (np.cumsum(tied, axis=1) <= k - below.sum(axis=1, keepdims=True)))
+        index[spilled] = np.nonzero(keep)[1].reshape(len(spilled), k)
+    index.sort(axis=1)
+    order = np.argsort(np.take_along_axis(dist, index, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(index, order, axis=1)
+
+
+def top_k(dist, k, block_size=1024):
+    """Column indices of the k smallest entries of every row of `dist`, smallest first,
+    computed over blocks of `block_size` rows."""
+    k = min(k, dist.shape[1])
+    index = np.empty((dist.shape[0], k), dtype=np.int64)
+    for start in range(0, dist.shape[0], block_size):
+        index[start:start + block_size] = _top_k_block(np.asarray(dist[start:start + block_size]), k)
+    return index
+
+
+def recall_at_k(index, exact_index, k):
+    """Mean fraction of the exact top-k columns of a row (exact_index) that are also
+    in its approximate top-k (index)."""
+    hits = (index[:, :k, None] == exact_index[:, None, :k]).any(axis=2)
+    return hits.sum(axis=1).mean() / k
@@ -0,0 +1,126 @@
+# encoding: utf-8
+"""
+Blocked exact k-nearest-neighbor search between query and gallery features.
+
+Gallery blocks are streamed through one GEMM each and merged into a running
+top-k per query, so memory is O(Q * k + query_block * gallery_block) instead of
+the O(Q * G) of a full distance matrix. Distances are squared euclidean, as in
+Evaluator.
+
+With a reduced precision dtype (float16 / bfloat16) the GEMMs only pick
+k * rescore candidates per query, which are then re-scored in the precision of
+the features.
+
+two_stage_search ranks the gallery on a subset of the feature columns (e.g.
+the global branches of MGN) and re-scores a shortlist with the full features.
+"""
+from __future__ import absolute_import
+from __future__ import division
+
+import torch
+
+DTYPES = {'float32': None, 'float16': torch.float16, 'bfloat16': torch.bfloat16}
+
+
+def _order(values, indices):
+    # ascending value, ties by gallery index
+    by_index = torch.sort(indices, dim=1)[1]
+    values, indices = values.gather(1, by_index), indices.gather(1, by_index)
+    order = torch.sort(values, dim=1, stable=True)[1]
+    return values.gather(1, order), indices.gather(1, order)
+
+
+def _top_k(values, indices, k):
+    """The k smallest values of every row with their indices, ties at the k-th value
+    resolved by index. Not ordered."""
+    if values.size(1) <= k:
+        return values, indices
+    top_values, pos = torch.topk(values, k + 1, dim=1, largest=False)
+    pos = pos[:, :k]
+    # rows where topk had to choose among values tied with the k-th one
+    for row in (top_values[:, k - 1] == top_values[:, k]).nonzero()[:, 0].tolist():
+        by_index = torch.sort(indices[row])[1]
+        pos[row] = by_index[torch.sort(values[row, by_index], stable=True)[1][:k]]
+    return values.gather(1, pos), indices.gather(1, pos)
+
+
+def nearest(dist, k):
+    """(distances, indices) of the k smallest entries of every row of `dist`, ascending,
+    ties by column index."""
+    k = min(k, dist.size(1))
+    return _order(*_top_k(dist, torch.arange(dist.size(1), device=dist.device).expand_as(dist), k))
+
+
+def _rescore(qf, gf, g_sq_norms, indices, metric, max_elements=1 << 24):
+    scores = torch.empty(indices.size(), dtype=qf.dtype, device=qf.device)
+    step = max(1, max_elements // (indices.size(1) * gf.size(1)))
+    # the gathered candidate rows of a step are written into one reused buffer
+    buffer = torch.empty((min(step, qf.size(0)) * indices.size(1), gf.size(1)), dtype=gf.dtype, device=gf.device)
+    for start in range(0, qf.size(0), step):
+        rows = indices[start:start + step]
+        candidates = buffer[:rows.numel()].view(rows.size(0), rows.size(1), -1)
+        torch.index_select(gf, 0, rows.reshape(-1), out=candidates.view(rows.numel(), -1))
+        dot = torch.bmm(candidates, qf[start:start + step].unsqueeze(2)).squeeze(2)
+        scores[start:start + step] = -2 * dot if metric == 'cosine' else g_sq_norms[rows] - 2 * dot
+    return scores
+
+
+def search(qf, gf, k, metric='euclidean', dtype='float32', rescore=4,
+           query_block_size=1024, gallery_block_size=4096):
+    """(distances, indices) [Q, k] of the k nearest gallery features of every query, nearest first.
+
+    metric: 'euclidean', or 'cosine' for L2-normalized features, which skips the norms.
+    dtype: precision of the GEMMs, 'float32', 'float16' or 'bfloat16'.
+    """
+    if metric not in ('euclidean', 'cosine'):
+        raise ValueError("metric should be 'euclidean' or 'cosine', but got {}".format(metric))
+    if dtype not in DTYPES:
+        raise ValueError('dtype should be one of {}, but got {}'.format(list(DTYPES), dtype))
+    k = min(k, gf.size(0))
+    num_candidates = min(k * rescore, gf.size(0)) if DTYPES[dtype] is not None else k
+    g_sq_norms = torch.pow(gf, 2).sum(dim=1)
+    g_low = gf.to(DTYPES[dtype]) if DTYPES[dtype] is not None else gf
+
+    distances = torch.empty((qf.size(0), k), dtype=qf.dtype, device=qf.device)
+    indices = torch.empty((qf.size(0), k), dtype=torch.long, device=qf.device)
+    for q_start in range(0, qf.size(0), query_block_size):
+        q_block = qf[q_start:q_start + query_block_size]
+        q_low = q_block.to(g_low.dtype)
+        values = torch.empty((q_block.size(0), 0), dtype=qf.dtype, device=qf.device)
+        block_indices = torch.empty((q_block.size(0), 0), dtype=torch.long, device=qf.device)
+        for g_start in range(0, gf.size(0), gallery_block_size):
+            # the squared norm of the query is the same for the whole row, added at the end
+            scores = torch.mm(q_low, g_low[g_start:g_start + gallery_block_size].t()).to(qf.dtype)
+            scores *= -2
+            if metric == 'euclidean':
+                scores += g_sq_norms[g_start:g_start + gallery_block_size]
+            columns = torch.arange(g_start, g_start + scores.size(1), device=qf.device).expand_as(scores)
+            values, block_indices = _top_k(torch.cat([values, scores], 1),
+                                           torch.cat([block_indices, columns], 1), num_candidates)
+        if num_candidates > k:
+            values = _rescore(q_block, gf, g_sq_norms, block_indices, metric)
+            values, block_indices = _top_k(values, block_indices, k)
+        values, block_indices = _order(values, block_indices)
+
+        # |q|^2 + |g|^2 = 2 for L2-normalized features
+        offset = 2 if metric == 'cosine' else torch.pow(q_block, 2).sum(dim=1, keepdim=True)
+        distances[q_start:q_start + query_block_size] = values + offset
+        indices[q_start:q_start + query_block_size] = block_indices
+    return distances, indices
+
+
+def two_stage_search(qf, gf, k, columns, shortlist=1000, metric='euclidean', dtype='float32'):
+    """(distances, indices) [Q, k] like search, the gallery is ranked on `columns`
+    of the features first and only the `shortlist` nearest of a query are
+    re-scored with all of them."""
+    if metric not in ('euclidean', 'cosine'):
+        raise ValueError("metric should be 'euclidean' or 'cosine', but got {}".format(metric))
+    columns = torch.as_tensor(columns, dtype=torch.long, device=qf.device)
+    k = min(k, gf.size(0))
+    # a subset of the columns of normalized features is not normalized
+    _, candidates = search(qf.index_select(1, columns), gf.index_select(1, columns), max(k, shortlist),
+                           dtype=dtype)
+    g_sq_norms = torch.pow(gf, 2).sum(dim=1)
+    values, indices = _order(*_top_k(_rescore(qf, gf, g_sq_norms, candidates, metric), candidates, k))
+    offset = 2 if metric == 'cosine' else torch.pow(qf, 2).sum(dim=1, keepdim=True)
+    return values + offset, indices
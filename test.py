@@ -15,20 +15,62 @@ from torch.backends import cudnn
 from torch.utils.data import DataLoader
 from datasets.init_dataset import Tx_dataset
 from datasets.dataset_loader import ImageDataset
-from models import build_model
+from models import build_model, feature_columns
 from logger import Logger
-from transformer import build_transforms
+from transformer import build_tta_transforms
 from config import opt
 from evaluator import Evaluator
+from device import build_device
+from feature_cache import FeatureCache, MODEL_OPTIONS
+from retrieval import BinaryHash, PCA, PQCodec
 import json
 
+def _feature_cache(checkpoints):
+    # features are only reusable for a fixed checkpoint
+    if not opt.feature_cache or opt.pretrained_choice != 'self':
+        return None
+    return FeatureCache(opt.feature_cache, checkpoints, {name: getattr(opt, name) for name in MODEL_OPTIONS})
+
+def _pq_codec():
+    if not opt.pq_codec or not osp.exists(opt.pq_codec):
+        return None
+    return PQCodec.load(opt.pq_codec)
+
+def _projection():
+    if not opt.projection_dim:
+        return None
+    path = opt.projection or osp.join(opt.save_dir, 'projection.pth')
+    if not osp.exists(path):
+        raise ValueError('{} does not exist, fit a projection with test.fit_projection'.format(path))
+    return PCA.from_state_dict(torch.load(path, map_location='cpu'))
+
+def _hash_codec():
+    if not opt.hash_codec or not osp.exists(opt.hash_codec):
+        return None
+    return BinaryHash.load(opt.hash_codec)
+
+def _stage_one_columns(model):
+    if opt.ranking_backend != 'two_stage':
+        return None
+    # unwrap DataParallel
+    return feature_columns(getattr(model, 'module', model), opt.stage_one_slices)
+
+def _rerank_sweep(reid_evaluator, queryloader, galleryloader, features):
+    results = reid_evaluator.rerank_sweep(queryloader, galleryloader, k1s=opt.rerank_k1s, k2s=opt.rerank_k2s,
+                                          lambda_values=opt.rerank_lambdas, grid_workers=opt.rerank_grid_workers,
+                                          output=osp.join(opt.save_dir, 'rerank_sweep.json'), features=features)
+    best = max(results, key=lambda result: result['score'])
+    print("max_score: {score} at k1: {k1} k2: {k2} lambda: {lambda_value}".format(**best))
+    return best
+
 def test(**kwargs):
     opt._parse(kwargs)
 
     # set random seed and cudnn benchmark
     # torch.manual_seed(opt.seed)
     os.makedirs(opt.save_dir, exist_ok=True)
-    use_gpu = torch.cuda.is_available()
+    device = build_device(opt)
+    use_gpu = device.type == 'cuda'
     # sys.stdout = Logger(osp.join(opt.save_dir, 'log_train.txt'))
 
     print('=========user config==========')
@@ -40,7 +82,7 @@ def test(**kwargs):
         cudnn.benchmark = True
         torch.cuda.manual_seed_all(opt.seed)
     else:
-        print('currently using cpu')
+        print('currently using cpu, {} threads'.format(torch.get_num_threads()))
 
     print('initializing tx_chanllege dataset')
 
@@ -49,94 +91,23 @@ def test(**kwargs):
     gallery_dataset = Tx_dataset(set='gallery_a', file_list='gallery_a_list.txt').dataset
 
 
+    tta_transform = build_tta_transforms(opt, flip=opt.eval_flip, crop=opt.eval_flip and opt.crop_validation)
     queryloader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False)),
+        ImageDataset(query_dataset, transform=tta_transform),
         batch_size=opt.test_batch, num_workers=opt.workers,
         pin_memory=pin_memory)
 
     galleryloader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False)),
+        ImageDataset(gallery_dataset, transform=tta_transform),
         batch_size=opt.test_batch, num_workers=opt.workers,
         pin_memory=pin_memory)
 
-    queryFliploader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False, flip=True)),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    galleryFliploader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False, flip=True)),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    queryCenterloader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False, crop='center')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    galleryCenterloader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False, crop='center')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    queryLtloader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False, crop='lt')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    galleryLtloader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False, crop='lt')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    queryRtloader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False, crop='rt')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    galleryRtloader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False, crop='rt')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    queryRbloader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False, crop='rb')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    galleryRbloader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False, crop='rb')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    queryLbloader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False, crop='lb')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    galleryLbloader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False, crop='lb')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
     print('initializing model ...')
 
     model = build_model(opt)
 
     if opt.pretrained_choice == 'self':
-        state_dict = torch.load(opt.pretrained_model)['state_dict']
+        state_dict = torch.load(opt.pretrained_model, map_location='cpu')['state_dict']
         # state_dict = {k: v for k, v in state_dict.items() \
         #        if not ('reduction' in k or 'softmax' in k)}
         model.load_state_dict(state_dict, False)
@@ -145,15 +116,23 @@ def test(**kwargs):
 
     if use_gpu:
         model = nn.DataParallel(model).cuda()
-    reid_evaluator = Evaluator(model, norm=opt.norm, eval_flip=opt.eval_flip, re_ranking=opt.re_ranking, crop_validation=opt.crop_validation)
+    reid_evaluator = Evaluator(model, norm=opt.norm, eval_flip=opt.eval_flip, re_ranking=opt.re_ranking, crop_validation=opt.crop_validation,
+                               rerank_workers=opt.rerank_workers,
+                               rerank_approximate=opt.rerank_approximate, rerank_shortlist=opt.rerank_shortlist,
+                               ann_probes=opt.ann_probes, rerank_backend=opt.rerank_backend,
+                               rerank_torch_backend=opt.rerank_torch_backend,
+                               ranking_backend=opt.ranking_backend, ann_lists=opt.ann_lists or None,
+                               ann_index=opt.ann_index or None, pq_codec=_pq_codec(), pq_codes=opt.pq_codes or None,
+                               pq_rescore=opt.pq_rescore, hash_codec=_hash_codec(), hash_codes=opt.hash_codes or None,
+                               hash_shortlist=opt.hash_shortlist,
+                               stage_one_columns=_stage_one_columns(model), stage_one_shortlist=opt.stage_one_shortlist,
+                               projection=_projection(), projection_dim=opt.projection_dim or None,
+                               projection_whiten=opt.projection_whiten,
+                               stack_views=opt.stack_views, max_eval_batch=opt.max_eval_batch,
+                               prefetch=opt.prefetch, memmap_dir=opt.feature_memmap_dir or None, search_dtype=opt.search_dtype,
+                               device=device, feature_cache=_feature_cache([opt.pretrained_model]))
 
     results = reid_evaluator.evaluate(queryloader, galleryloader,
-                                      queryFliploader, galleryFliploader,
-                                      queryCenterloader, galleryCenterloader,
-                                      queryLtloader, galleryLtloader,
-                                      queryRtloader, galleryRtloader,
-                                      queryLbloader, galleryLbloader,
-                                      queryRbloader, galleryRbloader,
                                       k1=6, k2=2, lambda_value=0.3)
 
     # reid_evaluator.validation(queryloader, galleryloader)
@@ -167,7 +146,8 @@ def multi_test(**kwargs):
     # set random seed and cudnn benchmark
     # torch.manual_seed(opt.seed)
     os.makedirs(opt.save_dir, exist_ok=True)
-    use_gpu = torch.cuda.is_available()
+    device = build_device(opt)
+    use_gpu = device.type == 'cuda'
     # sys.stdout = Logger(osp.join(opt.save_dir, 'log_train.txt'))
 
     print('=========user config==========')
@@ -179,7 +159,7 @@ def multi_test(**kwargs):
         cudnn.benchmark = True
         torch.cuda.manual_seed_all(opt.seed)
     else:
-        print('currently using cpu')
+        print('currently using cpu, {} threads'.format(torch.get_num_threads()))
 
     print('initializing tx_chanllege dataset')
 
@@ -188,34 +168,23 @@ def multi_test(**kwargs):
     gallery_dataset = Tx_dataset(set='gallery_a', file_list='gallery_a_list.txt').dataset
 
 
+    tta_transform = build_tta_transforms(opt, flip=opt.eval_flip, crop=opt.eval_flip and opt.crop_validation)
     queryloader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False)),
+        ImageDataset(query_dataset, transform=tta_transform),
         batch_size=opt.test_batch, num_workers=opt.workers,
         pin_memory=pin_memory)
 
     galleryloader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False)),
+        ImageDataset(gallery_dataset, transform=tta_transform),
         batch_size=opt.test_batch, num_workers=opt.workers,
         pin_memory=pin_memory)
 
-    queryFliploader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False, flip=True)),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    galleryFliploader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False, flip=True)),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
     print('initializing model ...')
 
     model = build_model(opt)
 
     if opt.pretrained_choice == 'self':
-        state_dict = torch.load(opt.pretrained_model)['state_dict']
+        state_dict = torch.load(opt.pretrained_model, map_location='cpu')['state_dict']
         # state_dict = {k: v for k, v in state_dict.items() \
         #        if not ('reduction' in k or 'softmax' in k)}
         model.load_state_dict(state_dict, False)
@@ -225,9 +194,10 @@ def multi_test(**kwargs):
     # opt.model_name = "pcb"
 
     pcb_model = build_model(opt)
+    pcb_model_path = '/data/zhoumi/train_project/REID/tx_challenge/pytorch-ckpt/r50_ibn_a_bigsize_era/model_best.pth.tar'
 
     if opt.pretrained_choice == 'self':
-        state_dict = torch.load('/data/zhoumi/train_project/REID/tx_challenge/pytorch-ckpt/r50_ibn_a_bigsize_era/model_best.pth.tar')['state_dict']
+        state_dict = torch.load(pcb_model_path, map_location='cpu')['state_dict']
         # state_dict = {k: v for k, v in state_dict.items() \
         #        if not ('reduction' in k or 'softmax' in k)}
         pcb_model.load_state_dict(state_dict, False)
@@ -238,9 +208,21 @@ def multi_test(**kwargs):
         model = nn.DataParallel(model).cuda()
         pcb_model = nn.DataParallel(pcb_model).cuda()
 
-    reid_evaluator = Evaluator(model, pcb_model= pcb_model, norm=opt.norm, eval_flip=opt.eval_flip, re_ranking=opt.re_ranking, concate=True)
-
-    results = reid_evaluator.evaluate(queryloader, galleryloader, queryFliploader, galleryFliploader, k1=6, k2=2, lambda_value=0.3)
+    reid_evaluator = Evaluator(model, pcb_model= pcb_model, norm=opt.norm, eval_flip=opt.eval_flip, re_ranking=opt.re_ranking, concate=True,
+                               rerank_workers=opt.rerank_workers,
+                               rerank_approximate=opt.rerank_approximate, rerank_shortlist=opt.rerank_shortlist,
+                               ann_probes=opt.ann_probes, rerank_backend=opt.rerank_backend,
+                               rerank_torch_backend=opt.rerank_torch_backend,
+                               ranking_backend=opt.ranking_backend, ann_lists=opt.ann_lists or None,
+                               ann_index=opt.ann_index or None, pq_codec=_pq_codec(), pq_codes=opt.pq_codes or None,
+                               pq_rescore=opt.pq_rescore, hash_codec=_hash_codec(), hash_codes=opt.hash_codes or None,
+                               hash_shortlist=opt.hash_shortlist,
+                               stack_views=opt.stack_views, max_eval_batch=opt.max_eval_batch,
+                               prefetch=opt.prefetch, memmap_dir=opt.feature_memmap_dir or None, search_dtype=opt.search_dtype,
+                               device=device,
+                               feature_cache=_feature_cache([opt.pretrained_model, pcb_model_path]))
+
+    results = reid_evaluator.evaluate(queryloader, galleryloader, k1=6, k2=2, lambda_value=0.3)
 
     # reid_evaluator.validation(queryloader, galleryloader)
 
@@ -253,7 +235,8 @@ def validate(**kwargs):
     # set random seed and cudnn benchmark
     torch.manual_seed(opt.seed)
     # os.makedirs(opt.save_dir, exist_ok=True)
-    use_gpu = torch.cuda.is_available()
+    device = build_device(opt)
+    use_gpu = device.type == 'cuda'
     # sys.stdout = Logger(osp.join(opt.save_dir, 'log_train.txt'))
 
     print('=========user config==========')
@@ -265,7 +248,7 @@ def validate(**kwargs):
         cudnn.benchmark = True
         torch.cuda.manual_seed_all(opt.seed)
     else:
-        print('currently using cpu')
+        print('currently using cpu, {} threads'.format(torch.get_num_threads()))
 
     print('initializing tx_chanllege dataset')
 
@@ -274,95 +257,23 @@ def validate(**kwargs):
     gallery_dataset = Tx_dataset(set='train_set', file_list='val_gallery_list.txt').dataset
 
 
+    tta_transform = build_tta_transforms(opt, flip=opt.eval_flip, crop=opt.eval_flip and opt.crop_validation)
     queryloader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False)),
+        ImageDataset(query_dataset, transform=tta_transform),
         batch_size=opt.test_batch, num_workers=opt.workers,
         pin_memory=pin_memory)
 
     galleryloader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False)),
+        ImageDataset(gallery_dataset, transform=tta_transform),
         batch_size=opt.test_batch, num_workers=opt.workers,
         pin_memory=pin_memory)
 
-    queryFliploader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False, flip=True)),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    galleryFliploader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False, flip=True)),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    queryCenterloader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False, crop='center')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    galleryCenterloader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False, crop='center')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    queryLtloader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False, crop='lt')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    galleryLtloader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False, crop='lt')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    queryRtloader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False, crop='rt')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    galleryRtloader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False, crop='rt')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    queryRbloader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False, crop='rb')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    galleryRbloader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False, crop='rb')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    queryLbloader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False, crop='lb')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    galleryLbloader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False, crop='lb')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-
     print('initializing model ...')
 
     model = build_model(opt)
 
     if opt.pretrained_choice == 'self':
-        state_dict = torch.load(opt.pretrained_model)['state_dict']
+        state_dict = torch.load(opt.pretrained_model, map_location='cpu')['state_dict']
         # state_dict = {k: v for k, v in state_dict.items() \
         #        if not ('reduction' in k or 'softmax' in k)}
         model.load_state_dict(state_dict, False)
@@ -371,35 +282,49 @@ def validate(**kwargs):
 
     if use_gpu:
         model = nn.DataParallel(model).cuda()
-    reid_evaluator = Evaluator(model, norm=opt.norm, eval_flip=opt.eval_flip, crop_validation=opt.crop_validation)
-
+    reid_evaluator = Evaluator(model, norm=opt.norm, eval_flip=opt.eval_flip, crop_validation=opt.crop_validation,
+                               rerank_workers=opt.rerank_workers,
+                               rerank_approximate=opt.rerank_approximate, rerank_shortlist=opt.rerank_shortlist,
+                               ann_probes=opt.ann_probes, rerank_backend=opt.rerank_backend,
+                               rerank_torch_backend=opt.rerank_torch_backend,
+                               ranking_backend=opt.ranking_backend, ann_lists=opt.ann_lists or None,
+                               ann_index=opt.ann_index or None, pq_codec=_pq_codec(), pq_codes=opt.pq_codes or None,
+                               pq_rescore=opt.pq_rescore, hash_codec=_hash_codec(), hash_codes=opt.hash_codes or None,
+                               hash_shortlist=opt.hash_shortlist,
+                               stage_one_columns=_stage_one_columns(model), stage_one_shortlist=opt.stage_one_shortlist,
+                               projection=_projection(), projection_dim=opt.projection_dim or None,
+                               projection_whiten=opt.projection_whiten,
+                               stack_views=opt.stack_views, max_eval_batch=opt.max_eval_batch,
+                               prefetch=opt.prefetch, memmap_dir=opt.feature_memmap_dir or None, search_dtype=opt.search_dtype,
+                               device=device, feature_cache=_feature_cache([opt.pretrained_model]))
+
+    raw_features = reid_evaluator.validation_features(queryloader, galleryloader, project=False)
+    features = reid_evaluator.project_features(raw_features)
     print("without reranking testing......")
-    reid_evaluator.validation(queryloader, galleryloader,
-                              queryFliploader, galleryFliploader,
-                              queryCenterloader, galleryCenterloader,
-                              queryLtloader, galleryLtloader,
-                              queryRtloader, galleryRtloader,
-                              queryLbloader, galleryLbloader,
-                              queryRbloader, galleryRbloader)
-
-    max_score = 0
-    k = 0
-    for k1 in range(1, 21):
-    # for la in [0.1,0.2,0.3,0.4,0.5,0.6,0.7,0.8,0.9]:
-            print("**********k1:{}***********".format(k1))
-            score = reid_evaluator.validation(queryloader, galleryloader,
-                                              queryFliploader, galleryFliploader,
-                                              queryCenterloader, galleryCenterloader,
-                                              queryLtloader, galleryLtloader,
-                                              queryRtloader, galleryRtloader,
-                                              queryLbloader, galleryLbloader,
-                                              queryRbloader, galleryRbloader,
-                                              re_ranking=True, k1=k1, k2=2, lambda_value=0.3)
-            if score > max_score:
-                max_score = score
-                k = k1
-
-    print("max_score: {} at k: {}".format(max_score, k))
+    reid_evaluator.validation(queryloader, galleryloader, features=features)
+
+    if reid_evaluator.projection is not None:
+        print("projection dims vs score......")
+        reid_evaluator.projection_report(queryloader, galleryloader, features=raw_features)
+
+    best = _rerank_sweep(reid_evaluator, queryloader, galleryloader, features)
+    k = best['k1']
+
+    if opt.ranking_backend == 'ivf':
+        print("ivf search vs exact......")
+        reid_evaluator.ann_report(queryloader, galleryloader, features=features)
+    if opt.ranking_backend == 'two_stage':
+        print("two-stage search vs exact......")
+        reid_evaluator.two_stage_report(queryloader, galleryloader, features=features)
+    if opt.ranking_backend == 'hash':
+        print("hamming prefilter vs exact......")
+        reid_evaluator.hash_report(queryloader, galleryloader, features=features)
+
+    if opt.rerank_approximate:
+        print("approximate reranking vs exact......")
+        reid_evaluator.rerank_approximate_report(queryloader, galleryloader,
+                                                 k1=k, k2=best['k2'], lambda_value=best['lambda_value'],
+                                                 shortlists=[opt.rerank_shortlist], features=features)
 
 
     # with open('./result/submission_example_A.json', "w", encoding='utf-8') as fd:
@@ -411,7 +336,8 @@ def multi_validate(**kwargs):
     # set random seed and cudnn benchmark
     torch.manual_seed(opt.seed)
     # os.makedirs(opt.save_dir, exist_ok=True)
-    use_gpu = torch.cuda.is_available()
+    device = build_device(opt)
+    use_gpu = device.type == 'cuda'
     # sys.stdout = Logger(osp.join(opt.save_dir, 'log_train.txt'))
 
     print('=========user config==========')
@@ -423,7 +349,7 @@ def multi_validate(**kwargs):
         cudnn.benchmark = True
         torch.cuda.manual_seed_all(opt.seed)
     else:
-        print('currently using cpu')
+        print('currently using cpu, {} threads'.format(torch.get_num_threads()))
 
     print('initializing tx_chanllege dataset')
 
@@ -432,35 +358,24 @@ def multi_validate(**kwargs):
     gallery_dataset = Tx_dataset(set='train_set', file_list='val_gallery_list.txt').dataset
 
 
+    tta_transform = build_tta_transforms(opt, flip=opt.eval_flip, crop=opt.eval_flip and opt.crop_validation)
     queryloader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False)),
+        ImageDataset(query_dataset, transform=tta_transform),
         batch_size=opt.test_batch, num_workers=opt.workers,
         pin_memory=pin_memory)
 
     galleryloader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False)),
+        ImageDataset(gallery_dataset, transform=tta_transform),
         batch_size=opt.test_batch, num_workers=opt.workers,
         pin_memory=pin_memory)
 
-    queryFliploader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False, flip=True)),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    galleryFliploader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False, flip=True)),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
     models = []
     print('initializing model ...')
 
     model = build_model(opt)
 
     if opt.pretrained_choice == 'self':
-        state_dict = torch.load(opt.pretrained_model)['state_dict']
+        state_dict = torch.load(opt.pretrained_model, map_location='cpu')['state_dict']
         # state_dict = {k: v for k, v in state_dict.items() \
         #        if not ('reduction' in k or 'softmax' in k)}
         model.load_state_dict(state_dict, False)
@@ -492,7 +407,7 @@ def multi_validate(**kwargs):
 
             model = build_model(opt)
 
-            state_dict = torch.load(base_path + model_path)['state_dict']
+            state_dict = torch.load(base_path + model_path, map_location='cpu')['state_dict']
             # state_dict = {k: v for k, v in state_dict.items() \
             #        if not ('reduction' in k or 'softmax' in k)}
             model.load_state_dict(state_dict, False)
@@ -505,23 +420,24 @@ def multi_validate(**kwargs):
     if use_gpu:
         model = nn.DataParallel(model).cuda()
         pcb_model = nn.DataParallel(pcb_model).cuda()
-    reid_evaluator = Evaluator(model, pcb_model=pcb_model, norm=opt.norm, eval_flip=opt.eval_flip,concate=True)
-
+    reid_evaluator = Evaluator(model, pcb_model=pcb_model, norm=opt.norm, eval_flip=opt.eval_flip,concate=True,
+                               rerank_workers=opt.rerank_workers,
+                               rerank_approximate=opt.rerank_approximate, rerank_shortlist=opt.rerank_shortlist,
+                               ann_probes=opt.ann_probes, rerank_backend=opt.rerank_backend,
+                               rerank_torch_backend=opt.rerank_torch_backend,
+                               ranking_backend=opt.ranking_backend, ann_lists=opt.ann_lists or None,
+                               ann_index=opt.ann_index or None, pq_codec=_pq_codec(), pq_codes=opt.pq_codes or None,
+                               pq_rescore=opt.pq_rescore, hash_codec=_hash_codec(), hash_codes=opt.hash_codes or None,
+                               hash_shortlist=opt.hash_shortlist,
+                               stack_views=opt.stack_views, max_eval_batch=opt.max_eval_batch,
+                               prefetch=opt.prefetch, memmap_dir=opt.feature_memmap_dir or None, search_dtype=opt.search_dtype,
+                               device=device)
+
+    features = reid_evaluator.validation_features(queryloader, galleryloader)
     print("without reranking testing......")
-    reid_evaluator.validation(queryloader, galleryloader, queryFliploader, galleryFliploader)
+    reid_evaluator.validation(queryloader, galleryloader, features=features)
 
-    max_score = 0
-    k = 0
-    for k1 in range(1, 21):
-    # for la in [0.1,0.2,0.3,0.4,0.5,0.6,0.7,0.8,0.9]:
-            print("**********k1:{}***********".format(k1))
-            score = reid_evaluator.validation(queryloader, galleryloader, queryFliploader, galleryFliploader, re_ranking=True,
-                                              k1=k1, k2=2, lambda_value=0.3)
-            if score > max_score:
-                max_score = score
-                k = k1
-
-    print("max_score: {} at k: {}".format(max_score, k))
+    _rerank_sweep(reid_evaluator, queryloader, galleryloader, features)
 
 
     # with open('./result/submission_example_A.json', "w", encoding='utf-8') as fd:
@@ -533,7 +449,8 @@ def extract_features(**kwargs):
     # set random seed and cudnn benchmark
     # torch.manual_seed(opt.seed)
     os.makedirs(opt.save_dir, exist_ok=True)
-    use_gpu = torch.cuda.is_available()
+    device = build_device(opt)
+    use_gpu = device.type == 'cuda'
     # sys.stdout = Logger(osp.join(opt.save_dir, 'log_train.txt'))
 
     print('=========user config==========')
@@ -545,7 +462,7 @@ def extract_features(**kwargs):
         cudnn.benchmark = True
         torch.cuda.manual_seed_all(opt.seed)
     else:
-        print('currently using cpu')
+        print('currently using cpu, {} threads'.format(torch.get_num_threads()))
 
     print('initializing tx_chanllege dataset')
 
@@ -553,117 +470,163 @@ def extract_features(**kwargs):
     query_dataset = Tx_dataset(set='query_a', file_list='query_a_list.txt').dataset
     gallery_dataset = Tx_dataset(set='gallery_a', file_list='gallery_a_list.txt').dataset
 
+    tta_transform = build_tta_transforms(opt, flip=opt.eval_flip, crop=opt.eval_flip and opt.crop_validation)
     queryloader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False)),
+        ImageDataset(query_dataset, transform=tta_transform),
         batch_size=opt.test_batch, num_workers=opt.workers,
         pin_memory=pin_memory)
 
     galleryloader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False)),
+        ImageDataset(gallery_dataset, transform=tta_transform),
         batch_size=opt.test_batch, num_workers=opt.workers,
         pin_memory=pin_memory)
 
-    queryFliploader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False, flip=True)),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
+    print('initializing model ...')
 
-    galleryFliploader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False, flip=True)),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
+    model = build_model(opt)
 
-    queryCenterloader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False, crop='center')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
+    if opt.pretrained_choice == 'self':
+        state_dict = torch.load(opt.pretrained_model, map_location='cpu')['state_dict']
+        # state_dict = {k: v for k, v in state_dict.items() \
+        #        if not ('reduction' in k or 'softmax' in k)}
+        model.load_state_dict(state_dict, False)
+        print('load pretrained model ' + opt.pretrained_model)
+    print('model size: {:.5f}M'.format(sum(p.numel() for p in model.parameters()) / 1e6))
 
-    galleryCenterloader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False, crop='center')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
+    if use_gpu:
+        model = nn.DataParallel(model).cuda()
+    reid_evaluator = Evaluator(model, norm=opt.norm, eval_flip=opt.eval_flip, re_ranking=opt.re_ranking,
+                               crop_validation=opt.crop_validation, rerank_workers=opt.rerank_workers,
+                               rerank_approximate=opt.rerank_approximate, rerank_shortlist=opt.rerank_shortlist,
+                               ann_probes=opt.ann_probes, rerank_backend=opt.rerank_backend,
+                               rerank_torch_backend=opt.rerank_torch_backend,
+                               ranking_backend=opt.ranking_backend, ann_lists=opt.ann_lists or None,
+                               ann_index=opt.ann_index or None, pq_codec=_pq_codec(), pq_codes=opt.pq_codes or None,
+                               pq_rescore=opt.pq_rescore, hash_codec=_hash_codec(), hash_codes=opt.hash_codes or None,
+                               hash_shortlist=opt.hash_shortlist,
+                               stage_one_columns=_stage_one_columns(model), stage_one_shortlist=opt.stage_one_shortlist,
+                               projection=_projection(), projection_dim=opt.projection_dim or None,
+                               projection_whiten=opt.projection_whiten,
+                               stack_views=opt.stack_views, max_eval_batch=opt.max_eval_batch,
+                               prefetch=opt.prefetch, memmap_dir=opt.feature_memmap_dir or None, search_dtype=opt.search_dtype,
+                               device=device, feature_cache=_feature_cache([opt.pretrained_model]))
 
-    queryLtloader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False, crop='lt')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
+    results = reid_evaluator.extract_features(queryloader, galleryloader,
+                                      k1=6, k2=2, lambda_value=0.3)
 
-    galleryLtloader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False, crop='lt')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
+    # reid_evaluator.validation(queryloader, galleryloader)
 
-    queryRtloader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False, crop='rt')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
+    torch.save(results, './result/submission_example_A.pth'.replace('submission_example_A', opt.pretrained_model.split('/')[-2]))
 
-    galleryRtloader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False, crop='rt')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
+def _train_set_evaluator():
+    # evaluator over the training set with the test transform, to fit codecs on its features
+    os.makedirs(opt.save_dir, exist_ok=True)
+    device = build_device(opt)
+    use_gpu = device.type == 'cuda'
 
-    queryRbloader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False, crop='rb')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
+    print('=========user config==========')
+    pprint(opt._state_dict())
+    print('============end===============')
 
-    galleryRbloader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False, crop='rb')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
+    if use_gpu:
+        print('currently using GPU')
+        cudnn.benchmark = True
+    else:
+        print('currently using cpu, {} threads'.format(torch.get_num_threads()))
 
-    queryLbloader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False, crop='lb')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
+    print('initializing tx_chanllege dataset')
+
+    pin_memory = True if use_gpu else False
+    train_dataset = Tx_dataset(file_list='train_list_new.txt').dataset
 
-    galleryLbloader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False, crop='lb')),
+    tta_transform = build_tta_transforms(opt, flip=opt.eval_flip, crop=opt.eval_flip and opt.crop_validation)
+    trainloader = DataLoader(
+        ImageDataset(train_dataset, transform=tta_transform),
         batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
+        pin_memory=pin_memory)
 
     print('initializing model ...')
 
     model = build_model(opt)
 
     if opt.pretrained_choice == 'self':
-        state_dict = torch.load(opt.pretrained_model)['state_dict']
-        # state_dict = {k: v for k, v in state_dict.items() \
-        #        if not ('reduction' in k or 'softmax' in k)}
+        state_dict = torch.load(opt.pretrained_model, map_location='cpu')['state_dict']
         model.load_state_dict(state_dict, False)
         print('load pretrained model ' + opt.pretrained_model)
-    print('model size: {:.5f}M'.format(sum(p.numel() for p in model.parameters()) / 1e6))
 
     if use_gpu:
         model = nn.DataParallel(model).cuda()
-    reid_evaluator = Evaluator(model, norm=opt.norm, eval_flip=opt.eval_flip, re_ranking=opt.re_ranking,
-                               crop_validation=opt.crop_validation)
+    reid_evaluator = Evaluator(model, norm=opt.norm, eval_flip=opt.eval_flip, crop_validation=opt.crop_validation,
+                               stack_views=opt.stack_views, max_eval_batch=opt.max_eval_batch,
+                               prefetch=opt.prefetch, memmap_dir=opt.feature_memmap_dir or None,
+                               device=device, feature_cache=_feature_cache([opt.pretrained_model]),
+                               projection=_projection(), projection_dim=opt.projection_dim or None,
+                               projection_whiten=opt.projection_whiten)
+    return reid_evaluator, trainloader
+
+def train_pq(**kwargs):
+    opt._parse(kwargs)
 
-    results = reid_evaluator.extract_features(queryloader, galleryloader,
-                                      queryFliploader, galleryFliploader,
-                                      queryCenterloader, galleryCenterloader,
-                                      queryLtloader, galleryLtloader,
-                                      queryRtloader, galleryRtloader,
-                                      queryLbloader, galleryLbloader,
-                                      queryRbloader, galleryRbloader,
-                                      k1=6, k2=2, lambda_value=0.3)
+    reid_evaluator, trainloader = _train_set_evaluator()
+    codec = reid_evaluator.train_pq_codec(trainloader, num_subspaces=opt.pq_subspaces)
+    path = opt.pq_codec or osp.join(opt.save_dir, 'pq_codec.npz')
+    codec.save(path)
+    print('saved product quantizer to ' + path)
 
-    # reid_evaluator.validation(queryloader, galleryloader)
+def train_hash(**kwargs):
+    opt._parse(kwargs)
 
-    torch.save(results, './result/submission_example_A.pth'.replace('submission_example_A', opt.pretrained_model.split('/')[-2]))
+    reid_evaluator, trainloader = _train_set_evaluator()
+    codec = reid_evaluator.train_hash_codec(trainloader, num_bits=opt.hash_bits)
+    path = opt.hash_codec or osp.join(opt.save_dir, 'hash_codec.npz')
+    codec.save(path)
+    print('saved hash codec to ' + path)
+
+def fit_projection(**kwargs):
+    opt._parse(kwargs)
+
+    os.makedirs(opt.save_dir, exist_ok=True)
+    device = build_device(opt)
+    use_gpu = device.type == 'cuda'
+
+    print('=========user config==========')
+    pprint(opt._state_dict())
+    print('============end===============')
+
+    if use_gpu:
+        print('currently using GPU')
+        cudnn.benchmark = True
+    else:
+        print('currently using cpu, {} threads'.format(torch.get_num_threads()))
+
+    print('initializing tx_chanllege dataset')
+
+    pin_memory = True if use_gpu else False
+    train_dataset = Tx_dataset(file_list='train_list_new.txt').dataset
+
+    tta_transform = build_tta_transforms(opt, flip=opt.eval_flip, crop=opt.eval_flip and opt.crop_validation)
+    trainloader = DataLoader(
+        ImageDataset(train_dataset, transform=tta_transform),
+        batch_size=opt.test_batch, num_workers=opt.workers,
+        pin_memory=pin_memory)
+
+    print('initializing model ...')
+
+    model = build_model(opt)
+    checkpoint = torch.load(opt.pretrained_model, map_location='cpu')
+    model.load_state_dict(checkpoint['state_dict'], False)
+    print('load pretrained model ' + opt.pretrained_model)
+
+    if use_gpu:
+        model = nn.DataParallel(model).cuda()
+    reid_evaluator = Evaluator(model, norm=opt.norm, eval_flip=opt.eval_flip, crop_validation=opt.crop_validation,
+                               stack_views=opt.stack_views, max_eval_batch=opt.max_eval_batch,
+                               prefetch=opt.prefetch, device=device)
+
+    # kept out of the checkpoint, which the feature cache keys on
+    path = opt.projection or osp.join(opt.save_dir, 'projection.pth')
+    torch.save(reid_evaluator.fit_projection(trainloader).state_dict(), path)
+    print('saved projection to ' + path)
 
 if __name__ == '__main__':
     import fire
@@ -0,0 +1,27 @@
+# encoding: utf-8
+import torch
+
+from evaluator import Evaluator
+
+
+class _Model(torch.nn.Module):
+
+    def __init__(self):
+        super(_Model, self).__init__()
+        self.fc = torch.nn.Linear(12, 5)
+        self.batch_sizes = []
+
+    def forward(self, x):
+        self.batch_sizes.append(x.size(0))
+        return self.fc(x.flatten(1))
+
+
+def test_stacked_views_respect_max_eval_batch():
+    torch.manual_seed(0)
+    model = _Model()
+    views = [torch.randn(10, 3, 2, 2) for _ in range(5)] + [torch.randn(10, 3, 1, 4) for _ in range(2)]
+    expected = Evaluator(model, device='cpu')._view_features(views)
+    model.batch_sizes = []
+    stacked = Evaluator(model, stack_views=True, max_eval_batch=7, device='cpu')._view_features(views)
+    assert max(model.batch_sizes) == 7
+    assert torch.allclose(stacked, expected, atol=1e-5)
@@ -0,0 +1,28 @@
+# encoding: utf-8
+import os.path as osp
+import subprocess
+import sys
+
+ROOT = osp.dirname(osp.dirname(osp.abspath(__file__)))
+
+KEY_SCRIPT = """
+import sys
+from config import opt
+from feature_cache import FeatureCache
+from transformer import build_tta_transforms
+
+cache = FeatureCache(sys.argv[1], [sys.argv[2]], {'model_name': 'MGN'})
+transform = build_tta_transforms(opt, flip=True, crop=True)
+print(cache.key([('a.png', 0), ('b.png', 1)], transform, eval_flip=True, crop_validation=True))
+"""
+
+
+def _key(tmpdir, checkpoint):
+    return subprocess.check_output([sys.executable, '-c', KEY_SCRIPT, str(tmpdir), str(checkpoint)],
+                                   cwd=ROOT).decode().strip()
+
+
+def test_key_is_stable_across_processes_with_crop_tta(tmp_path):
+    checkpoint = tmp_path / 'checkpoint.pth'
+    checkpoint.write_bytes(b'weights')
+    assert _key(tmp_path, checkpoint) == _key(tmp_path, checkpoint)
@@ -0,0 +1,40 @@
+# encoding: utf-8
+import os
+
+import numpy as np
+import pytest
+
+import reranking
+
+
+def _distances(num_query=5, num_gallery=20, dim=8):
+    rng = np.random.RandomState(0)
+    feats = rng.randn(num_query + num_gallery, dim).astype(np.float32)
+    dist = np.sqrt(((feats[:, None] - feats[None]) ** 2).sum(axis=2))
+    return dist[:num_query, num_query:], dist[:num_query, :num_query], dist[num_query:, num_query:]
+
+
+def test_out_of_core_keeps_only_final_dist(tmp_path):
+    final_dist = reranking.re_ranking_out_of_core(*_distances(), scratch_dir=str(tmp_path))
+    assert final_dist.shape == (5, 20)
+    assert os.listdir(str(tmp_path)) == ['final_dist.dat']
+
+
+def test_out_of_core_removes_its_scratch_dir_on_error(tmp_path, monkeypatch):
+    def fail(*args, **kwargs):
+        raise MemoryError
+
+    monkeypatch.setattr(reranking.tempfile, 'tempdir', str(tmp_path))
+    monkeypatch.setattr(reranking, '_re_ranking_sparse', fail)
+    with pytest.raises(MemoryError):
+        reranking.re_ranking_out_of_core(*_distances())
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_rerank_index_loads_from_the_path_it_was_saved_to(tmp_path):
+    rng = np.random.RandomState(0)
+    qf, gf = rng.randn(5, 8).astype(np.float32), rng.randn(30, 8).astype(np.float32)
+    index = reranking.RerankIndex(k1=5, k2=2).build(gf)
+    path = str(tmp_path / 'gallery.index')
+    index.save(path)
+    assert np.array_equal(reranking.RerankIndex.load(path).rerank(qf), index.rerank(qf))
@@ -23,11 +23,12 @@ from models import build_model
 from trainer import cls_tripletTrainer
 from loss import CrossEntropyLabelSmooth, TripletLoss, CenterLoss
 from logger import Logger, save_checkpoint
-from transformer import build_transforms
+from transformer import build_transforms, build_tta_transforms
 from lr_schedule import adjust_lr
 from datasets.collate_batch import val_collate_fn, train_collate_fn
 from config import opt
 from evaluator import Evaluator
+from device import build_device
 from loss import make_loss_with_center, make_loss
 
 def train(**kwargs):
@@ -36,7 +37,8 @@ def train(**kwargs):
     # set random seed and cudnn benchmark
     torch.manual_seed(opt.seed)
     os.makedirs(opt.save_dir, exist_ok=True)
-    use_gpu = torch.cuda.is_available()
+    device = build_device(opt)
+    use_gpu = device.type == 'cuda'
     sys.stdout = Logger(osp.join(opt.save_dir, 'log_train.txt'))
 
     print('=========user config==========')
@@ -48,7 +50,7 @@ def train(**kwargs):
         cudnn.benchmark = True
         torch.cuda.manual_seed_all(opt.seed)
     else:
-        print('currently using cpu')
+        print('currently using cpu, {} threads'.format(torch.get_num_threads()))
 
     print('initializing tx_chanllege dataset')
     dataset = Tx_dataset(file_list='train_list_new.txt').dataset
@@ -77,88 +79,17 @@ def train(**kwargs):
             pin_memory=pin_memory, drop_last=True
         )
 
+    tta_transform = build_tta_transforms(opt, flip=opt.eval_flip, crop=opt.eval_flip and opt.crop_validation)
     queryloader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False)),
+        ImageDataset(query_dataset, transform=tta_transform),
         batch_size=opt.test_batch, num_workers=opt.workers,
         pin_memory=pin_memory)
 
     galleryloader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False)),
+        ImageDataset(gallery_dataset, transform=tta_transform),
         batch_size=opt.test_batch, num_workers=opt.workers,
         pin_memory=pin_memory)
 
-    queryFliploader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False, flip=True)),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    galleryFliploader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False, flip=True)),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    queryCenterloader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False, crop='center')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    galleryCenterloader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False, crop='center')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    queryLtloader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False, crop='lt')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    galleryLtloader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False, crop='lt')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    queryRtloader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False, crop='rt')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    galleryRtloader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False, crop='rt')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    queryRbloader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False, crop='rb')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    galleryRbloader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False, crop='rb')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    queryLbloader = DataLoader(
-        ImageDataset(query_dataset, transform=build_transforms(opt, is_train=False, crop='lb')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
-    galleryLbloader = DataLoader(
-        ImageDataset(gallery_dataset, transform=build_transforms(opt, is_train=False, crop='lb')),
-        batch_size=opt.test_batch, num_workers=opt.workers,
-        pin_memory=pin_memory
-    )
-
     print('initializing model ...')
 
     model = build_model(opt)
@@ -166,7 +97,7 @@ def train(**kwargs):
     optim_policy = model.get_optim_policy()
 
     if opt.pretrained_choice == 'self':
-        state_dict = torch.load(opt.pretrained_model)['state_dict']
+        state_dict = torch.load(opt.pretrained_model, map_location='cpu')['state_dict']
         # state_dict = {k: v for k, v in state_dict.items() \
         #        if not ('reduction' in k or 'softmax' in k)}
         model.load_state_dict(state_dict, False)
@@ -175,12 +106,19 @@ def train(**kwargs):
 
     if use_gpu:
         model = nn.DataParallel(model).cuda()
-    reid_evaluator = Evaluator(model, norm=opt.norm, eval_flip=opt.eval_flip, re_ranking=opt.re_ranking)
+    reid_evaluator = Evaluator(model, norm=opt.norm, eval_flip=opt.eval_flip, crop_validation=opt.crop_validation,
+                               re_ranking=opt.re_ranking, rerank_workers=opt.rerank_workers,
+                               rerank_approximate=opt.rerank_approximate, rerank_shortlist=opt.rerank_shortlist,
+                               ann_probes=opt.ann_probes, rerank_backend=opt.rerank_backend,
+                               rerank_torch_backend=opt.rerank_torch_backend,
+                               stack_views=opt.stack_views, max_eval_batch=opt.max_eval_batch,
+                               prefetch=opt.prefetch, memmap_dir=opt.feature_memmap_dir or None,
+                               device=device)
 
     if opt.use_center:
-        criterion = make_loss_with_center(opt)
+        criterion = make_loss_with_center(opt, device=device)
     else:
-        criterion = make_loss(opt)
+        criterion = make_loss(opt, device=device)
 
     # get optimizer
     if opt.optim == "sgd":
@@ -190,7 +128,7 @@ def train(**kwargs):
 
     start_epoch = opt.start_epoch
     # get trainer and evaluator
-    reid_trainer = cls_tripletTrainer(opt, model, optimizer, criterion, summary_writer)
+    reid_trainer = cls_tripletTrainer(opt, model, optimizer, criterion, summary_writer, device=device)
 
     # start training
     best_rank1 = opt.best_rank
@@ -202,20 +140,9 @@ def train(**kwargs):
 
         # skip if not save model
         if opt.eval_step > 0 and (epoch + 1) % opt.eval_step == 0 or (epoch + 1) == opt.max_epoch:
-            rank1 = reid_evaluator.validation(queryloader, galleryloader, queryFliploader, galleryFliploader,
-                                              queryCenterloader, galleryCenterloader,
-                                              queryLtloader, galleryLtloader,
-                                              queryRtloader, galleryRtloader,
-                                              queryLbloader, galleryLbloader,
-                                              queryRbloader, galleryRbloader)
+            rank1 = reid_evaluator.validation(queryloader, galleryloader)
             print('start re_ranking......')
             _ = reid_evaluator.validation(queryloader, galleryloader,
-                                          queryFliploader, galleryFliploader,
-                                          queryCenterloader, galleryCenterloader,
-                                          queryLtloader, galleryLtloader,
-                                          queryRtloader, galleryRtloader,
-                                          queryLbloader, galleryLbloader,
-                                          queryRbloader, galleryRbloader,
                                           re_ranking=True)
             is_best = rank1 > best_rank1
             if is_best:
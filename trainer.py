@@ -6,6 +6,7 @@
 import math
 import time
 import numpy as np
+import torch
 
 class AverageMeter(object):
     def __init__(self):
@@ -43,8 +44,9 @@ class AverageMeter(object):
         self.std = np.nan
 
 class cls_tripletTrainer:
-    def __init__(self, opt, model, optimzier, criterion, summary_writer):
+    def __init__(self, opt, model, optimzier, criterion, summary_writer, device='cuda'):
         self.opt = opt
+        self.device = torch.device(device)
         self.model = model
         self.optimizer= optimzier
         self.criterion = criterion
@@ -95,8 +97,8 @@ class cls_tripletTrainer:
 
     def _parse_data(self, inputs):
         imgs, pids, _ = inputs
-        self.data = imgs.cuda()
-        self.target = pids.cuda()
+        self.data = imgs.to(self.device, non_blocking=True)
+        self.target = pids.to(self.device, non_blocking=True)
 
     def _forward(self):
         score, feat = self.model(self.data)
@@ -4,4 +4,4 @@
 @contact: zhoumi281571814@126.com
 """
 
-from .build import build_transforms
+from .build import build_transforms, build_tta_transforms
@@ -6,7 +6,7 @@
 
 import torchvision.transforms as T
 
-from .transforms import RandomErasing
+from .transforms import MultiView, RandomErasing
 from .crop import center_crop, crop_lb, crop_lt, crop_rb, crop_rt
 
 def build_transforms(opt, is_train=True, flip=False, crop = ''):
@@ -73,3 +73,22 @@ def build_transforms(opt, is_train=True, flip=False, crop = ''):
                 ])
 
     return transform
+
+
+def build_tta_transforms(opt, flip=False, crop=False):
+    """One transform producing every test-time view of an image, in the order
+    plain, flip, center, lt, rt, lb, rb (flip and the crops only when asked for).
+    Each view equals the build_transforms(opt, is_train=False, ...) one."""
+    normalize_transform = T.Compose([
+        T.ToTensor(),
+        T.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+    ])
+    views = [normalize_transform]
+    if flip:
+        views.append(T.Compose([T.RandomHorizontalFlip(p=1.0), normalize_transform]))
+    groups = [(T.Resize(opt.SIZE_TEST), views)]
+    if crop:
+        groups.append((T.Resize([x+10 for x in opt.SIZE_TEST]),
+                       [T.Compose([crop_view(384, 128), normalize_transform])
+                        for crop_view in (center_crop, crop_lt, crop_rt, crop_lb, crop_rb)]))
+    return MultiView(groups)
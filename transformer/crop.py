@@ -11,6 +11,9 @@ class crop_lt(object):
     def __call__(self, x):
         return x.crop((0, 0, self.crop_w, self.crop_h))
 
+    def __repr__(self):
+        return '{}(crop_h={}, crop_w={})'.format(self.__class__.__name__, self.crop_h, self.crop_w)
+
 
 class crop_lb(object):
     def __init__(self, crop_h, crop_w):
@@ -20,6 +23,9 @@ class crop_lb(object):
     def __call__(self, x):
         return x.crop((0, x.size[1] - self.crop_h ,self.crop_w, x.size[1]))
 
+    def __repr__(self):
+        return '{}(crop_h={}, crop_w={})'.format(self.__class__.__name__, self.crop_h, self.crop_w)
+
 class crop_rt(object):
     def __init__(self, crop_h, crop_w):
         self.crop_h = crop_h
@@ -28,6 +34,9 @@ class crop_rt(object):
     def __call__(self, x):
         return x.crop((x.size[0] - self.crop_w, 0 , x.size[0], self.crop_h))
 
+    def __repr__(self):
+        return '{}(crop_h={}, crop_w={})'.format(self.__class__.__name__, self.crop_h, self.crop_w)
+
 class crop_rb(object):
     def __init__(self, crop_h, crop_w):
         self.crop_h = crop_h
@@ -36,6 +45,9 @@ class crop_rb(object):
     def __call__(self, x):
         return x.crop((x.size[0] - self.crop_w, x.size[1] - self.crop_h, x.size[0], x.size[1]))
 
+    def __repr__(self):
+        return '{}(crop_h={}, crop_w={})'.format(self.__class__.__name__, self.crop_h, self.crop_w)
+
 class center_crop(object):
     def __init__(self, crop_h, crop_w):
         self.crop_h = crop_h
@@ -52,4 +64,7 @@ class center_crop(object):
         x_min = center_w - half_crop_w
         x_max = center_w + half_crop_w + self.crop_w % 2
 
-        return x.crop((x_min, y_min, x_max, y_max))
\ No newline at end of file
+        return x.crop((x_min, y_min, x_max, y_max))
+
+    def __repr__(self):
+        return '{}(crop_h={}, crop_w={})'.format(self.__class__.__name__, self.crop_h, self.crop_w)
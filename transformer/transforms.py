@@ -53,3 +53,25 @@ class RandomErasing(object):
                 return img
 
         return img
+
+
+class MultiView(object):
+    """ All test-time views of one image, returned as a tuple in order.
+    Args:
+         groups: list of (resize, views); the image is resized once per group and
+                 every transform in views is applied to that resized image.
+    """
+
+    def __init__(self, groups):
+        self.groups = groups
+
+    def __call__(self, img):
+        outputs = []
+        for resize, views in self.groups:
+            resized = resize(img)
+            for view in views:
+                outputs.append(view(resized))
+        return tuple(outputs)
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, self.groups)